@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for nodebalance on synthetic large nodes.
+
+Times every balance mode of node_balance against synthetic listfunds/listpeerchannels
+payloads (rendered, and answered from the response cache), format_balance, channel-details formatting against the per-channel
+format_balance/format_currency path it replaced, and get_currency_rates cold and warm
+against a local stub of the rate providers with simulated latency and failures.
+
+Results can be saved as a baseline and later runs compared against it; a comparison
+exits non-zero when any benchmark is slower than the baseline by more than the tolerance.
+
+Usage: python bench_nodebalance.py [--sizes 10000,100000,1000000] [--repeat N] [--latency SECONDS]
+                                   [--save FILE] [--compare FILE] [--tolerance FRACTION]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import nodebalance
+from nodebalance import (format_balance, format_currency, build_format_table, format_channel_details, node_balance,
+                         get_currency_rates, reset_provider_health, CONVERSION_RATES, RATES_CACHE, HTTP_VALIDATORS,
+                         VALID_CURRENCIES)
+
+CURRENCIES = ["usd", "eur", "gbp", "jpy", "mxn"]
+RATES = dict(CONVERSION_RATES, usd=100000000000 / 100000, eur=100000000000 / 91604,
+             gbp=100000000000 / 78000, jpy=100000000000 / 15000000, mxn=100000000000 / 2000000)
+BALANCE_MODES = ["total", "onchain", "channels", "channel-details"]
+
+# Fiat per BTC served by the stub providers for every supported currency
+STUB_PRICES = {currency: 100000 * (1 + i / 10) for i, currency in enumerate(VALID_CURRENCIES)}
+
+# Provider behaviour per scenario: provider -> (delay factor x --latency, HTTP status); unlisted providers
+# answer after one latency. "timeout" delays beyond nodebalance-http-timeout.
+PROVIDER_SCENARIOS = {
+    "healthy": {},
+    "primary-error": {"coingecko": (1, 500)},
+    "primary-timeout": {"coingecko": ("timeout", 200)},
+    "all-down": {"coingecko": (1, 500), "coinpaprika": (1, 503), "coincap": (1, 500)},
+}
+STUB = {"scenario": "healthy", "latency": 0.05}
+HTTP_TIMEOUT = 1
+
+def synthetic_listfunds(count):
+    """listfunds outputs: mostly confirmed, some reserved or unconfirmed."""
+    return {"outputs": [
+        {"txid": "%064x" % i, "output": i % 4, "amount_msat": 1000 + (i * 7919) % 10 ** 9,
+         "status": "unconfirmed" if i % 50 == 0 else "confirmed", "reserved": i % 20 == 0}
+        for i in range(count)
+    ]}
+
+def synthetic_listpeerchannels(count):
+    """listpeerchannels channels: mostly connected CHANNELD_NORMAL, with varied balances."""
+    return {"channels": [
+        {"peer_id": "02" + "%064x" % i, "peer_connected": i % 13 != 0, "channel_id": "%064x" % i,
+         "short_channel_id": f"{800000 + i}x{i % 3000}x{i % 2}", "state": "CHANNELD_NORMAL" if i % 17 else "ONCHAIN",
+         "to_us_msat": (i * 7919) % 10 ** 9, "total_msat": 10 ** 9}
+        for i in range(count)
+    ]}
+
+def synthetic_channels(count):
+    """Connected CHANNELD_NORMAL channels with varied balances, as list_channels returns them."""
+    return [
+        {"peer_id": "02" + "%064x" % i, "short_channel_id": f"{800000 + i}x{i % 3000}x{i % 2}",
+         "state": "CHANNELD_NORMAL", "connected": True,
+         "our_amount_msat": (i * 7919) % 10 ** 9, "amount_msat": 10 ** 9}
+        for i in range(count)
+    ]
+
+class FakeRpc:
+    """Answers listfunds and listpeerchannels with fixed payloads."""
+
+    def __init__(self, size):
+        self.responses = {"listfunds": synthetic_listfunds(size), "listpeerchannels": synthetic_listpeerchannels(size)}
+
+    def call(self, method, payload=None, filter=None):
+        return self.responses[method]
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """CoinGecko, CoinPaprika and CoinCap look-alikes behaving as STUB["scenario"] dictates."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        provider = url.path.split("/")[1]
+        delay, status = PROVIDER_SCENARIOS[STUB["scenario"]].get(provider, (1, 200))
+        time.sleep(HTTP_TIMEOUT + STUB["latency"] if delay == "timeout" else delay * STUB["latency"])
+        if url.path == "/coingecko/simple/price":
+            currencies = parse_qs(url.query).get("vs_currencies", [""])[0].split(",")
+            body = {"bitcoin": {c: STUB_PRICES[c] for c in currencies if c in STUB_PRICES}}
+        elif url.path == "/coinpaprika/tickers/btc-bitcoin":
+            body = {"quotes": {c.upper(): {"price": price} for c, price in STUB_PRICES.items()}}
+        elif url.path == "/coincap/rates/bitcoin":
+            body = {"data": {"id": "bitcoin", "rateUsd": str(STUB_PRICES["usd"])}}
+        elif url.path == "/coincap/rates":
+            body = {"data": [{"id": c, "rateUsd": str(STUB_PRICES["usd"] / price)} for c, price in STUB_PRICES.items()]}
+        else:
+            status, body = 404, {}
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # Client gave up (timeout scenario)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_providers():
+    """Serve the stub providers on an ephemeral local port and point nodebalance at them."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubProviderHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    nodebalance.COINGECKO_API = f"{base}/coingecko"
+    nodebalance.COINPAPRIKA_API = f"{base}/coinpaprika"
+    nodebalance.COINCAP_API = f"{base}/coincap"
+    return server
+
+def reset_rates_cache():
+    """Forget every fetched rate, HTTP validator and provider health record, as on a cold start."""
+    RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+    RATES_CACHE["timestamp"] = 0
+    RATES_CACHE["timestamps"] = {}
+    RATES_CACHE["ttls"] = {}
+    RATES_CACHE["sources"] = {}
+    RATES_CACHE["retrying"].clear()
+    HTTP_VALIDATORS.clear()
+    reset_provider_health()
+
+def warm_rates_cache():
+    """Cache freshly fetched RATES for CURRENCIES so balance benchmarks never fetch."""
+    reset_rates_cache()
+    RATES_CACHE["rates"] = RATES.copy()
+    RATES_CACHE["timestamp"] = time.time()
+    for currency in CURRENCIES:
+        RATES_CACHE["timestamps"][currency] = time.time()
+        RATES_CACHE["ttls"][currency] = nodebalance.CACHE_TIMEOUT
+        RATES_CACHE["sources"][currency] = "bench"
+
+def per_channel_details(channels, rates, fiat_currencies):
+    """channel-details as formatted before the precomputed table: every call re-checks every rate."""
+    return [
+        {
+            "peer_id": ch["peer_id"][:10] + "...",
+            "short_channel_id": ch["short_channel_id"],
+            "outbound_capacity": format_currency(ch["our_amount_msat"], "msats", rates),
+            "inbound_capacity": format_currency(ch["amount_msat"] - ch["our_amount_msat"], "msats", rates),
+            "outbound_balance": format_balance(ch["our_amount_msat"], rates, fiat_currencies),
+            "inbound_balance": format_balance(ch["amount_msat"] - ch["our_amount_msat"], rates, fiat_currencies)
+        } for ch in channels
+        if ch["state"] == "CHANNELD_NORMAL" and ch["connected"]
+    ]
+
+def table_details(channels, rates, fiat_currencies):
+    """channel-details with rates checked once into a format table."""
+    return format_channel_details(channels, build_format_table(rates, fiat_currencies))[0]
+
+def best_of(func, repeat, setup=None):
+    """
+    Best wall time of repeat runs of func, in seconds; setup runs untimed before each.
+    Like timeit, garbage collection is paused while func runs, so collections triggered by
+    earlier allocations do not land in whichever benchmark happens to be running.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_balance_modes(results, sizes, repeat):
+    """
+    node_balance for every balance mode on synthetic nodes, rates cached, no ledger. The response
+    cache is disabled so every repeat renders; node_balance_cached times the repeated-call hit.
+    """
+    nodebalance.BALANCE_LEDGER["ready"] = False
+    warm_rates_cache()
+    response_cache = nodebalance.plugin.options["nodebalance-response-cache"]
+    for size in sizes:
+        nodebalance.plugin.rpc = FakeRpc(size)
+        for mode in BALANCE_MODES:
+            response_cache.value = 0
+            nodebalance.RESPONSE_CACHE["entries"].clear()
+            results[f"node_balance/{mode}/{size}"] = best_of(
+                lambda: node_balance(nodebalance.plugin, mode=mode, currencies="usd,eur"), repeat)
+            response_cache.value = None
+            node_balance(nodebalance.plugin, mode=mode, currencies="usd,eur")
+            results[f"node_balance_cached/{mode}/{size}"] = best_of(
+                lambda: node_balance(nodebalance.plugin, mode=mode, currencies="usd,eur"), repeat)
+    nodebalance.RESPONSE_CACHE["entries"].clear()
+
+def bench_formatting(results, sizes, repeat):
+    """format_balance per amount, and channel-details per-channel path against the format table."""
+    amounts = [(i * 7919) % 10 ** 12 for i in range(10000)]
+    results["format_balance/10000"] = best_of(lambda: [format_balance(a, RATES, CURRENCIES) for a in amounts], repeat)
+    for size in sizes:
+        channels = synthetic_channels(size)
+        if size == sizes[0]:
+            assert per_channel_details(channels, RATES, CURRENCIES) == table_details(channels, RATES, CURRENCIES)
+        results[f"channel_details/per_channel/{size}"] = best_of(
+            lambda: per_channel_details(channels, RATES, CURRENCIES), repeat)
+        results[f"channel_details/format_table/{size}"] = best_of(
+            lambda: table_details(channels, RATES, CURRENCIES), repeat)
+
+def bench_rates(results, repeat):
+    """get_currency_rates cold (empty cache) per provider scenario and fetch mode, then warm."""
+    start_stub_providers()
+    nodebalance.plugin.options["nodebalance-http-timeout"].value = HTTP_TIMEOUT
+    for fetch_mode in ("sequential", "hedged"):
+        nodebalance.plugin.options["nodebalance-fetch-mode"].value = fetch_mode
+        for scenario in PROVIDER_SCENARIOS:
+            STUB["scenario"] = scenario
+            results[f"rates/cold/{scenario}/{fetch_mode}"] = best_of(
+                lambda: get_currency_rates(CURRENCIES), repeat, setup=reset_rates_cache)
+    STUB["scenario"] = "healthy"
+    reset_rates_cache()
+    get_currency_rates(CURRENCIES)
+    results["rates/warm"] = best_of(lambda: get_currency_rates(CURRENCIES), repeat)
+
+def compare(results, baseline, tolerance):
+    """Print each benchmark against the baseline; returns the names slower than 1 + tolerance times it."""
+    regressions = []
+    print(f"\n{'benchmark':<48} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if not before:
+            print(f"{name:<48} {'-':>12} {seconds * 1000:10.2f}ms {'new':>7}")
+            continue
+        ratio = seconds / before
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<48} {before * 1000:10.2f}ms {seconds * 1000:10.2f}ms {ratio:6.2f}x{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma-separated output/channel counts of the synthetic nodes (default: 10000,100000)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated provider latency in seconds")
+    parser.add_argument("--skip-rates", action="store_true", help="Skip the rate provider benchmarks")
+    parser.add_argument("--save", metavar="FILE", help="Save results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="Compare results against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline before failing (default: 0.25)")
+    args = parser.parse_args()
+
+    nodebalance.plugin.log = lambda *args, **kwargs: None
+    sizes = [int(size) for size in args.sizes.split(",")]
+    STUB["latency"] = args.latency
+    results = {}
+    bench_balance_modes(results, sizes, args.repeat)
+    bench_formatting(results, sizes, args.repeat)
+    if not args.skip_rates:
+        bench_rates(results, args.repeat)
+
+    for name, seconds in results.items():
+        print(f"{name:<48} {seconds * 1000:10.2f}ms")
+    for size in sizes:
+        before = results[f"channel_details/per_channel/{size}"]
+        after = results[f"channel_details/format_table/{size}"]
+        print(f"channel-details format table speedup at {size} channels: {before / after:.2f}x")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "repeat": args.repeat,
+                       "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
-from pyln.client import Plugin
+from pyln.client import Plugin, LightningRpc
 import json
-import requests
+import os
 import time
+import threading
+import statistics
+import heapq
+import functools
+from array import array
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+# requests, concurrent.futures, sqlite3, http.server and email.utils are imported where first
+# used, keeping them off the startup path lightningd waits on
 
 plugin = Plugin()
 
@@ -16,9 +24,16 @@ VALID_CURRENCIES = [
     "php", "pkr", "pln", "rub", "sar", "sek", "sgd", "thb", "try", "twd",
     "uah", "usd", "vef", "vnd", "xag", "xau", "xdr", "zar"
 ]
+VALID_CURRENCY_SET = frozenset(VALID_CURRENCIES)
 
 # Default currencies and fallback rates (msat as base)
 DEFAULT_CURRENCIES = ["usd", "mxn"]
+VALID_MODES = ["total", "onchain", "channels", "channel-details", "summary", "rate"]
+CHANNEL_SORT_KEYS = ["outbound", "inbound", "ratio"]
+OUTPUT_FORMATS = ["text", "raw"]
+SUMMARY_TOP = 5  # Most imbalanced channels listed by the summary mode
+SUMMARY_PERCENTILES = [10, 25, 50, 75, 90]
+SUMMARY_HISTOGRAM_BUCKETS = 10
 CONVERSION_RATES = {
     "msats": 1,  # Base unit
     "sats": 1000,  # 1 sat = 1000 msat
@@ -27,127 +42,871 @@ CONVERSION_RATES = {
     "usd": 0.000001   # Fallback: 1 msat = 0.000001 USD (1 BTC ≈ 100,000 USD)
 }
 
-# Cache for currency rates
-RATES_CACHE = {"rates": CONVERSION_RATES, "timestamp": 0}
+# Cache for currency rates, with per-currency fetch time and provider of every fetched rate;
+# "retrying" holds the currencies whose last fetch failed and that wait out RETRY_TIMEOUT
+RATES_CACHE = {"rates": CONVERSION_RATES, "timestamp": 0, "timestamps": {}, "ttls": {}, "sources": {}, "retrying": set()}
 CACHE_TIMEOUT = 3600  # Cache rates for 1 hour
+RETRY_TIMEOUT = 300  # Retry currencies no API could quote after 5 minutes
+REFRESH_AHEAD = 300  # Background refresher renews rates 5 minutes before they expire
+MAX_STALE_AGE = 6 * 3600  # Serve expired rates for up to 6 hours while a refresh runs
+RATES_LOCK = threading.RLock()
+
+# On-disk copy of RATES_CACHE for warm restarts; path is set at init
+RATE_STORE = {"path": None}
+RATE_STORE_FILE = "nodebalance-rates.json"
+
+# Log levels understood by lightningd, lowest first; messages below nodebalance-log-level are dropped
+LOG_LEVELS = {"debug": 0, "info": 1, "warn": 2, "error": 3}
+LOG_CONFIG = {"threshold": LOG_LEVELS["info"]}
+
+# Shared keep-alive HTTP session and conditional-request validators per URL
+HTTP_SESSION = {"session": None, "lock": threading.Lock()}
+HTTP_VALIDATORS = {}
+
+# Rate provider API base URLs
+COINGECKO_API = "https://api.coingecko.com/api/v3"
+COINPAPRIKA_API = "https://api.coinpaprika.com/v1"
+COINCAP_API = "https://api.coincap.io/v2"
+
+# Rate provider registry (name -> fetch(currencies) returning fiat-per-BTC quotes or None), tried in
+# order of health, and per-provider health: EWMA latency, recent outcomes, 429 backoff and circuit breaker
+RATE_PROVIDERS = OrderedDict()
+PROVIDER_HEALTH = {}
+PROVIDER_LOCK = threading.Lock()
+HEALTH_WINDOW = 20  # Outcomes kept for the rolling success rate
+LATENCY_ALPHA = 0.3  # Weight of the newest latency in the EWMA
+PRIOR_LATENCY_MS = 1000  # Latency assumed for providers not tried yet, so registry order holds until one degrades
+CIRCUIT_FAILURES = 3  # Consecutive failures that open a provider's circuit
+CIRCUIT_COOLDOWN = 60  # Seconds an opened circuit stays open, doubling on each failed half-open trial
+CIRCUIT_MAX_COOLDOWN = 1800
+RATE_LIMIT_BACKOFF = 60  # Seconds to skip a provider after HTTP 429 without a usable Retry-After
+MAX_RETRY_AFTER = 3600
+
+# Single-flight rate refreshes: currency -> Event set when the refresh fetching it finishes
+RATE_FLIGHTS = {}
+RATE_FLIGHTS_LOCK = threading.Lock()
+
+# Worker threads answering nodebalance/nodebalance-batch off the plugin's main loop
+REQUEST_EXECUTOR = {"executor": None, "lock": threading.Lock()}
+REQUEST_WORKERS = 8
+
+# Fleet aggregation: one reusable RPC client and one single-worker pool per extra node socket.
+# LightningRpc calls cannot time out, so a hung node holds its worker; FLEET_CALLS keeps each
+# node's last call so no more work is queued behind one that has not returned.
+FLEET_RPCS = {}
+FLEET_EXECUTORS = {}
+FLEET_CALLS = {}
+FLEET_LOCK = threading.Lock()
+FLEET_TIMEOUT = 10  # Seconds to wait for every node before reporting partial results
+
+# Concurrent provider fetching (nodebalance-fetch-mode hedged/median)
+FETCH_MODES = ["sequential", "hedged", "median"]
+HEDGE_DELAY = 1  # Seconds to wait on a provider before also starting the next one
+FETCH_DEADLINE = 6  # Overall deadline in seconds for a concurrent fetch
+FETCH_EXECUTOR = {"executor": None, "lock": threading.Lock()}
+
+# Field filters for the balance RPCs, so lightningd only serializes what the modes read
+OUTPUTS_FILTER = {"outputs": [{"amount_msat": True, "status": True, "reserved": True}]}
+LEDGER_OUTPUTS_FILTER = {"outputs": [{"txid": True, "output": True, "amount_msat": True, "status": True, "reserved": True}]}
+CHANNELS_FILTER = {"channels": [{
+    "peer_id": True, "peer_connected": True, "channel_id": True, "short_channel_id": True,
+    "state": True, "to_us_msat": True, "total_msat": True
+}]}
+
+# Incremental balance ledger built from listfunds/listpeerchannels and kept current from notifications.
+# Outputs are keyed by "txid:output", channels by channel_id; totals only count confirmed
+# unreserved outputs and connected CHANNELD_NORMAL channels, like the RPC-based modes.
+BALANCE_LEDGER = {
+    "ready": False,
+    "dirty": False,
+    "outputs": {},
+    "channels": {},
+    "onchain_msat": 0,
+    "channel_msat": 0,
+    "reconciled": 0,
+    "version": 0,  # Bumped on every change, so responses rendered from the ledger can be reused until then
+    "events": 0  # Notifications received, so a reconcile can tell whether any arrived during its RPC calls
+}
+LEDGER_LOCK = threading.RLock()
+LEDGER_RECONCILE = {"thread": None, "wake": threading.Event()}
+RECONCILE_INTERVAL = 600  # Full RPC reconcile every 10 minutes
+RECONCILE_ATTEMPTS = 3  # RPC rounds a reconcile tries before settling for a snapshot notifications raced with
+RECONCILE_RETRY = 10  # Seconds before reconciling again after such a snapshot
+
+# Background rate refresher state; "currencies" maps each requested currency to when it was last asked for
+REFRESHER = {"thread": None, "wake": threading.Event(), "currencies": {}}
+REQUEST_WINDOW = 24 * 3600  # Stop refreshing currencies nobody asked for in a day
+
+# Balance and rate history; raw samples roll up into hourly and daily buckets as they are written.
+# Each resolution (seconds per bucket, 0 for raw) is kept for its retention in seconds (None keeps forever).
+HISTORY_STORE = {"path": None, "conn": None, "lock": threading.Lock()}
+HISTORY_STORE_FILE = "nodebalance-history.sqlite3"
+HISTORY_SAMPLER = {"thread": None, "wake": threading.Event()}
+HISTORY_RESOLUTIONS = OrderedDict([("raw", 0), ("hour", 3600), ("day", 86400)])
+HISTORY_RETENTION = {0: 2 * 86400, 3600: 90 * 86400, 86400: None}
+
+# Stage timers, counters and per-provider outcome/latency histograms reported by nodebalance-stats.
+# STATS_CALL.stages collects the stage timings of the RPC call running on the current thread.
+STATS = {"lock": threading.Lock(), "since": time.time(), "timers": {}, "counters": {}, "providers": {}}
+STATS_CALL = threading.local()
+LATENCY_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Bounded LRU of rendered balance responses; entries hold the rate table they were priced with, and
+# refresh_rates/load_rates_cache always install a new table, so its identity acts as the rate version
+RESPONSE_CACHE = {"entries": OrderedDict(), "lock": threading.Lock()}
+RESPONSE_CACHE_SIZE = 64
+
+# Prometheus exporter; "body" is the pre-rendered exposition served to every scrape until the next refresh
+METRICS = {"server": None, "thread": None, "wake": threading.Event(), "body": b""}
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_INTERVAL = 15  # Seconds between metrics snapshot refreshes
+
+# Balance change notifications; "baseline" holds the values last notified, "funds" the on-chain/channel
+# totals of the latest RPC snapshot, and "wake" is set whenever the ledger or the rate table changes
+NOTIFIER = {"thread": None, "wake": threading.Event(), "baseline": None, "last_sent": 0, "funds": {}}
+NOTIFY_TOPIC = "nodebalance_changed"
+NOTIFY_DEBOUNCE = 60  # Minimum seconds between two notifications
+
+def set_log_level(plugin, name, value):
+    """Apply a new nodebalance-log-level."""
+    if value not in LOG_LEVELS:
+        raise ValueError(f"Invalid log level: {value}. Use: {', '.join(LOG_LEVELS)}")
+    LOG_CONFIG["threshold"] = LOG_LEVELS[value]
+
+def log_enabled(level):
+    """Check whether messages at level pass nodebalance-log-level."""
+    return LOG_LEVELS[level] >= LOG_CONFIG["threshold"]
+
+def log(message, *args, level="info"):
+    """Log message at level; %-style args are only formatted when the level is enabled."""
+    if LOG_LEVELS[level] < LOG_CONFIG["threshold"]:
+        return
+    plugin.log(message % args if args else message, level=level)
+
+def log_payload(label, payload):
+    """Dump a full payload as indented JSON at debug level only."""
+    if log_enabled("debug"):
+        plugin.log(f"{label}: {json.dumps(payload, indent=2)}", level="debug")
+
+def record_timing(stage, seconds):
+    """Add one timing of stage to its timer and to the current call's breakdown."""
+    with STATS["lock"]:
+        timer = STATS["timers"].setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0})
+        timer["count"] += 1
+        timer["total"] += seconds
+        timer["max"] = max(timer["max"], seconds)
+    stages = getattr(STATS_CALL, "stages", None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0) + seconds
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block as stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(stage, time.perf_counter() - start)
+
+def count(name, amount=1):
+    """Increment counter name."""
+    with STATS["lock"]:
+        STATS["counters"][name] = STATS["counters"].get(name, 0) + amount
+
+def record_provider(api_name, seconds, success):
+    """Count a provider fetch outcome and add its latency to the provider's histogram."""
+    latency_ms = seconds * 1000
+    bucket = next((str(bound) for bound in LATENCY_BUCKETS_MS if latency_ms <= bound), "inf")
+    with STATS["lock"]:
+        provider = STATS["providers"].setdefault(api_name, {
+            "success": 0, "failure": 0, "total": 0.0,
+            "latency_ms": OrderedDict((str(bound), 0) for bound in LATENCY_BUCKETS_MS + ("inf",))
+        })
+        provider["success" if success else "failure"] += 1
+        provider["total"] += seconds
+        provider["latency_ms"][bucket] += 1
+
+def fetch_provider(fetch_func, api_name, currencies):
+    """
+    Call a provider fetcher, recording its latency and whether it answered. A fetcher returns
+    None on an HTTP or parse error; an empty answer (no quote for the currencies) still counts
+    as a success, so asking for a currency a provider does not list never opens its circuit.
+    """
+    if not claim_provider(api_name):
+        log("Skipping %s: its half-open trial is still running", api_name, level="debug")
+        return None
+    start = time.perf_counter()
+    btc_rates = None
+    try:
+        btc_rates = fetch_func(currencies)
+        return btc_rates
+    finally:
+        seconds = time.perf_counter() - start
+        record_provider(api_name, seconds, btc_rates is not None)
+        record_provider_health(api_name, seconds, btc_rates is not None)
+
+def traced_call(name):
+    """
+    Decorator timing an RPC method as a whole and per stage. Calls slower than
+    nodebalance-slow-call-ms are logged as a warning with their stage breakdown.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            STATS_CALL.stages = {}
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stages = STATS_CALL.stages
+                STATS_CALL.stages = None
+                record_timing(name, elapsed)
+                threshold_ms = int(plugin.get_option("nodebalance-slow-call-ms") or 0)
+                if threshold_ms and elapsed * 1000 >= threshold_ms:
+                    params = ", ".join(f"{key}={value}" for key, value in kwargs.items() if key != "plugin")
+                    breakdown = ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in stages.items())
+                    log(f"Slow {name} call ({params}): {elapsed * 1000:.0f}ms [{breakdown}]", level="warn")
+        return wrapper
+    return decorator
+
+def get_http_session():
+    """Shared keep-alive session with a connection pool, created on first use."""
+    import requests
+    with HTTP_SESSION["lock"]:
+        if HTTP_SESSION["session"] is None:
+            pool_size = int(plugin.get_option("nodebalance-http-pool-size"))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            if not plugin.get_option("nodebalance-http-keepalive"):
+                session.headers["Connection"] = "close"
+            HTTP_SESSION["session"] = session
+        return HTTP_SESSION["session"]
+
+def http_get_json(url):
+    """
+    GET url through the shared session and decode the JSON body.
+    When the provider sent an ETag or Last-Modified header last time, the request is
+    made conditional and a 304 reply is answered from the previously decoded body.
+    """
+    conditional = plugin.get_option("nodebalance-http-conditional")
+    validator = HTTP_VALIDATORS.get(url) if conditional else None
+    headers = {}
+    if validator:
+        if validator["etag"]:
+            headers["If-None-Match"] = validator["etag"]
+        if validator["last_modified"]:
+            headers["If-Modified-Since"] = validator["last_modified"]
+    timeout = int(plugin.get_option("nodebalance-http-timeout"))
+    response = get_http_session().get(url, timeout=timeout, headers=headers)
+    if validator and response.status_code == 304:
+        log("Not modified, reusing previous response for %s", url, level="debug")
+        return validator["data"]
+    response.raise_for_status()
+    data = response.json()
+    if conditional:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if isinstance(etag, str) or isinstance(last_modified, str):
+            HTTP_VALIDATORS[url] = {
+                "etag": etag if isinstance(etag, str) else None,
+                "last_modified": last_modified if isinstance(last_modified, str) else None,
+                "data": data
+            }
+    return data
 
 def fetch_coingecko_rates(currencies):
     """Fetch rates from CoinGecko API."""
     try:
         currency_param = ",".join(currencies)
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies={currency_param}"
-        plugin.log(f"Fetching rates from CoinGecko for: {currency_param}")
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
+        url = f"{COINGECKO_API}/simple/price?ids=bitcoin&vs_currencies={currency_param}"
+        log(f"Fetching rates from CoinGecko for: {currency_param}")
+        data = http_get_json(url)
         btc_rates = data.get("bitcoin", {})
-        plugin.log(f"CoinGecko response: {json.dumps(btc_rates, indent=2)}")
+        log_payload("CoinGecko response", btc_rates)
         return btc_rates
     except Exception as e:
-        plugin.log(f"CoinGecko API failed: {str(e)}")
+        log(f"CoinGecko API failed: {str(e)}", level="warn")
+        note_provider_error("CoinGecko", e)
         return None
 
 def fetch_coinpaprika_rates(currencies):
     """Fetch rates from CoinPaprika API."""
     try:
-        url = "https://api.coinpaprika.com/v1/tickers/btc-bitcoin"
-        plugin.log(f"Fetching rates from CoinPaprika for: {','.join(currencies)}")
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
+        url = f"{COINPAPRIKA_API}/tickers/btc-bitcoin"
+        log(f"Fetching rates from CoinPaprika for: {','.join(currencies)}")
+        data = http_get_json(url)
         quotes = data.get("quotes", {})
         btc_rates = {c.lower(): quotes[c.upper()]["price"] for c in currencies if c.upper() in quotes}
-        plugin.log(f"CoinPaprika response: {json.dumps(btc_rates, indent=2)}")
+        log_payload("CoinPaprika response", btc_rates)
         return btc_rates
     except Exception as e:
-        plugin.log(f"CoinPaprika API failed: {str(e)}")
+        log(f"CoinPaprika API failed: {str(e)}", level="warn")
+        note_provider_error("CoinPaprika", e)
         return None
 
 def fetch_coincap_rates(currencies):
     """Fetch rates from CoinCap API."""
     try:
-        btc_url = "https://api.coincap.io/v2/rates/bitcoin"
-        rates_url = "https://api.coincap.io/v2/rates"
-        plugin.log(f"Fetching rates from CoinCap for: {','.join(currencies)}")
-        btc_response = requests.get(btc_url, timeout=5)
-        btc_response.raise_for_status()
-        rates_response = requests.get(rates_url, timeout=5)
-        rates_response.raise_for_status()
-        btc_data = btc_response.json()["data"]
-        rates_data = {rate["id"].lower(): float(rate["rateUsd"]) for rate in rates_response.json()["data"]}
+        btc_url = f"{COINCAP_API}/rates/bitcoin"
+        rates_url = f"{COINCAP_API}/rates"
+        log(f"Fetching rates from CoinCap for: {','.join(currencies)}")
+        btc_data = http_get_json(btc_url)["data"]
+        rates_data = {rate["id"].lower(): float(rate["rateUsd"]) for rate in http_get_json(rates_url)["data"]}
         btc_usd = float(btc_data["rateUsd"])
         btc_rates = {c: btc_usd / rates_data[c] for c in currencies if c in rates_data}
-        plugin.log(f"CoinCap response: {json.dumps(btc_rates, indent=2)}")
+        log_payload("CoinCap response", btc_rates)
         return btc_rates
     except Exception as e:
-        plugin.log(f"CoinCap API failed: {str(e)}")
+        log(f"CoinCap API failed: {str(e)}", level="warn")
+        note_provider_error("CoinCap", e)
+        return None
+
+def register_provider(name, fetch):
+    """Add a rate provider; fetch(currencies) returns {currency: fiat per BTC} or None on failure."""
+    RATE_PROVIDERS[name] = fetch
+
+# Looked up at call time so the fetchers can be replaced (e.g. patched in tests)
+register_provider("CoinGecko", lambda currencies: fetch_coingecko_rates(currencies))
+register_provider("CoinPaprika", lambda currencies: fetch_coinpaprika_rates(currencies))
+register_provider("CoinCap", lambda currencies: fetch_coincap_rates(currencies))
+
+def provider_health(name):
+    """Health record of provider name; callers hold PROVIDER_LOCK."""
+    if name not in PROVIDER_HEALTH:
+        PROVIDER_HEALTH[name] = {
+            "latency_ms": PRIOR_LATENCY_MS,
+            "outcomes": deque(maxlen=HEALTH_WINDOW),
+            "consecutive_failures": 0,
+            "circuit": "closed",
+            "open_until": 0,
+            "cooldown": CIRCUIT_COOLDOWN,
+            "probing": False,
+            "retry_after_until": 0
+        }
+    return PROVIDER_HEALTH[name]
+
+def reset_provider_health():
+    """Forget every provider's health, restoring registry order."""
+    with PROVIDER_LOCK:
+        PROVIDER_HEALTH.clear()
+
+def success_rate(health):
+    """Rolling success rate, counting one prior success so untried providers start at 1."""
+    return (sum(health["outcomes"]) + 1) / (len(health["outcomes"]) + 1)
+
+def record_provider_health(name, seconds, success):
+    """Update latency EWMA, outcomes and circuit state of provider name after a fetch."""
+    with PROVIDER_LOCK:
+        health = provider_health(name)
+        health["probing"] = False
+        health["latency_ms"] += LATENCY_ALPHA * (seconds * 1000 - health["latency_ms"])
+        health["outcomes"].append(1 if success else 0)
+        if success:
+            if health["circuit"] != "closed":
+                log(f"{name} recovered, closing its circuit")
+            health["consecutive_failures"] = 0
+            health["circuit"] = "closed"
+            health["cooldown"] = CIRCUIT_COOLDOWN
+            return
+        health["consecutive_failures"] += 1
+        if health["circuit"] == "half-open" or health["consecutive_failures"] >= CIRCUIT_FAILURES:
+            if health["circuit"] == "half-open":
+                health["cooldown"] = min(health["cooldown"] * 2, CIRCUIT_MAX_COOLDOWN)
+            health["circuit"] = "open"
+            health["open_until"] = time.time() + health["cooldown"]
+            log(f"{name} failed {health['consecutive_failures']} times in a row, skipping it for {health['cooldown']}s", level="warn")
+
+def claim_provider(name):
+    """
+    Whether a fetch from provider name may go ahead: a half-open circuit lets a single trial
+    through, and other fetches fail fast until that trial has closed or reopened it.
+    """
+    with PROVIDER_LOCK:
+        health = provider_health(name)
+        if health["circuit"] != "half-open":
+            return True
+        if health["probing"]:
+            return False
+        health["probing"] = True
+        return True
+
+def retry_after_seconds(response):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), None if absent or unparsable."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not isinstance(value, str):
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0, int(parsedate_to_datetime(value).timestamp() - time.time()))
+    except (TypeError, ValueError):
         return None
 
+def note_provider_error(name, error):
+    """Back off from provider name for its Retry-After (or RATE_LIMIT_BACKOFF) when it answered HTTP 429."""
+    response = getattr(error, "response", None)
+    if response is None or response.status_code != 429:
+        return
+    delay = retry_after_seconds(response)
+    delay = RATE_LIMIT_BACKOFF if delay is None else min(delay, MAX_RETRY_AFTER)
+    with PROVIDER_LOCK:
+        provider_health(name)["retry_after_until"] = time.time() + delay
+    log(f"{name} rate limited us, skipping it for {delay}s", level="warn")
+
+def ordered_providers():
+    """
+    (fetch, name) of the providers to try, best first by expected cost (EWMA latency divided
+    by success rate). Providers in a 429 backoff or with an open circuit are skipped; an open
+    circuit past its cooldown lets one half-open trial through (see claim_provider), and is
+    skipped while that trial runs.
+    """
+    now = time.time()
+    candidates = []
+    with PROVIDER_LOCK:
+        for index, (name, fetch) in enumerate(RATE_PROVIDERS.items()):
+            health = provider_health(name)
+            if health["retry_after_until"] > now:
+                log("Skipping %s: rate limited for %ds", name, health["retry_after_until"] - now, level="debug")
+                continue
+            if health["circuit"] == "open":
+                if health["open_until"] > now:
+                    log("Skipping %s: circuit open for %ds", name, health["open_until"] - now, level="debug")
+                    continue
+                health["circuit"] = "half-open"
+            elif health["circuit"] == "half-open" and health["probing"]:
+                log("Skipping %s: its half-open trial is still running", name, level="debug")
+                continue
+            candidates.append((health["latency_ms"] / success_rate(health), index, fetch, name))
+    candidates.sort()
+    return [(fetch, name) for _, _, fetch, name in candidates]
+
+def refresher_running():
+    """Check whether the background rate refresher thread is alive."""
+    thread = REFRESHER["thread"]
+    return thread is not None and thread.is_alive()
+
+def rate_expiry(currency):
+    """Time at which the cached rate of currency expires (0 if it was never fetched)."""
+    timestamp = RATES_CACHE["timestamps"].get(currency, 0)
+    if not timestamp:
+        return 0
+    return timestamp + RATES_CACHE["ttls"].get(currency, CACHE_TIMEOUT)
+
+def rates_timestamp(currencies):
+    """Fetch time of the oldest cached rate among currencies (0 if any was never fetched)."""
+    return min((RATES_CACHE["timestamps"].get(currency, 0) for currency in currencies), default=0)
+
 def get_currency_rates(currencies):
     """
-    Fetch real-time BTC to specified currency rates from multiple APIs.
-    Caches rates to minimize API calls, refreshes if currencies are missing or rates are invalid.
+    Return BTC to specified currency rates, refreshing from the APIs only when needed.
+    Every currency has its own timestamp and TTL. Only missing or expired currencies are
+    fetched, merged into one provider request. Expired but bounded (MAX_STALE_AGE) rates are
+    served immediately while the background refresher renews them, so callers only block
+    on HTTP for currencies that are missing or when the refresher is not running.
     """
     current_time = time.time()
     cached_rates = RATES_CACHE["rates"]
-    plugin.log(f"Checking cache: timestamp={RATES_CACHE['timestamp']}, rates={cached_rates}")
+    for currency in currencies:
+        REFRESHER["currencies"][currency] = current_time
+    log("Checking cache: timestamp=%s, rates=%s", RATES_CACHE["timestamp"], cached_rates, level="debug")
 
-    # Check if cache is fresh and all requested currencies have valid rates
-    valid_rates = True
+    missing = []
+    stale = []
     for currency in currencies:
+        timestamp = RATES_CACHE["timestamps"].get(currency, 0)
+        usable = cached_rates.get(currency, 0) > 0 and RATES_CACHE["sources"].get(currency) != "fallback"
+        # A zero or fallback rate is only kept while its retry after a failed fetch is pending
+        if rate_expiry(currency) > current_time and (usable or currency in RATES_CACHE["retrying"]):
+            continue
         if currency not in cached_rates or cached_rates[currency] <= 0:
-            plugin.log(f"Cache miss or invalid: {currency} rate is {cached_rates.get(currency, 'missing')}")
-            valid_rates = False
+            log("Cache miss or invalid: %s rate is %s", currency, cached_rates.get(currency, "missing"), level="debug")
+            missing.append(currency)
+            continue
+        btc_value = cached_rates["btc"] / cached_rates[currency]
+        if btc_value < 1e3 or btc_value > 1e10:  # Unrealistic: 1 BTC < 1K or > 10B fiat
+            log("Cache invalid: %s rate gives %.2f fiat/BTC", currency, btc_value, level="debug")
+            missing.append(currency)
+        elif not timestamp or RATES_CACHE["sources"].get(currency) == "fallback":
+            missing.append(currency)
         else:
-            btc_value = cached_rates["btc"] / cached_rates[currency]
-            if btc_value < 1e3 or btc_value > 1e10:  # Unrealistic: 1 BTC < 1K or > 10B fiat
-                plugin.log(f"Cache invalid: {currency} rate gives {btc_value:,.2f} fiat/BTC")
-                valid_rates = False
+            stale.append(currency)
 
-    if RATES_CACHE["timestamp"] + CACHE_TIMEOUT > current_time and valid_rates:
-        plugin.log(f"Using cached currency rates: {cached_rates.keys()}")
+    if not missing and not stale:
+        log("Using cached currency rates for %s", currencies, level="debug")
+        count("rates_cache_hit")
         return cached_rates
 
-    plugin.log("Cache invalid or expired, fetching new rates")
-    rates = cached_rates.copy()
+    max_stale = int(plugin.get_option("nodebalance-max-stale"))
+    if not missing and refresher_running() and rates_timestamp(stale) + max_stale >= current_time:
+        log("Serving stale rates for %s while refreshing in background", stale, level="debug")
+        count("rates_cache_stale")
+        REFRESHER["wake"].set()
+        return cached_rates
 
-    # Try APIs in order: CoinGecko, CoinPaprika, CoinCap
-    api_attempts = [
-        (fetch_coingecko_rates, "CoinGecko"),
-        (fetch_coinpaprika_rates, "CoinPaprika"),
-        (fetch_coincap_rates, "CoinCap")
-    ]
-    for fetch_func, api_name in api_attempts:
-        btc_rates = fetch_func(currencies)
-        if btc_rates:
-            for currency in currencies:
-                if currency in btc_rates and btc_rates[currency] > 0:
-                    rates[currency] = rates["btc"] / btc_rates[currency]  # msat per currency
-                    btc_value = btc_rates[currency]  # fiat per BTC
-                    plugin.log(f"Rate for {currency} from {api_name}: {rates[currency]:,.2f} msat ({btc_value:,.2f} {currency.upper()}/BTC)")
-                else:
-                    plugin.log(f"No valid rate for {currency} from {api_name}")
-            if all(currency in btc_rates and btc_rates[currency] > 0 for currency in currencies):
-                break  # All currencies fetched successfully
+    count("rates_cache_miss")
+    with timed("rates_fetch"):
+        return refresh_coalesced(missing + stale)
+
+def refresh_coalesced(currencies, due=None):
+    """
+    Refresh currencies, sharing in-flight refreshes: currencies another caller is already
+    fetching are waited for instead of fetched again, so a burst of concurrent cache misses
+    makes one upstream request per currency. due(currency) is the time a currency needs
+    renewing (default: rate_expiry); ones a finished refresh has pushed past now are skipped.
+    """
+    due = due or rate_expiry
+    with RATE_FLIGHTS_LOCK:
+        joined = {RATE_FLIGHTS[currency] for currency in currencies if currency in RATE_FLIGHTS}
+        # Skip currencies a refresh that finished meanwhile has already renewed
+        now = time.time()
+        own = [currency for currency in currencies if currency not in RATE_FLIGHTS and due(currency) <= now]
+        flight = threading.Event()
+        for currency in own:
+            RATE_FLIGHTS[currency] = flight
+    if joined:
+        count("rates_coalesced")
+        log("Joining in-flight rate refresh for %s", [c for c in currencies if c in RATE_FLIGHTS], level="debug")
+    try:
+        if own:
+            refresh_rates(refresh_set(own), required=own)
+    finally:
+        with RATE_FLIGHTS_LOCK:
+            for currency in own:
+                RATE_FLIGHTS.pop(currency, None)
+        flight.set()
+    for other in joined:
+        other.wait()
+    return RATES_CACHE["rates"]
+
+def refresh_set(currencies):
+    """Currencies to fetch along with currencies: the whole fiat table when nodebalance-prefetch-all is set."""
+    if plugin.get_option("nodebalance-prefetch-all"):
+        return VALID_CURRENCIES + [currency for currency in currencies if currency not in VALID_CURRENCY_SET]
+    return currencies
+
+def refresh_rates(currencies, required=None):
+    """
+    Fetch real-time BTC to specified currency rates from multiple APIs and update the cache.
+    The next API is only tried while some of the required currencies (default: all) are
+    missing. Falls back to default rates for required currencies no API could provide; those
+    are retried after RETRY_TIMEOUT rather than on every call. Other currencies (fetched
+    along, e.g. by nodebalance-prefetch-all) that got no answer are left as they were.
+    """
+    if required is None:
+        required = currencies
+    if not currencies:
+        return RATES_CACHE["rates"]
+    with RATES_LOCK:
+        current_time = time.time()
+        log("Cache invalid or expired, fetching new rates")
+        rates = RATES_CACHE["rates"].copy()
+        sources = {}
+
+        # Try healthy APIs first; CoinGecko, CoinPaprika, CoinCap while none has degraded
+        api_attempts = ordered_providers()
+        if not api_attempts:
+            log("Every rate API is backing off, using cached or fallback rates", level="warn")
+        fetch_mode = plugin.get_option("nodebalance-fetch-mode")
+        if fetch_mode in ("hedged", "median"):
+            for btc_rates, api_name in fetch_rates_concurrent(currencies, api_attempts, fetch_mode, required):
+                apply_btc_rates(rates, btc_rates, currencies, api_name, sources)
         else:
-            plugin.log(f"{api_name} returned no valid rates")
+            if fetch_mode not in FETCH_MODES:
+                log(f"Unknown fetch mode {fetch_mode}, fetching sequentially", level="warn")
+            for fetch_func, api_name in api_attempts:
+                btc_rates = fetch_provider(fetch_func, api_name, currencies)
+                if btc_rates:
+                    apply_btc_rates(rates, btc_rates, currencies, api_name, sources)
+                    if all(btc_rates.get(currency, 0) > 0 for currency in required):
+                        break  # All currencies fetched successfully
+                else:
+                    log(f"{api_name} returned no valid rates")
 
-    # Fallback to defaults for missing or invalid rates
-    for currency in currencies:
-        if currency not in rates or rates[currency] <= 0:
-            if currency in CONVERSION_RATES:
-                rates[currency] = CONVERSION_RATES[currency]
-                btc_value = rates["btc"] / rates[currency]
-                plugin.log(f"Using fallback for {currency}: {rates[currency]:,.2f} msat ({btc_value:,.2f} {currency.upper()}/BTC)")
+        # Fallback to defaults for missing or invalid rates
+        for currency in required:
+            if currency not in rates or rates[currency] <= 0:
+                if currency in CONVERSION_RATES:
+                    rates[currency] = CONVERSION_RATES[currency]
+                    btc_value = rates["btc"] / rates[currency]
+                    log(f"Using fallback for {currency}: {rates[currency]:,.2f} msat ({btc_value:,.2f} {currency.upper()}/BTC)")
+                else:
+                    log(f"No fallback available for {currency}")
+                    rates[currency] = 0
+
+        # Update cache
+        RATES_CACHE["rates"] = rates
+        RATES_CACHE["timestamp"] = current_time
+        for currency in currencies:
+            timestamp = RATES_CACHE["timestamps"].get(currency, 0)
+            if currency in sources:
+                RATES_CACHE["timestamps"][currency] = current_time
+                RATES_CACHE["ttls"][currency] = CACHE_TIMEOUT
+                RATES_CACHE["sources"][currency] = sources[currency]
+                RATES_CACHE["retrying"].discard(currency)
+            elif currency not in required:
+                continue  # Only fetched along; an unanswered one is fetched when it is itself requested
+            elif timestamp and RATES_CACHE["sources"].get(currency) != "fallback":
+                # Keep the last good rate and its age, but don't retry before RETRY_TIMEOUT
+                RATES_CACHE["ttls"][currency] = current_time - timestamp + RETRY_TIMEOUT
+                RATES_CACHE["retrying"].add(currency)
             else:
-                plugin.log(f"No fallback available for {currency}")
-                rates[currency] = 0
+                RATES_CACHE["timestamps"][currency] = current_time
+                RATES_CACHE["ttls"][currency] = RETRY_TIMEOUT
+                RATES_CACHE["sources"][currency] = "fallback"
+                RATES_CACHE["retrying"].add(currency)
+        log(f"Updated rates for {len(currencies)} currencies ({len(sources)} quoted)")
+        log_payload("Updated currency rates", rates)
+        save_rates_cache()
+        NOTIFIER["wake"].set()
+        return rates
+
+def apply_btc_rates(rates, btc_rates, currencies, api_name, sources):
+    """Merge provider fiat-per-BTC quotes into msat-per-unit rates, recording the provider in sources."""
+    for currency in currencies:
+        if currency in btc_rates and btc_rates[currency] > 0:
+            rates[currency] = rates["btc"] / btc_rates[currency]  # msat per currency
+            sources[currency] = api_name
+            btc_value = btc_rates[currency]  # fiat per BTC
+            log("Rate for %s from %s: %.2f msat (%.2f %s/BTC)", currency, api_name, rates[currency], btc_value, currency.upper(), level="debug")
+        else:
+            log("No valid rate for %s from %s", currency, api_name, level="debug")
+
+def get_fetch_executor():
+    """Shared thread pool for concurrent provider fetches, created on first use."""
+    from concurrent.futures import ThreadPoolExecutor
+    with FETCH_EXECUTOR["lock"]:
+        if FETCH_EXECUTOR["executor"] is None:
+            # Room for a full round plus stragglers still hanging from the previous one
+            FETCH_EXECUTOR["executor"] = ThreadPoolExecutor(max_workers=6, thread_name_prefix="nodebalance-fetch")
+        return FETCH_EXECUTOR["executor"]
+
+def fetch_rates_concurrent(currencies, api_attempts, fetch_mode, required):
+    """
+    Query rate providers concurrently under a single FETCH_DEADLINE.
+    Providers are started HEDGE_DELAY seconds apart, or immediately once a running one fails.
+    In hedged mode the first answer covering all required currencies wins; otherwise partial answers are returned
+    in completion order. In median mode every answer received before the deadline is
+    combined into a per-currency median.
+    Returns a list of (btc_rates, api_name) to merge in order.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    executor = get_fetch_executor()
+    queue = list(api_attempts)
+    pending = {}
+    results = []
+    start = time.monotonic()
+    deadline = start + FETCH_DEADLINE
+    next_start = start
+    while queue or pending:
+        now = time.monotonic()
+        if now >= deadline:
+            log(f"Fetch deadline reached, abandoning: {', '.join(pending.values())}", level="warn")
+            break
+        if queue and now >= next_start:
+            fetch_func, api_name = queue.pop(0)
+            pending[executor.submit(fetch_provider, fetch_func, api_name, currencies)] = api_name
+            next_start = now + HEDGE_DELAY
+            continue
+        timeout = min(deadline, next_start) - now if queue else deadline - now
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            api_name = pending.pop(future)
+            try:
+                btc_rates = future.result()
+            except Exception as e:
+                log(f"{api_name} API failed: {str(e)}", level="warn")
+                btc_rates = None
+            if not btc_rates:
+                log(f"{api_name} returned no valid rates")
+                next_start = time.monotonic()  # Start the next provider right away
+                continue
+            results.append((btc_rates, api_name))
+            complete = all(btc_rates.get(currency, 0) > 0 for currency in required)
+            if fetch_mode == "hedged" and complete:
+                log(f"Using first complete answer from {api_name} after {time.monotonic() - start:.2f}s")
+                return [(btc_rates, api_name)]
+
+    if fetch_mode == "median" and results:
+        median_rates = {}
+        for currency in currencies:
+            quotes = [btc_rates[currency] for btc_rates, _ in results if btc_rates.get(currency, 0) > 0]
+            if quotes:
+                median_rates[currency] = statistics.median(quotes)
+        sources = ",".join(api_name for _, api_name in results)
+        return [(median_rates, f"median({sources})")]
+    return results
+
+def save_rates_cache():
+    """Atomically write every fetched rate with its timestamp and provider to the rate store."""
+    path = RATE_STORE["path"]
+    if not path:
+        return
+    entries = {
+        currency: [RATES_CACHE["rates"][currency], timestamp, RATES_CACHE["sources"].get(currency)]
+        for currency, timestamp in RATES_CACHE["timestamps"].items()
+        if RATES_CACHE["rates"].get(currency, 0) > 0 and RATES_CACHE["sources"].get(currency) != "fallback"
+    }
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 1, "rates": entries}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log(f"Failed to save rate cache to {path}: {str(e)}", level="warn")
+
+def valid_cache_entry(entry):
+    """Whether a stored rate has save_rates_cache's [rate, timestamp, source] shape with finite numbers."""
+    if not isinstance(entry, list) or len(entry) != 3:
+        return False
+    rate, timestamp, source = entry
+    return all(
+        isinstance(value, (int, float)) and not isinstance(value, bool) and float("-inf") < value < float("inf")
+        for value in (rate, timestamp)
+    ) and (source is None or isinstance(source, str))
+
+def load_rates_cache(path):
+    """
+    Load rates saved by save_rates_cache into RATES_CACHE, keeping newer in-memory rates.
+    Malformed entries are skipped with a warning, so a damaged file never stops startup.
+    """
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        log(f"Ignoring unreadable rate cache {path}: {str(e)}", level="warn")
+        return 0
+    if not isinstance(stored, dict) or stored.get("version") != 1:
+        version = stored.get("version") if isinstance(stored, dict) else None
+        log(f"Ignoring rate cache {path} with unknown version {version}", level="warn")
+        return 0
+    entries = stored.get("rates", {})
+    if not isinstance(entries, dict):
+        log(f"Ignoring rate cache {path}: rates is not an object", level="warn")
+        return 0
+
+    with RATES_LOCK:
+        rates = RATES_CACHE["rates"].copy()
+        loaded = 0
+        for currency, entry in entries.items():
+            if not valid_cache_entry(entry):
+                log(f"Skipping malformed cached rate for {currency} in {path}: {entry!r}", level="warn")
+                continue
+            rate, timestamp, source = entry
+            if rate > 0 and timestamp > RATES_CACHE["timestamps"].get(currency, 0):
+                rates[currency] = rate
+                RATES_CACHE["timestamps"][currency] = timestamp
+                RATES_CACHE["ttls"][currency] = CACHE_TIMEOUT
+                RATES_CACHE["sources"][currency] = source
+                RATES_CACHE["retrying"].discard(currency)
+                loaded += 1
+        if loaded:
+            RATES_CACHE["rates"] = rates
+            # The cache is only as fresh as its oldest rate
+            RATES_CACHE["timestamp"] = min(RATES_CACHE["timestamps"].values())
+    log(f"Loaded {loaded} cached rates from {path}")
+    return loaded
+
+def tracked_currencies(now):
+    """Currencies requested within REQUEST_WINDOW; older ones are forgotten."""
+    tracked = REFRESHER["currencies"]
+    for currency, requested in list(tracked.items()):
+        if requested + REQUEST_WINDOW < now:
+            log(f"No requests for {currency} in {REQUEST_WINDOW}s, no longer refreshing it")
+            tracked.pop(currency, None)
+    return sorted(tracked)
+
+def refresh_due(currency):
+    """
+    Time the background refresher renews currency: REFRESH_AHEAD before a quoted rate expires,
+    but a currency being retried after a failed fetch only at its expiry, so failures wait out
+    RETRY_TIMEOUT instead of being retried at once.
+    """
+    if currency in RATES_CACHE["retrying"]:
+        return rate_expiry(currency)
+    return rate_expiry(currency) - REFRESH_AHEAD
+
+def next_refresh_delay(now):
+    """Seconds until the first tracked currency is due for a refresh, None if nothing is tracked."""
+    tracked = tracked_currencies(now)
+    if not tracked:
+        return None
+    return max(0, min(refresh_due(currency) for currency in tracked) - now)
+
+def due_currencies(now):
+    """Tracked currencies due for a refresh (see refresh_due)."""
+    return [currency for currency in tracked_currencies(now) if refresh_due(currency) <= now]
+
+def refresh_round(now):
+    """
+    Renew the currencies due at now. Currencies a nodebalance call or the startup prefetch is
+    already fetching are joined rather than fetched a second time.
+    """
+    refresh_coalesced(due_currencies(now), due=refresh_due)
+
+def rate_refresh_loop():
+    """Keep RATES_CACHE warm by refreshing tracked currencies ahead of expiry, one request per round."""
+    while True:
+        delay = next_refresh_delay(time.time())
+        if delay is None or delay > 0:
+            REFRESHER["wake"].wait(delay)
+            REFRESHER["wake"].clear()
+            continue
+        try:
+            refresh_round(time.time())
+        except Exception as e:
+            log(f"Background rate refresh failed: {str(e)}", level="warn")
+            REFRESHER["wake"].wait(REFRESH_AHEAD)  # Don't spin on a persistent failure
+
+def start_rate_refresher():
+    """Start the background rate refresher thread if it is not already running."""
+    if refresher_running():
+        return
+    thread = threading.Thread(target=rate_refresh_loop, name="nodebalance-refresher", daemon=True)
+    REFRESHER["thread"] = thread
+    thread.start()
+    log("Started background rate refresher")
+
+def prefetch_rates(currencies):
+    """
+    Fetch currencies in a background thread so the first nodebalance call finds them cached.
+    The fetch goes through refresh_coalesced, so a refresher round or a nodebalance call
+    renewing the same currencies at startup shares it instead of fetching them again.
+    """
+    def prefetch():
+        try:
+            now = time.time()
+            for currency in currencies:
+                REFRESHER["currencies"][currency] = now
+            refresh_coalesced(currencies)
+        except Exception as e:
+            log(f"Rate prefetch failed: {str(e)}", level="warn")
+    thread = threading.Thread(target=prefetch, name="nodebalance-prefetch", daemon=True)
+    thread.start()
+    return thread
 
-    # Update cache
-    RATES_CACHE["rates"] = rates
-    RATES_CACHE["timestamp"] = current_time
-    plugin.log(f"Updated currency rates: {rates}")
-    return rates
+def rates_freshness(currencies):
+    """
+    Age in seconds and freshness of the oldest fetched rate among currencies (age is None if
+    any was never fetched or only has a fallback rate, which was not fetched at all).
+    """
+    sources = RATES_CACHE["sources"]
+    timestamp = min((0 if sources.get(currency) == "fallback" else RATES_CACHE["timestamps"].get(currency, 0)
+                     for currency in currencies), default=0)
+    if not timestamp:
+        return {"age": None, "fresh": False}
+    age = max(0, int(time.time() - timestamp))
+    return {"age": age, "fresh": age < CACHE_TIMEOUT}
 
 def format_currency(amount_msat, currency, rates):
     """Convert msat to specified currency and format with commas for fiat."""
@@ -175,13 +934,55 @@ def format_balance(amount_msat, rates, fiat_currencies):
         if currency in rates and rates[currency] > 0:
             btc_value = rates["btc"] / rates[currency]
             if btc_value < 1e3 or btc_value > 1e10:  # Skip unrealistic rates
-                plugin.log(f"Skipping {currency} balance: {btc_value:,.2f} fiat/BTC is invalid")
+                log("Skipping %s balance: %.2f fiat/BTC is invalid", currency, btc_value, level="debug")
                 continue
             balance[currency] = format_currency(amount_msat, currency, rates)
         else:
-            plugin.log(f"Skipping {currency}: no valid rate available")
+            log("Skipping %s: no valid rate available", currency, level="debug")
     return balance
 
+def build_format_table(rates, fiat_currencies):
+    """
+    Check rates once per request and precompute (key, msat per unit, format spec, suffix)
+    entries for format_balance_fast, in the same order and with the same skips as format_balance.
+    """
+    table = [
+        ("btc", rates["btc"], ".8f", " btc"),
+        ("sats", rates["sats"], ",.0f", " sats"),
+        ("msats", rates["msats"], ",.0f", " msats")
+    ]
+    for currency in fiat_currencies:
+        if currency in rates and rates[currency] > 0:
+            btc_value = rates["btc"] / rates[currency]
+            if btc_value < 1e3 or btc_value > 1e10:  # Skip unrealistic rates
+                log("Skipping %s balance: %.2f fiat/BTC is invalid", currency, btc_value, level="debug")
+                continue
+            table.append((currency, rates[currency], ",.2f", f" {currency.upper()}"))
+        else:
+            log("Skipping %s: no valid rate available", currency, level="debug")
+    return table
+
+def format_balance_fast(amount_msat, table):
+    """Format a balance with a table from build_format_table; same output as format_balance."""
+    amount_msat = int(amount_msat)
+    return OrderedDict([(key, format(amount_msat / divisor, spec) + suffix) for key, divisor, spec, suffix in table])
+
+def format_columns(amounts, table):
+    """
+    Format a column of msat amounts in every currency of a build_format_table table, one pass
+    per currency with its format string built once; returns one list of strings per entry,
+    equal to format_balance_fast of each amount.
+    """
+    columns = []
+    for _, divisor, spec, suffix in table:
+        if divisor == 1 and spec == ",.0f":
+            # Whole msat amounts (below 2**53) format exactly like their float value
+            columns.append(list(map(("{:,}" + suffix).format, amounts)))
+        else:
+            columns.append(list(map(("{:" + spec + "}" + suffix).format, [amount / divisor for amount in amounts])))
+    return columns
+
+@timed("format")
 def format_rates(rates, fiat_currencies, timestamp):
     """Format BTC to fiat currency rates with timestamp and cache status."""
     btc_rates = {}
@@ -190,126 +991,1400 @@ def format_rates(rates, fiat_currencies, timestamp):
             btc_value = rates["btc"] / rates[currency]  # 1 BTC in fiat
             # Skip validation for CONVERSION_RATES to allow fallbacks
             if currency not in CONVERSION_RATES and (btc_value < 1e3 or btc_value > 1e10):  # Unrealistic rates
-                plugin.log(f"Skipping {currency} rate: {btc_value:,.2f} fiat/BTC is invalid")
+                log("Skipping %s rate: %.2f fiat/BTC is invalid", currency, btc_value, level="debug")
                 btc_rates[currency] = "Rate invalid"
             else:
                 btc_rates[currency] = f"{btc_value:,.2f} {currency.upper()}"
-                plugin.log(f"Formatted rate for {currency}: {btc_rates[currency]}")
+                log("Formatted rate for %s: %s", currency, btc_rates[currency], level="debug")
         else:
             btc_rates[currency] = "Rate unavailable"
+    freshness = rates_freshness(fiat_currencies)
     return {
         "rates": btc_rates,
         "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
-        "cached": timestamp + CACHE_TIMEOUT > time.time()
+        "cached": timestamp + CACHE_TIMEOUT > time.time(),
+        "age": freshness["age"],
+        "fresh": freshness["fresh"]
+    }
+
+def format_rates_raw(rates, fiat_currencies, timestamp):
+    """BTC to fiat rates as numbers (None when unavailable or invalid) with a unix timestamp and cache status."""
+    btc_rates = {}
+    for currency in fiat_currencies:
+        btc_rates[currency] = None
+        if currency in rates and rates[currency] > 0:
+            btc_value = rates["btc"] / rates[currency]
+            if currency in CONVERSION_RATES or 1e3 <= btc_value <= 1e10:
+                btc_rates[currency] = round(btc_value, 2)
+    freshness = rates_freshness(fiat_currencies)
+    return {
+        "rates": btc_rates,
+        "timestamp": int(timestamp),
+        "cached": timestamp + CACHE_TIMEOUT > time.time(),
+        "age": freshness["age"],
+        "fresh": freshness["fresh"]
+    }
+
+def raw_balance(amount_msat, table):
+    """A balance as integer msat plus fiat values for the fiat entries of a build_format_table table."""
+    return {
+        "msat": int(amount_msat),
+        "fiat": {key: round(amount_msat / divisor, 2) for key, divisor, _, _ in table[3:]}
+    }
+
+def output_value(output):
+    """msat an output contributes to the on-chain balance."""
+    if output["status"] == "confirmed" and not output["reserved"]:
+        return output["amount_msat"]
+    return 0
+
+def channel_value(channel):
+    """msat a channel contributes to the channel balance."""
+    if channel["state"] == "CHANNELD_NORMAL" and channel["connected"]:
+        return channel["our_amount_msat"]
+    return 0
+
+def channel_key(channel):
+    """Ledger key of a channel."""
+    return channel.get("channel_id") or channel.get("short_channel_id") or f"{channel.get('funding_txid')}:{channel.get('funding_output')}"
+
+def list_outputs(rpc, with_keys=False):
+    """Wallet outputs from listfunds, filtered down to the fields we read (plus txid/output for the ledger)."""
+    with timed("rpc_listfunds"):
+        funds = rpc.call("listfunds", {}, filter=LEDGER_OUTPUTS_FILTER if with_keys else OUTPUTS_FILTER)
+    log_payload("listfunds outputs", funds)
+    return funds.get("outputs", [])
+
+def list_channels(rpc):
+    """Channels from listpeerchannels, filtered down to the fields we read and renamed to listfunds' names."""
+    with timed("rpc_listpeerchannels"):
+        result = rpc.call("listpeerchannels", {}, filter=CHANNELS_FILTER)
+    log_payload("listpeerchannels output", result)
+    return [
+        {
+            "peer_id": channel["peer_id"],
+            "channel_id": channel.get("channel_id"),
+            "short_channel_id": channel.get("short_channel_id", "N/A"),
+            "state": channel["state"],
+            "connected": channel.get("peer_connected", False),
+            "our_amount_msat": channel.get("to_us_msat", 0),
+            "amount_msat": channel.get("total_msat", 0)
+        } for channel in result.get("channels", [])
+    ]
+
+def rebuild_ledger(outputs_list, channels_list, events=None):
+    """
+    Replace the ledger contents with fresh outputs and channels. With events (the notification
+    count taken before the RPC calls), nothing is replaced if a notification arrived since, as
+    it may be missing from the RPC answers; returns whether the ledger was replaced.
+    """
+    outputs = {}
+    for output in outputs_list:
+        outputs[f"{output['txid']}:{output['output']}"] = {
+            "amount_msat": int(output["amount_msat"]),
+            "status": output["status"],
+            "reserved": output["reserved"]
+        }
+    channels = {}
+    for channel in channels_list:
+        channels[channel_key(channel)] = {
+            "peer_id": channel["peer_id"],
+            "short_channel_id": channel.get("short_channel_id", "N/A"),
+            "state": channel["state"],
+            "connected": channel["connected"],
+            "our_amount_msat": int(channel["our_amount_msat"]),
+            "amount_msat": int(channel["amount_msat"])
+        }
+    with LEDGER_LOCK:
+        if events is not None and BALANCE_LEDGER["events"] != events:
+            return False
+        onchain_msat = sum(output_value(output) for output in outputs.values())
+        channel_msat = sum(channel_value(channel) for channel in channels.values())
+        if BALANCE_LEDGER["ready"] and (onchain_msat != BALANCE_LEDGER["onchain_msat"] or channel_msat != BALANCE_LEDGER["channel_msat"]):
+            log(f"Ledger drift corrected: onchain {BALANCE_LEDGER['onchain_msat']} -> {onchain_msat} msat, "
+                f"channels {BALANCE_LEDGER['channel_msat']} -> {channel_msat} msat", level="warn")
+        BALANCE_LEDGER["outputs"] = outputs
+        BALANCE_LEDGER["channels"] = channels
+        BALANCE_LEDGER["onchain_msat"] = onchain_msat
+        BALANCE_LEDGER["channel_msat"] = channel_msat
+        BALANCE_LEDGER["reconciled"] = time.time()
+        BALANCE_LEDGER["version"] += 1
+        BALANCE_LEDGER["dirty"] = False
+        BALANCE_LEDGER["ready"] = True
+    NOTIFIER["wake"].set()
+    return True
+
+def reconcile_ledger():
+    """
+    Rebuild the ledger from listfunds outputs and listpeerchannels. Notifications handled during
+    the RPC calls would be lost by installing their answers, so the calls are repeated while
+    notifications keep arriving, up to RECONCILE_ATTEMPTS rounds; the last answers are then
+    installed anyway. Returns False in that case, so the caller reconciles again soon.
+    """
+    for _ in range(RECONCILE_ATTEMPTS):
+        events = BALANCE_LEDGER["events"]
+        outputs = list_outputs(plugin.rpc, with_keys=True)
+        channels = list_channels(plugin.rpc)
+        if rebuild_ledger(outputs, channels, events):
+            log(f"Ledger reconciled: {len(BALANCE_LEDGER['outputs'])} outputs, {len(BALANCE_LEDGER['channels'])} channels")
+            return True
+        log("Notifications arrived during ledger reconcile, retrying", level="debug")
+    rebuild_ledger(outputs, channels)
+    log(f"Ledger reconciled while notifications kept arriving, reconciling again in {RECONCILE_RETRY}s", level="warn")
+    return False
+
+def ledger_event():
+    """Count a notification that may touch the ledger; called before it is applied."""
+    with LEDGER_LOCK:
+        BALANCE_LEDGER["events"] += 1
+
+def ledger_set_output(key, output):
+    """Add, replace or (output=None) remove a wallet output, adjusting the on-chain total."""
+    with LEDGER_LOCK:
+        old = BALANCE_LEDGER["outputs"].pop(key, None)
+        if old:
+            BALANCE_LEDGER["onchain_msat"] -= output_value(old)
+        if output:
+            BALANCE_LEDGER["outputs"][key] = output
+            BALANCE_LEDGER["onchain_msat"] += output_value(output)
+        BALANCE_LEDGER["version"] += 1
+        NOTIFIER["wake"].set()
+
+def ledger_update_channel(key, **fields):
+    """Update fields of a known channel, adjusting the channel total; False if the channel is unknown."""
+    with LEDGER_LOCK:
+        channel = BALANCE_LEDGER["channels"].get(key)
+        if channel is None:
+            return False
+        BALANCE_LEDGER["channel_msat"] -= channel_value(channel)
+        channel.update(fields)
+        BALANCE_LEDGER["channel_msat"] += channel_value(channel)
+        BALANCE_LEDGER["version"] += 1
+        NOTIFIER["wake"].set()
+        return True
+
+def mark_ledger_dirty(reason):
+    """Force a full reconcile before the ledger is used again."""
+    log(f"Ledger needs reconcile: {reason}")
+    BALANCE_LEDGER["dirty"] = True
+    LEDGER_RECONCILE["wake"].set()
+
+def ledger_snapshot():
+    """Balances from the ledger, reconciling first if an event could not be applied incrementally."""
+    if BALANCE_LEDGER["dirty"]:
+        reconcile_ledger()
+    with LEDGER_LOCK:
+        return {
+            "onchain_msat": BALANCE_LEDGER["onchain_msat"],
+            "channel_msat": BALANCE_LEDGER["channel_msat"],
+            "channels": list(BALANCE_LEDGER["channels"].values()),
+            "version": ("ledger", BALANCE_LEDGER["version"])
+        }
+
+def rpc_snapshot(rpc, need_outputs=True, need_channels=True, digest=False):
+    """
+    Balances computed from filtered RPC calls, skipping the data a mode does not need.
+    With digest, the version is a digest of everything a response is rendered from, standing
+    in for the ledger's version as the response cache key; otherwise it is None.
+    """
+    outputs = list_outputs(rpc) if need_outputs else []
+    channels = list_channels(rpc) if need_channels else []
+    with timed("aggregate"):
+        onchain_msat = sum(output_value(output) for output in outputs)
+        channel_msat = sum(channel_value(channel) for channel in channels)
+        version = None
+        if digest:
+            version = ("rpc", hash((onchain_msat, channel_msat, tuple(
+                (channel["peer_id"], channel["short_channel_id"], channel["state"], channel["connected"],
+                 int(channel["our_amount_msat"]), int(channel["amount_msat"])) for channel in channels))))
+        return {
+            "onchain_msat": onchain_msat,
+            "channel_msat": channel_msat,
+            "channels": channels,
+            "version": version
+        }
+
+def get_funds_snapshot(modes, digest=False):
+    """
+    On-chain and channel balances for modes, from the ledger when it is built, else from RPC
+    (with a digest version when digest is set, see rpc_snapshot).
+    """
+    if BALANCE_LEDGER["ready"]:
+        count("funds_ledger")
+        with timed("aggregate"):
+            return ledger_snapshot()
+    count("funds_rpc")
+    need_outputs = any(mode in ("total", "onchain") for mode in modes)
+    need_channels = any(mode != "onchain" for mode in modes)
+    funds = rpc_snapshot(plugin.rpc, need_outputs=need_outputs, need_channels=need_channels, digest=digest)
+    # Without the ledger, balance notifications are checked against the snapshots requests already take
+    if need_outputs:
+        NOTIFIER["funds"]["onchain_msat"] = funds["onchain_msat"]
+    if need_channels:
+        NOTIFIER["funds"]["channel_msat"] = funds["channel_msat"]
+    NOTIFIER["wake"].set()
+    return funds
+
+def ledger_reconcile_loop():
+    """Build the ledger, then reconcile it every nodebalance-reconcile-interval seconds or when marked dirty."""
+    interval = int(plugin.get_option("nodebalance-reconcile-interval"))
+    while True:
+        settled = True
+        try:
+            settled = reconcile_ledger()
+        except Exception as e:
+            log(f"Ledger reconcile failed: {str(e)}", level="warn")
+        LEDGER_RECONCILE["wake"].wait(interval if settled else min(interval, RECONCILE_RETRY))
+        LEDGER_RECONCILE["wake"].clear()
+
+def start_ledger():
+    """Start the thread that builds and reconciles the balance ledger."""
+    thread = threading.Thread(target=ledger_reconcile_loop, name="nodebalance-ledger", daemon=True)
+    LEDGER_RECONCILE["thread"] = thread
+    thread.start()
+
+def open_history_store():
+    """Open (creating if needed) the history database; callers hold HISTORY_STORE["lock"]."""
+    import sqlite3
+    if HISTORY_STORE["conn"] is None:
+        conn = sqlite3.connect(HISTORY_STORE["path"], check_same_thread=False)
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS balances (
+                resolution INTEGER NOT NULL, ts INTEGER NOT NULL, samples INTEGER NOT NULL,
+                onchain_msat INTEGER NOT NULL, channel_msat INTEGER NOT NULL,
+                PRIMARY KEY (resolution, ts)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS prices (
+                resolution INTEGER NOT NULL, currency TEXT NOT NULL, ts INTEGER NOT NULL,
+                samples INTEGER NOT NULL, price REAL NOT NULL,
+                PRIMARY KEY (resolution, ts, currency)
+            ) WITHOUT ROWID;
+        """)
+        HISTORY_STORE["conn"] = conn
+    return HISTORY_STORE["conn"]
+
+def close_history_store():
+    """Close the history database, if open."""
+    with HISTORY_STORE["lock"]:
+        if HISTORY_STORE["conn"] is not None:
+            HISTORY_STORE["conn"].close()
+            HISTORY_STORE["conn"] = None
+
+def record_history(now, onchain_msat, channel_msat, rates):
+    """
+    Write one sample of balances and msat-per-unit rates at every resolution.
+    Rates are stored as prices (fiat per BTC), so bucket averages are average prices rather
+    than the harmonic mean of the prices that averaging msat per unit would give.
+    Rollup buckets keep sums and a sample count, so averages stay exact as samples arrive;
+    buckets older than their resolution's retention are pruned.
+    """
+    now = int(now)
+    with HISTORY_STORE["lock"]:
+        conn = open_history_store()
+        with conn:
+            for resolution in HISTORY_RESOLUTIONS.values():
+                bucket = now - now % resolution if resolution else now
+                conn.execute(
+                    "INSERT INTO balances VALUES (?, ?, 1, ?, ?) ON CONFLICT (resolution, ts) DO UPDATE SET "
+                    "samples = samples + 1, onchain_msat = onchain_msat + excluded.onchain_msat, "
+                    "channel_msat = channel_msat + excluded.channel_msat",
+                    (resolution, bucket, onchain_msat, channel_msat))
+                conn.executemany(
+                    "INSERT INTO prices VALUES (?, ?, ?, 1, ?) ON CONFLICT (resolution, ts, currency) DO UPDATE SET "
+                    "samples = samples + 1, price = price + excluded.price",
+                    [(resolution, currency, bucket, CONVERSION_RATES["btc"] / rate) for currency, rate in rates.items()])
+                retention = HISTORY_RETENTION[resolution]
+                if retention is not None:
+                    conn.execute("DELETE FROM balances WHERE resolution = ? AND ts < ?", (resolution, now - retention))
+                    conn.execute("DELETE FROM prices WHERE resolution = ? AND ts < ?", (resolution, now - retention))
+
+def history_resolution(start, now):
+    """Finest resolution whose retention still covers start."""
+    for resolution in HISTORY_RESOLUTIONS.values():
+        retention = HISTORY_RETENTION[resolution]
+        if retention is None or start >= now - retention:
+            return resolution
+
+def query_history(start, end, resolution, currencies):
+    """Average balances and rates per bucket of resolution in [start, end], oldest first."""
+    with HISTORY_STORE["lock"]:
+        if HISTORY_STORE["conn"] is None and not (HISTORY_STORE["path"] and os.path.exists(HISTORY_STORE["path"])):
+            return []
+        conn = open_history_store()
+        balances = conn.execute(
+            "SELECT ts, onchain_msat / samples, channel_msat / samples FROM balances "
+            "WHERE resolution = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+            (resolution, start, end)).fetchall()
+        prices = conn.execute(
+            "SELECT ts, currency, price / samples FROM prices WHERE resolution = ? AND ts BETWEEN ? AND ?",
+            (resolution, start, end)).fetchall()
+    rates_by_ts = {}
+    for ts, currency, price in prices:
+        if currency in currencies:
+            rates_by_ts.setdefault(ts, {})[currency] = round(price, 2)
+    return [
+        {
+            "timestamp": ts,
+            "onchain_msat": onchain_msat,
+            "channel_msat": channel_msat,
+            "total_msat": onchain_msat + channel_msat,
+            "rates": rates_by_ts.get(ts, {})
+        } for ts, onchain_msat, channel_msat in balances
+    ]
+
+def sample_history():
+    """Record current balances and every fetched rate in the history store."""
+    funds = get_funds_snapshot(["total"])
+    with RATES_LOCK:
+        rates = {
+            currency: RATES_CACHE["rates"][currency]
+            for currency in RATES_CACHE["timestamps"]
+            if RATES_CACHE["rates"].get(currency, 0) > 0 and RATES_CACHE["sources"].get(currency) != "fallback"
+        }
+    record_history(time.time(), funds["onchain_msat"], funds["channel_msat"], rates)
+
+def history_sample_loop():
+    """Sample balances and rates every nodebalance-history-interval seconds."""
+    interval = int(plugin.get_option("nodebalance-history-interval"))
+    while True:
+        try:
+            sample_history()
+        except Exception as e:
+            log(f"History sample failed: {str(e)}", level="warn")
+        HISTORY_SAMPLER["wake"].wait(interval)
+        HISTORY_SAMPLER["wake"].clear()
+
+def start_history_sampler():
+    """Start the thread that samples balances and rates into the history store."""
+    thread = threading.Thread(target=history_sample_loop, name="nodebalance-history", daemon=True)
+    HISTORY_SAMPLER["thread"] = thread
+    thread.start()
+    log(f"Recording balance history to {HISTORY_STORE['path']}")
+
+def render_metrics(funds, now):
+    """Render balances, per-channel capacities and cached fiat rates in the Prometheus text format."""
+    lines = [
+        "# HELP nodebalance_onchain_msat Confirmed unreserved on-chain balance.",
+        "# TYPE nodebalance_onchain_msat gauge",
+        f"nodebalance_onchain_msat {funds['onchain_msat']}",
+        "# HELP nodebalance_channel_msat Our balance in connected CHANNELD_NORMAL channels.",
+        "# TYPE nodebalance_channel_msat gauge",
+        f"nodebalance_channel_msat {funds['channel_msat']}",
+        "# HELP nodebalance_total_msat On-chain plus channel balance.",
+        "# TYPE nodebalance_total_msat gauge",
+        f"nodebalance_total_msat {funds['onchain_msat'] + funds['channel_msat']}"
+    ]
+    peers, scids, outbound, inbound = channel_columns(funds["channels"])
+    for name, column, help_text in (("outbound", outbound, "Outbound capacity"), ("inbound", inbound, "Inbound capacity")):
+        lines.append(f"# HELP nodebalance_channel_{name}_msat {help_text} of a usable channel.")
+        lines.append(f"# TYPE nodebalance_channel_{name}_msat gauge")
+        lines.extend(
+            f'nodebalance_channel_{name}_msat{{peer_id="{peer_id}",short_channel_id="{scid}"}} {amount}'
+            for peer_id, scid, amount in zip(peers, scids, column)
+        )
+    with RATES_LOCK:
+        rates = sorted(
+            (currency, RATES_CACHE["rates"][currency], timestamp)
+            for currency, timestamp in RATES_CACHE["timestamps"].items()
+            if RATES_CACHE["rates"].get(currency, 0) > 0 and RATES_CACHE["sources"].get(currency) != "fallback"
+        )
+    lines.append("# HELP nodebalance_rate_fiat_per_btc Cached BTC price in fiat currency.")
+    lines.append("# TYPE nodebalance_rate_fiat_per_btc gauge")
+    lines.extend(f'nodebalance_rate_fiat_per_btc{{currency="{currency}"}} {CONVERSION_RATES["btc"] / rate:.2f}'
+                 for currency, rate, _ in rates)
+    lines.append("# HELP nodebalance_rate_age_seconds Seconds since the cached rate was fetched.")
+    lines.append("# TYPE nodebalance_rate_age_seconds gauge")
+    lines.extend(f'nodebalance_rate_age_seconds{{currency="{currency}"}} {max(0, int(now - timestamp))}'
+                 for currency, _, timestamp in rates)
+    lines.append("# HELP nodebalance_metrics_timestamp_seconds When this snapshot was taken.")
+    lines.append("# TYPE nodebalance_metrics_timestamp_seconds gauge")
+    lines.append(f"nodebalance_metrics_timestamp_seconds {int(now)}")
+    return ("\n".join(lines) + "\n").encode()
+
+def refresh_metrics():
+    """Replace the served metrics with a new snapshot."""
+    METRICS["body"] = render_metrics(get_funds_snapshot(["channel-details", "total"]), time.time())
+
+def metrics_refresh_loop():
+    """Refresh the metrics snapshot every nodebalance-metrics-interval seconds."""
+    interval = int(plugin.get_option("nodebalance-metrics-interval"))
+    while True:
+        try:
+            refresh_metrics()
+        except Exception as e:
+            log(f"Metrics refresh failed: {str(e)}", level="warn")
+        METRICS["wake"].wait(interval)
+        METRICS["wake"].clear()
+
+def start_metrics_server(port):
+    """Serve metrics on 127.0.0.1:port and start the thread keeping the snapshot fresh."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serve the pre-rendered metrics snapshot; scrapes never touch the node or the rate APIs."""
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = METRICS["body"]
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log("Metrics request: " + format, *args, level="debug")
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    METRICS["server"] = server
+    threading.Thread(target=server.serve_forever, name="nodebalance-metrics-http", daemon=True).start()
+    thread = threading.Thread(target=metrics_refresh_loop, name="nodebalance-metrics", daemon=True)
+    METRICS["thread"] = thread
+    thread.start()
+    log(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+def watched_values():
+    """
+    Current on-chain, channel and total msat plus the total's value in each nodebalance-currencies
+    fiat with a quoted rate, from the ledger (or the latest RPC snapshot) and RATES_CACHE, without
+    calling the node or the rate APIs. None until both balances are known.
+    """
+    if BALANCE_LEDGER["ready"]:
+        with LEDGER_LOCK:
+            funds = {"onchain_msat": BALANCE_LEDGER["onchain_msat"], "channel_msat": BALANCE_LEDGER["channel_msat"]}
+    else:
+        funds = dict(NOTIFIER["funds"])
+        if len(funds) < 2:
+            return None
+    values = dict(funds, total_msat=funds["onchain_msat"] + funds["channel_msat"])
+    with RATES_LOCK:
+        for currency in parse_currencies(plugin.get_option("nodebalance-currencies")):
+            rate = RATES_CACHE["rates"].get(currency, 0)
+            if rate > 0 and currency in RATES_CACHE["timestamps"] and RATES_CACHE["sources"].get(currency) != "fallback":
+                values[f"total_{currency}"] = round(values["total_msat"] / rate, 2)
+    return values
+
+def value_changes(baseline, values, min_msat, min_fiat, min_percent):
+    """
+    Values that moved from baseline by at least min_msat (msat values), min_fiat (fiat values)
+    or min_percent of the baseline; a threshold of 0 is disabled.
+    """
+    changes = OrderedDict()
+    for name, current in values.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        change = current - previous
+        percent = round(change * 100 / abs(previous), 2) if previous else None
+        min_amount = min_msat if name.endswith("_msat") else min_fiat
+        if (min_amount > 0 and abs(change) >= min_amount) or \
+                (min_percent > 0 and percent is not None and abs(percent) >= min_percent):
+            changes[name] = {"previous": previous, "current": current, "change": change, "percent": percent}
+    return changes
+
+def check_balance_changes(now):
+    """
+    Compare current values with the last notified ones and send a nodebalance_changed notification
+    (and call nodebalance-notify-hook) when one crosses a threshold. Changes within
+    nodebalance-notify-debounce seconds of the last notification are held back; returns the
+    seconds until they may be sent, else 0.
+    """
+    values = watched_values()
+    if values is None:
+        return 0
+    baseline = NOTIFIER["baseline"]
+    if baseline is None:
+        NOTIFIER["baseline"] = values
+        return 0
+    changes = value_changes(baseline, values, int(plugin.get_option("nodebalance-notify-msat")),
+                            float(plugin.get_option("nodebalance-notify-fiat")),
+                            float(plugin.get_option("nodebalance-notify-percent")))
+    # Start comparing new currencies from their first value
+    NOTIFIER["baseline"] = dict(values, **baseline)
+    if not changes:
+        return 0
+    wait = NOTIFIER["last_sent"] + int(plugin.get_option("nodebalance-notify-debounce")) - now
+    if wait > 0:
+        count("notifications_debounced")
+        return wait
+    payload = dict(values, changes=changes, timestamp=int(now))
+    plugin.notify(NOTIFY_TOPIC, payload)
+    count("notifications_sent")
+    hook = plugin.get_option("nodebalance-notify-hook")
+    if hook:
+        try:
+            plugin.rpc.call(hook, {NOTIFY_TOPIC: payload})
+        except Exception as e:
+            log(f"Notify hook {hook} failed: {str(e)}", level="warn")
+    log(f"Notified balance changes: {', '.join(changes)}")
+    NOTIFIER["baseline"] = values
+    NOTIFIER["last_sent"] = now
+    return 0
+
+def notify_loop():
+    """Check for notifiable changes whenever the ledger, an RPC snapshot or the rate table changes."""
+    while True:
+        NOTIFIER["wake"].wait()
+        NOTIFIER["wake"].clear()
+        try:
+            wait = check_balance_changes(time.time())
+        except Exception as e:
+            log(f"Balance change check failed: {str(e)}", level="warn")
+            wait = 0
+        if wait > 0:
+            # Bursts within the debounce window collapse into one notification with the latest values
+            time.sleep(wait)
+            NOTIFIER["wake"].set()
+
+def start_notifier():
+    """Start the thread sending balance change notifications."""
+    thread = threading.Thread(target=notify_loop, name="nodebalance-notify", daemon=True)
+    NOTIFIER["thread"] = thread
+    thread.start()
+    log("Sending nodebalance_changed notifications")
+
+@plugin.subscribe("coin_movement")
+def on_coin_movement(plugin, coin_movement, **kwargs):
+    """Apply wallet deposits/spends and channel credits/debits to the ledger."""
+    ledger_event()
+    if not BALANCE_LEDGER["ready"]:
+        return
+    account = coin_movement.get("account_id")
+    credit = int(coin_movement.get("credit_msat", 0))
+    debit = int(coin_movement.get("debit_msat", 0))
+    if coin_movement.get("type") == "channel_mvt":
+        with LEDGER_LOCK:
+            channel = BALANCE_LEDGER["channels"].get(account)
+            if channel is None:
+                mark_ledger_dirty(f"coin movement on unknown channel {account}")
+                return
+            ledger_update_channel(account, our_amount_msat=channel["our_amount_msat"] + credit - debit)
+    elif coin_movement.get("type") == "chain_mvt" and account == "wallet":
+        if "utxo" in coin_movement:
+            key = coin_movement["utxo"]
+            spending_txid = coin_movement.get("spending_txid")
+        else:
+            # Older format (CLN 24.11 and earlier): the spending transaction is carried in txid
+            key = f"{coin_movement.get('utxo_txid')}:{coin_movement.get('vout')}"
+            spending_txid = coin_movement.get("spending_txid") or coin_movement.get("txid")
+        if spending_txid:
+            ledger_set_output(key, None)
+        elif credit:
+            amount = int(coin_movement.get("output_msat", credit))
+            ledger_set_output(key, {"amount_msat": amount, "status": "confirmed", "reserved": False})
+
+@plugin.subscribe("balance_snapshot")
+def on_balance_snapshot(plugin, balance_snapshot, **kwargs):
+    """Take channel balances from the snapshot; reconcile if the wallet balance disagrees."""
+    ledger_event()
+    if not BALANCE_LEDGER["ready"]:
+        return
+    for account in balance_snapshot.get("accounts", []):
+        account_id = account.get("account_id")
+        balance_msat = int(account.get("balance_msat", 0))
+        if account_id == "wallet":
+            with LEDGER_LOCK:
+                wallet_msat = sum(output["amount_msat"] for output in BALANCE_LEDGER["outputs"].values() if output["status"] == "confirmed")
+            if balance_msat != wallet_msat:
+                mark_ledger_dirty(f"wallet snapshot {balance_msat} msat != ledger {wallet_msat} msat")
+        elif account_id in BALANCE_LEDGER["channels"]:
+            ledger_update_channel(account_id, our_amount_msat=balance_msat)
+
+@plugin.subscribe("channel_state_changed")
+def on_channel_state_changed(plugin, channel_state_changed, **kwargs):
+    """Track channel state; new channels need a reconcile to learn their amounts."""
+    ledger_event()
+    if not BALANCE_LEDGER["ready"]:
+        return
+    key = channel_state_changed.get("channel_id")
+    fields = {"state": channel_state_changed.get("new_state")}
+    if channel_state_changed.get("short_channel_id"):
+        fields["short_channel_id"] = channel_state_changed["short_channel_id"]
+    if not ledger_update_channel(key, **fields):
+        mark_ledger_dirty(f"state change on unknown channel {key}")
+
+def set_peer_connected(peer_id, connected):
+    """Flag every channel with peer_id as connected or disconnected."""
+    ledger_event()
+    if not BALANCE_LEDGER["ready"] or not peer_id:
+        return
+    with LEDGER_LOCK:
+        for key, channel in list(BALANCE_LEDGER["channels"].items()):
+            if channel["peer_id"] == peer_id:
+                ledger_update_channel(key, connected=connected)
+
+@plugin.subscribe("connect")
+def on_connect(plugin, connect=None, id=None, **kwargs):
+    """Count the peer's channels again."""
+    set_peer_connected((connect or {}).get("id", id), True)
+
+@plugin.subscribe("disconnect")
+def on_disconnect(plugin, disconnect=None, id=None, **kwargs):
+    """Stop counting the peer's channels."""
+    set_peer_connected((disconnect or {}).get("id", id), False)
+
+def parse_currencies(currencies):
+    """Parse a comma-separated currency list; defaults to usd,mxn if empty."""
+    fiat_currencies = [c.strip().lower() for c in currencies.split(",") if c.strip()]
+    # Use default currencies only if none specified
+    if not fiat_currencies:
+        fiat_currencies = DEFAULT_CURRENCIES
+    log("Parsed fiat currencies: %s", fiat_currencies, level="debug")
+    return fiat_currencies
+
+def channel_columns(channels):
+    """Split usable channels into peer, scid, outbound and inbound msat columns."""
+    peers = []
+    scids = []
+    outbound = array("q")
+    inbound = array("q")
+    for channel in channels:
+        if channel["state"] == "CHANNELD_NORMAL" and channel["connected"]:
+            our_msat = int(channel["our_amount_msat"])
+            peers.append(channel["peer_id"])
+            scids.append(channel.get("short_channel_id", "N/A"))
+            outbound.append(our_msat)
+            inbound.append(int(channel["amount_msat"]) - our_msat)
+    return peers, scids, outbound, inbound
+
+def select_channels(columns, peer=None, scid=None, min_capacity=None, sort=None, order="desc", offset=0, limit=None):
+    """
+    Indices of the channels in columns matching the filters, sorted and paginated.
+    With a limit, sorted pages are taken with a heap selection of offset+limit entries
+    instead of sorting every channel. Returns (indices, number of matching channels).
+    """
+    peers, scids, outbound, inbound = columns
+    matching = [
+        i for i in range(len(peers))
+        if (peer is None or peers[i].startswith(peer))
+        and (scid is None or scids[i] == scid)
+        and (min_capacity is None or outbound[i] + inbound[i] >= min_capacity)
+    ]
+    if sort is not None:
+        if sort == "outbound":
+            key = outbound.__getitem__
+        elif sort == "inbound":
+            key = inbound.__getitem__
+        else:  # sort == "ratio"
+            def key(i):
+                capacity = outbound[i] + inbound[i]
+                return outbound[i] / capacity if capacity else 0
+        if limit is not None:
+            select = heapq.nlargest if order == "desc" else heapq.nsmallest
+            matching_page = select(offset + limit, matching, key=key)[offset:]
+            return matching_page, len(matching)
+        matching_sorted = sorted(matching, key=key, reverse=order == "desc")
+        return matching_sorted[offset:], len(matching)
+    end = None if limit is None else offset + limit
+    return matching[offset:end], len(matching)
+
+def format_channel_details(channels, table, **selection):
+    """
+    Format usable channels column by column: every currency of the outbound and inbound
+    amounts is formatted in one pass, and the capacities reuse the msats column.
+    selection takes the select_channels filters; returns (details, number of matching channels).
+    """
+    columns = channel_columns(channels)
+    peers, scids, outbound, inbound = columns
+    if selection:
+        indices, matched = select_channels(columns, **selection)
+        peers = [peers[i] for i in indices]
+        scids = [scids[i] for i in indices]
+        outbound = [outbound[i] for i in indices]
+        inbound = [inbound[i] for i in indices]
+    else:
+        matched = len(peers)
+    keys = [entry[0] for entry in table]
+    details = [
+        {
+            "peer_id": peer[:10] + "...",
+            "short_channel_id": scid,
+            "outbound_capacity": outbound_row[2],
+            "inbound_capacity": inbound_row[2],
+            "outbound_balance": dict(zip(keys, outbound_row)),
+            "inbound_balance": dict(zip(keys, inbound_row))
+        } for peer, scid, outbound_row, inbound_row in zip(
+            peers, scids, zip(*format_columns(outbound, table)), zip(*format_columns(inbound, table)))
+    ]
+    return details, matched
+
+def percentile(values, p):
+    """Nearest-rank p-th percentile of sorted values, None if there are none."""
+    if not values:
+        return None
+    return values[max(0, -(-p * len(values) // 100) - 1)]
+
+def summarize_channels(channels, peer=None, scid=None, min_capacity=None, limit=SUMMARY_TOP):
+    """
+    Liquidity statistics from one pass over channels into array-backed columns: channel counts by
+    state, outbound/inbound totals of usable channels, an outbound ratio histogram, ratio and
+    capacity percentiles, and the limit channels whose outbound ratio is furthest from 0.5.
+    peer, scid and min_capacity filter channels as in select_channels.
+    """
+    states = {}
+    disconnected = 0
+    peers = []
+    scids = []
+    outbound = array("q")
+    inbound = array("q")
+    ratios = array("d")
+    histogram = [0] * SUMMARY_HISTOGRAM_BUCKETS
+    outbound_msat = 0
+    inbound_msat = 0
+    for channel in channels:
+        channel_scid = channel.get("short_channel_id", "N/A")
+        capacity = int(channel["amount_msat"])
+        if (peer is not None and not channel["peer_id"].startswith(peer)) or (scid is not None and channel_scid != scid) \
+                or (min_capacity is not None and capacity < min_capacity):
+            continue
+        states[channel["state"]] = states.get(channel["state"], 0) + 1
+        if channel["state"] != "CHANNELD_NORMAL":
+            continue
+        if not channel["connected"]:
+            disconnected += 1
+            continue
+        our_msat = int(channel["our_amount_msat"])
+        ratio = our_msat / capacity if capacity else 0
+        peers.append(channel["peer_id"])
+        scids.append(channel_scid)
+        outbound.append(our_msat)
+        inbound.append(capacity - our_msat)
+        ratios.append(ratio)
+        outbound_msat += our_msat
+        inbound_msat += capacity - our_msat
+        histogram[min(int(ratio * SUMMARY_HISTOGRAM_BUCKETS), SUMMARY_HISTOGRAM_BUCKETS - 1)] += 1
+
+    sorted_ratios = sorted(ratios)
+    capacities = sorted(o + i for o, i in zip(outbound, inbound))
+    imbalanced = heapq.nlargest(limit, range(len(ratios)), key=lambda i: abs(ratios[i] - 0.5))
+    width = 1 / SUMMARY_HISTOGRAM_BUCKETS
+    return {
+        "channels": len(peers),
+        "states": states,
+        "disconnected": disconnected,
+        "outbound_msat": outbound_msat,
+        "inbound_msat": inbound_msat,
+        "ratio_histogram": OrderedDict(
+            (f"{b * width:.1f}-{(b + 1) * width:.1f}", n) for b, n in enumerate(histogram)
+        ),
+        "ratio_percentiles": OrderedDict(
+            (f"p{p}", None if not sorted_ratios else round(percentile(sorted_ratios, p), 4)) for p in SUMMARY_PERCENTILES
+        ),
+        "capacity_percentiles_msat": OrderedDict((f"p{p}", percentile(capacities, p)) for p in SUMMARY_PERCENTILES),
+        "most_imbalanced": [
+            {
+                "peer_id": peers[i],
+                "short_channel_id": scids[i],
+                "outbound_ratio": round(ratios[i], 4),
+                "outbound_msat": outbound[i],
+                "inbound_msat": inbound[i]
+            } for i in imbalanced
+        ]
+    }
+
+def format_summary(summary, table):
+    """Text rendering of summarize_channels: formatted balances and capacities, shortened peer ids."""
+    msats_divisor = table[2][1]
+    sats_divisor = table[1][1]
+    return {
+        "channels": summary["channels"],
+        "states": summary["states"],
+        "disconnected": summary["disconnected"],
+        "outbound_balance": format_balance_fast(summary["outbound_msat"], table),
+        "inbound_balance": format_balance_fast(summary["inbound_msat"], table),
+        "ratio_histogram": summary["ratio_histogram"],
+        "ratio_percentiles": summary["ratio_percentiles"],
+        "capacity_percentiles": OrderedDict(
+            (p, None if msat is None else format(msat / sats_divisor, ",.0f") + " sats")
+            for p, msat in summary["capacity_percentiles_msat"].items()
+        ),
+        "most_imbalanced": [
+            {
+                "peer_id": channel["peer_id"][:10] + "...",
+                "short_channel_id": channel["short_channel_id"],
+                "outbound_ratio": channel["outbound_ratio"],
+                "outbound_capacity": format(channel["outbound_msat"] / msats_divisor, ",.0f") + " msats",
+                "inbound_capacity": format(channel["inbound_msat"] / msats_divisor, ",.0f") + " msats"
+            } for channel in summary["most_imbalanced"]
+        ]
+    }
+
+def parse_channel_selection(limit=None, offset=None, sort=None, order=None, peer=None, scid=None, min_capacity=None):
+    """Validate channel-details pagination, sorting and filter parameters into select_channels arguments."""
+    selection = {}
+    if limit is not None:
+        selection["limit"] = int(limit)
+        if selection["limit"] < 0:
+            raise Exception(f"Invalid limit: {limit}")
+    if offset is not None:
+        selection["offset"] = int(offset)
+        if selection["offset"] < 0:
+            raise Exception(f"Invalid offset: {offset}")
+    if sort is not None:
+        if sort not in CHANNEL_SORT_KEYS:
+            raise Exception(f"Invalid sort: {sort}. Use: {', '.join(CHANNEL_SORT_KEYS)}")
+        selection["sort"] = sort
+    if order is not None:
+        if order not in ("asc", "desc"):
+            raise Exception(f"Invalid order: {order}. Use: asc, desc")
+        selection["order"] = order
+    if peer is not None:
+        selection["peer"] = peer.lower()
+    if scid is not None:
+        selection["scid"] = scid
+    if min_capacity is not None:
+        selection["min_capacity"] = int(min_capacity)
+    return selection
+
+def page_fields(selection, returned, matched):
+    """total_channels/offset/next_offset of a channel-details page of returned out of matched channels."""
+    offset = selection.get("offset", 0)
+    return {
+        "total_channels": matched,
+        "offset": offset,
+        "next_offset": offset + returned if offset + returned < matched else None
     }
 
-@plugin.method("nodebalance")
-def node_balance(plugin, mode="total", currencies=""):
+@timed("format")
+def render_balance_raw(mode, funds, rates, fiat_currencies, selection=None):
+    """
+    render_balance with numbers instead of formatted strings: balances as integer msat plus
+    fiat values, and channel-details as columns with fiat conversion factors (msat per unit).
+    """
+    table = build_format_table(rates, fiat_currencies)
+    freshness = rates_freshness(fiat_currencies)
+    if mode == "onchain":
+        result = {"onchain_balance": raw_balance(funds["onchain_msat"], table)}
+    elif mode == "channels":
+        result = {"channel_balance": raw_balance(funds["channel_msat"], table)}
+    elif mode == "channel-details":
+        columns = channel_columns(funds["channels"])
+        peers, scids, outbound, inbound = columns
+        if selection:
+            indices, matched = select_channels(columns, **selection)
+            peers = [peers[i] for i in indices]
+            scids = [scids[i] for i in indices]
+            outbound = [outbound[i] for i in indices]
+            inbound = [inbound[i] for i in indices]
+        else:
+            outbound = outbound.tolist()
+            inbound = inbound.tolist()
+        result = {
+            "channels": {
+                "peer_ids": peers,
+                "short_channel_ids": scids,
+                "outbound_msat": outbound,
+                "inbound_msat": inbound
+            },
+            "msat_per_unit": {key: divisor for key, divisor, _, _ in table[3:]}
+        }
+        if selection:
+            result.update(page_fields(selection, len(peers), matched))
+    elif mode == "summary":
+        result = summarize_channels(funds["channels"], **(selection or {}))
+        result["outbound_balance"] = raw_balance(result["outbound_msat"], table)
+        result["inbound_balance"] = raw_balance(result["inbound_msat"], table)
+    else:  # mode == "total"
+        result = {"total_balance": raw_balance(funds["onchain_msat"] + funds["channel_msat"], table)}
+    result["rates_age"] = freshness["age"]
+    result["rates_fresh"] = freshness["fresh"]
+    return result
+
+@timed("format")
+def render_balance(mode, funds, rates, fiat_currencies, selection=None):
+    """
+    Build the response of a balance mode from a funds snapshot and a rate table.
+    selection holds channel-details filters from parse_channel_selection; when given, the
+    response also reports the number of matching channels and the next offset.
+    """
+    onchain_balance_msat = funds["onchain_msat"]
+    total_channel_balance_msat = funds["channel_msat"]
+    log("On-chain balance: %s msat", onchain_balance_msat, level="debug")
+    log("Total channel balance: %s msat", total_channel_balance_msat, level="debug")
+
+    # Prepare output based on mode
+    table = build_format_table(rates, fiat_currencies)
+    freshness = rates_freshness(fiat_currencies)
+    if mode == "onchain":
+        result = {
+            "onchain_balance": format_balance_fast(onchain_balance_msat, table)
+        }
+    elif mode == "channels":
+        result = {
+            "channel_balance": format_balance_fast(total_channel_balance_msat, table)
+        }
+    elif mode == "channel-details":
+        details, matched = format_channel_details(funds["channels"], table, **(selection or {}))
+        result = {
+            "channels": details
+        }
+        if selection:
+            result.update(page_fields(selection, len(details), matched))
+    elif mode == "summary":
+        result = format_summary(summarize_channels(funds["channels"], **(selection or {})), table)
+    else:  # mode == "total"
+        total_balance_msat = onchain_balance_msat + total_channel_balance_msat
+        result = {
+            "total_balance": format_balance_fast(total_balance_msat, table)
+        }
+    result["rates_age"] = freshness["age"]
+    result["rates_fresh"] = freshness["fresh"]
+    return result
+
+def get_request_executor():
+    """Shared thread pool running RPC requests, created on first use."""
+    from concurrent.futures import ThreadPoolExecutor
+    with REQUEST_EXECUTOR["lock"]:
+        if REQUEST_EXECUTOR["executor"] is None:
+            REQUEST_EXECUTOR["executor"] = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="nodebalance-rpc")
+        return REQUEST_EXECUTOR["executor"]
+
+def run_request(request, func, *args, **kwargs):
+    """Answer an async RPC request with func(*args, **kwargs) computed on a worker thread; returns its future."""
+    def run():
+        try:
+            request.set_result(func(*args, **kwargs))
+        except Exception as e:
+            request.set_exception(e)
+    return get_request_executor().submit(run)
+
+def cached_response(key, rates):
+    """Response stored under key if it was rendered with this rate table, else None."""
+    with RESPONSE_CACHE["lock"]:
+        entry = RESPONSE_CACHE["entries"].get(key)
+        if entry is not None and entry[0] is rates:
+            RESPONSE_CACHE["entries"].move_to_end(key)
+            count("response_cache_hit")
+            return entry[1]
+    count("response_cache_miss")
+    return None
+
+def store_response(key, rates, response):
+    """Keep response for key, evicting the least recently used entries beyond nodebalance-response-cache."""
+    size = int(plugin.get_option("nodebalance-response-cache"))
+    if size <= 0:
+        return
+    with RESPONSE_CACHE["lock"]:
+        RESPONSE_CACHE["entries"][key] = (rates, response)
+        RESPONSE_CACHE["entries"].move_to_end(key)
+        while len(RESPONSE_CACHE["entries"]) > size:
+            RESPONSE_CACHE["entries"].popitem(last=False)
+
+def render_balance_cached(mode, rates, fiat_currencies, selection, output_format="text"):
+    """
+    render_balance (render_balance_raw for the raw format) for the current funds, reusing a stored
+    response while neither the funds (ledger version while the ledger is built, else a digest of
+    the RPC snapshot) nor the rate table changed. With a clean ledger a repeated call is answered
+    without taking a snapshot; rate ages are always current. With the cache disabled nothing is
+    looked up and no digest is computed.
+    """
+    render = render_balance_raw if output_format == "raw" else render_balance
+    if int(plugin.get_option("nodebalance-response-cache")) <= 0:
+        return render(mode, get_funds_snapshot([mode]), rates, fiat_currencies, selection)
+    key = (mode, output_format, tuple(fiat_currencies), tuple(sorted(selection.items())))
+    funds = None
+    if BALANCE_LEDGER["ready"] and not BALANCE_LEDGER["dirty"]:
+        version = ("ledger", BALANCE_LEDGER["version"])
+    else:
+        # A built ledger answers with its version; only an RPC snapshot is digested
+        funds = get_funds_snapshot([mode], digest=True)
+        version = funds["version"]
+    cached = cached_response(key + (version,), rates)
+    if cached is not None:
+        freshness = rates_freshness(fiat_currencies)
+        return dict(cached, rates_age=freshness["age"], rates_fresh=freshness["fresh"])
+    if funds is None:
+        funds = get_funds_snapshot([mode], digest=True)
+    result = render(mode, funds, rates, fiat_currencies, selection)
+    store_response(key + (funds["version"],), rates, result)
+    return result
+
+@plugin.async_method("nodebalance")
+def node_balance_request(plugin, request, mode="total", currencies="", limit=None, offset=None, sort=None, order=None,
+                         peer=None, scid=None, min_capacity=None, format="text"):
+    """
+    RPC method nodebalance, see node_balance. Answered on a worker thread so a call waiting
+    on a rate provider does not hold up other calls.
+    """
+    return run_request(request, node_balance, plugin, mode=mode, currencies=currencies, limit=limit, offset=offset,
+                       sort=sort, order=order, peer=peer, scid=scid, min_capacity=min_capacity, format=format)
+
+@traced_call("nodebalance")
+def node_balance(plugin, mode="total", currencies="", limit=None, offset=None, sort=None, order=None,
+                 peer=None, scid=None, min_capacity=None, format="text"):
     """
     RPC method to display node balances or rates based on mode.
-    Modes: total, onchain, channels, channel-details, rate.
+    Modes: total, onchain, channels, channel-details, summary, rate.
     All balance modes include btc, sats, msats, and user-specified currencies.
     Rate mode shows BTC to fiat rates.
     Currencies: comma-separated list (e.g., usd,mxn,eur); defaults to usd,mxn if empty.
+    channel-details accepts limit/offset pagination, sort (outbound, inbound, ratio) with
+    order (desc by default), and filters by peer id prefix, scid and min_capacity (msat).
+    summary reports channel counts by state, liquidity totals, an outbound ratio histogram,
+    percentiles and the limit (default 5) most imbalanced channels, filtered like channel-details.
+    Format: text (formatted strings) or raw (integer msat and numeric fiat values, channel-details
+    as columns).
     """
     try:
+        if format not in OUTPUT_FORMATS:
+            raise Exception(f"Invalid format: {format}. Use: {', '.join(OUTPUT_FORMATS)}")
+
         # Validate mode
-        valid_modes = ["total", "onchain", "channels", "channel-details", "rate"]
-        if mode not in valid_modes:
+        if mode not in VALID_MODES:
             # Check if mode is actually a currency (e.g., 'eur')
             if currencies == "":
                 currencies = mode
                 mode = "total"
             else:
-                raise Exception(f"Invalid mode: {mode}. Use: {', '.join(valid_modes)}")
+                raise Exception(f"Invalid mode: {mode}. Use: {', '.join(VALID_MODES)}")
 
-        # Parse currencies
-        fiat_currencies = [c.strip().lower() for c in currencies.split(",") if c.strip()]
-        # Use default currencies only if none specified
-        if not fiat_currencies:
-            fiat_currencies = DEFAULT_CURRENCIES
-        plugin.log(f"Parsed fiat currencies: {fiat_currencies}")
+        fiat_currencies = parse_currencies(currencies)
 
         # Check for invalid currencies in rate mode
         if mode == "rate":
-            invalid_currencies = [c for c in fiat_currencies if c not in VALID_CURRENCIES]
+            invalid_currencies = [c for c in fiat_currencies if c not in VALID_CURRENCY_SET]
             if invalid_currencies:
-                plugin.log(f"Invalid currencies detected: {invalid_currencies}")
+                log("Invalid currencies detected: %s", invalid_currencies, level="debug")
+                if format == "raw":
+                    return {"rates": {c: None for c in fiat_currencies}, "timestamp": int(time.time()),
+                            "cached": False, "age": None, "fresh": False}
                 rates_response = {
                     "rates": {c: "Rate unavailable" if c in invalid_currencies else "Rate unavailable" for c in fiat_currencies},
                     "timestamp": datetime.fromtimestamp(time.time()).isoformat(),
-                    "cached": False
+                    "cached": False,
+                    "age": None,
+                    "fresh": False
                 }
                 return rates_response
 
-        # Fetch currency rates
-        rates = get_currency_rates(fiat_currencies)
-        plugin.log(f"Rates available for: {rates.keys()}")
+        # Fetch currency rates; unsupported currencies are skipped instead of being sent to the APIs
+        rates = get_currency_rates([c for c in fiat_currencies if c in VALID_CURRENCY_SET])
+        log("Rates available for: %s", list(rates), level="debug")
 
         # Handle rate mode
         if mode == "rate":
-            return format_rates(rates, fiat_currencies, RATES_CACHE["timestamp"])
-
-        # Fetch listfunds data for balance modes
-        funds = plugin.rpc.listfunds()
-        plugin.log(f"listfunds output: {json.dumps(funds, indent=2)}")
-
-        # Calculate on-chain balance
-        onchain_balance_msat = sum(output["amount_msat"] for output in funds["outputs"] if output["status"] == "confirmed" and not output["reserved"])
-        plugin.log(f"On-chain balance: {onchain_balance_msat} msat")
-
-        # Calculate channel balances and details
-        total_channel_balance_msat = 0
-        channel_details = []
-        for channel in funds["channels"]:
-            if channel["state"] == "CHANNELD_NORMAL" and channel["connected"]:
-                our_msat = channel["our_amount_msat"]
-                total_msat = channel["amount_msat"]
-                outbound_msat = our_msat
-                inbound_msat = total_msat - our_msat
-                total_channel_balance_msat += our_msat
-                channel_details.append({
-                    "peer_id": channel["peer_id"][:10] + "...",
-                    "short_channel_id": channel.get("short_channel_id", "N/A"),
-                    "outbound_msat": outbound_msat,
-                    "inbound_msat": inbound_msat
-                })
-        plugin.log(f"Total channel balance: {total_channel_balance_msat} msat")
-
-        # Prepare output based on mode
-        if mode == "onchain":
-            return {
-                "onchain_balance": format_balance(onchain_balance_msat, rates, fiat_currencies)
-            }
-        elif mode == "channels":
-            return {
-                "channel_balance": format_balance(total_channel_balance_msat, rates, fiat_currencies)
-            }
-        elif mode == "channel-details":
-            return {
-                "channels": [
-                    {
-                        "peer_id": ch["peer_id"],
-                        "short_channel_id": ch["short_channel_id"],
-                        "outbound_capacity": format_currency(ch["outbound_msat"], "msats", rates),
-                        "inbound_capacity": format_currency(ch["inbound_msat"], "msats", rates),
-                        "outbound_balance": format_balance(ch["outbound_msat"], rates, fiat_currencies),
-                        "inbound_balance": format_balance(ch["inbound_msat"], rates, fiat_currencies)
-                    } for ch in channel_details
-                ]
-            }
-        else:  # mode == "total"
-            total_balance_msat = onchain_balance_msat + total_channel_balance_msat
-            return {
-                "total_balance": format_balance(total_balance_msat, rates, fiat_currencies)
-            }
+            render_rates = format_rates_raw if format == "raw" else format_rates
+            return render_rates(rates, fiat_currencies, rates_timestamp(fiat_currencies))
+
+        selection = parse_channel_selection(limit, offset, sort, order, peer, scid, min_capacity)
+        if mode == "summary" and (offset is not None or sort is not None or order is not None):
+            raise Exception("offset, sort and order do not apply to summary")
+
+        # Render balance modes, reusing the last identical response while funds and rates are unchanged
+        return render_balance_cached(mode, rates, fiat_currencies, selection, format)
 
     except Exception as e:
-        plugin.log(f"Error in nodebalance: {str(e)}")
+        log(f"Error in nodebalance: {str(e)}", level="error")
         raise Exception(f"Failed to retrieve balance: {str(e)}")
 
-plugin.add_option("nodebalance-mode", "total", "Default output mode: total, onchain, channels, channel-details, rate")
+def fleet_rpc(socket_path):
+    """
+    RPC client object of the node at socket_path, created once and kept for later calls;
+    LightningRpc still opens a new socket connection for every call it makes.
+    """
+    with FLEET_LOCK:
+        if socket_path not in FLEET_RPCS:
+            FLEET_RPCS[socket_path] = LightningRpc(socket_path)
+        return FLEET_RPCS[socket_path]
+
+def submit_fleet_call(socket_path):
+    """
+    Query the node at socket_path on its own worker; returns the future, or None while an
+    earlier call to that node is still running. Callers hold FLEET_LOCK.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    previous = FLEET_CALLS.get(socket_path)
+    if previous is not None and not previous.done():
+        return None
+    if socket_path not in FLEET_EXECUTORS:
+        FLEET_EXECUTORS[socket_path] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nodebalance-fleet")
+    FLEET_CALLS[socket_path] = FLEET_EXECUTORS[socket_path].submit(fleet_node_snapshot, socket_path)
+    return FLEET_CALLS[socket_path]
+
+def fleet_node_snapshot(socket_path):
+    """Node id and balances of the node at socket_path from filtered RPC calls."""
+    rpc = fleet_rpc(socket_path)
+    funds = rpc_snapshot(rpc)
+    funds["id"] = rpc.call("getinfo", {}, filter={"id": True})["id"]
+    return funds
+
+def local_node_snapshot():
+    """Node id and balances of this node, from the ledger when it is built."""
+    funds = dict(get_funds_snapshot(["total"]))
+    funds["id"] = plugin.rpc.call("getinfo", {}, filter={"id": True})["id"]
+    return funds
+
+def fleet_snapshots(socket_paths, timeout):
+    """
+    Query every node in socket_paths in parallel, and this node ("local") on the calling thread
+    meanwhile, under one timeout. Returns {name: funds or Exception}; nodes that did not answer
+    in time, or are still busy with an earlier call that never returned, map to a TimeoutError.
+    """
+    from concurrent.futures import wait
+    deadline = time.monotonic() + timeout
+    with FLEET_LOCK:
+        futures = OrderedDict((path, submit_fleet_call(path)) for path in OrderedDict.fromkeys(socket_paths))
+    snapshots = OrderedDict()
+    try:
+        snapshots["local"] = local_node_snapshot()
+    except Exception as e:
+        snapshots["local"] = e
+    done, _ = wait([future for future in futures.values() if future is not None],
+                   timeout=max(0, deadline - time.monotonic()))
+    for name, future in futures.items():
+        if future is None:
+            snapshots[name] = TimeoutError("still busy with an earlier call that did not return")
+        elif future not in done:
+            snapshots[name] = TimeoutError(f"no answer within {timeout:g}s")
+        elif future.exception() is not None:
+            snapshots[name] = future.exception()
+        else:
+            snapshots[name] = future.result()
+    return snapshots
+
+@traced_call("nodebalance-fleet")
+def node_balance_fleet(plugin, sockets=None, currencies="", timeout=None):
+    """
+    RPC method returning the balances of this node and every node in sockets, queried in parallel
+    and priced with one rate table.
+    Sockets: comma-separated list (or array) of lightning-rpc paths; defaults to nodebalance-fleet-sockets.
+    Nodes that fail or do not answer within timeout seconds are reported with an error and left
+    out of the aggregate, which is then marked partial.
+    """
+    try:
+        if sockets is None:
+            sockets = plugin.get_option("nodebalance-fleet-sockets")
+        if isinstance(sockets, str):
+            sockets = [path.strip() for path in sockets.split(",") if path.strip()]
+        timeout = float(plugin.get_option("nodebalance-fleet-timeout") if timeout is None else timeout)
+        fiat_currencies = parse_currencies(currencies)
+        rates = get_currency_rates([c for c in fiat_currencies if c in VALID_CURRENCY_SET])
+        table = build_format_table(rates, fiat_currencies)
+
+        snapshots = fleet_snapshots(sockets, timeout)
+        nodes = OrderedDict()
+        onchain_msat = channel_msat = 0
+        for name, funds in snapshots.items():
+            if isinstance(funds, Exception):
+                log(f"Fleet node {name} failed: {str(funds)}", level="warn")
+                nodes[name] = {"error": str(funds) or type(funds).__name__}
+                continue
+            onchain_msat += funds["onchain_msat"]
+            channel_msat += funds["channel_msat"]
+            nodes[name] = {
+                "id": funds["id"],
+                "onchain_balance": format_balance_fast(funds["onchain_msat"], table),
+                "channel_balance": format_balance_fast(funds["channel_msat"], table),
+                "total_balance": format_balance_fast(funds["onchain_msat"] + funds["channel_msat"], table)
+            }
+        failed = sum(1 for node in nodes.values() if "error" in node)
+        freshness = rates_freshness(fiat_currencies)
+        return {
+            "nodes": nodes,
+            "aggregate": {
+                "onchain_balance": format_balance_fast(onchain_msat, table),
+                "channel_balance": format_balance_fast(channel_msat, table),
+                "total_balance": format_balance_fast(onchain_msat + channel_msat, table)
+            },
+            "nodes_ok": len(nodes) - failed,
+            "nodes_failed": failed,
+            "partial": failed > 0,
+            "rates_age": freshness["age"],
+            "rates_fresh": freshness["fresh"]
+        }
+
+    except Exception as e:
+        log(f"Error in nodebalance-fleet: {str(e)}", level="error")
+        raise Exception(f"Failed to retrieve fleet balances: {str(e)}")
+
+@plugin.async_method("nodebalance-fleet")
+def node_balance_fleet_request(plugin, request, sockets=None, currencies="", timeout=None):
+    """RPC method nodebalance-fleet, see node_balance_fleet; answered on a worker thread."""
+    return run_request(request, node_balance_fleet, plugin, sockets=sockets, currencies=currencies, timeout=timeout)
+
+@plugin.async_method("nodebalance-batch")
+def node_balance_batch_request(plugin, request, modes="total,onchain,channels,rate", currencies=""):
+    """RPC method nodebalance-batch, see node_balance_batch; answered on a worker thread."""
+    return run_request(request, node_balance_batch, plugin, modes=modes, currencies=currencies)
+
+@traced_call("nodebalance-batch")
+def node_balance_batch(plugin, modes="total,onchain,channels,rate", currencies=""):
+    """
+    RPC method returning several nodebalance modes computed from one funds snapshot and one rate table.
+    Modes: comma-separated list (or array) of total, onchain, channels, channel-details, summary, rate.
+    Currencies: comma-separated list (e.g., usd,mxn,eur); defaults to usd,mxn if empty.
+    Returns an object keyed by mode, each value being what nodebalance returns for that mode.
+    """
+    try:
+        if isinstance(modes, str):
+            modes = [m.strip() for m in modes.split(",") if m.strip()]
+        invalid_modes = [m for m in modes if m not in VALID_MODES]
+        if invalid_modes or not modes:
+            raise Exception(f"Invalid modes: {', '.join(invalid_modes)}. Use: {', '.join(VALID_MODES)}")
+
+        fiat_currencies = parse_currencies(currencies)
+        # Unsupported currencies are reported as unavailable instead of being sent to the APIs
+        rates = get_currency_rates([c for c in fiat_currencies if c in VALID_CURRENCY_SET])
+        balance_modes = [m for m in modes if m != "rate"]
+        funds = get_funds_snapshot(balance_modes) if balance_modes else None
+
+        result = OrderedDict()
+        for mode in modes:
+            if mode == "rate":
+                result[mode] = format_rates(rates, fiat_currencies, rates_timestamp(fiat_currencies))
+            else:
+                result[mode] = render_balance(mode, funds, rates, fiat_currencies)
+        return result
+
+    except Exception as e:
+        log(f"Error in nodebalance-batch: {str(e)}", level="error")
+        raise Exception(f"Failed to retrieve balances: {str(e)}")
+
+@plugin.method("nodebalance-history")
+def node_balance_history(plugin, start=None, end=None, resolution="auto", currencies=""):
+    """
+    RPC method returning recorded balances and BTC to fiat rates between start and end (unix times).
+    Defaults to the last 24 hours. Resolution: raw, hour, day, or auto for the finest one still
+    retained at start. Answered from the history store only, without calling the node or rate APIs.
+    Currencies: comma-separated list (e.g., usd,mxn,eur); defaults to usd,mxn if empty.
+    """
+    try:
+        now = int(time.time())
+        end = now if end is None else int(end)
+        start = end - 86400 if start is None else int(start)
+        if start > end:
+            raise Exception(f"Invalid range: start {start} is after end {end}")
+        if resolution == "auto":
+            bucket = history_resolution(start, now)
+        elif resolution in HISTORY_RESOLUTIONS:
+            bucket = HISTORY_RESOLUTIONS[resolution]
+        else:
+            raise Exception(f"Invalid resolution: {resolution}. Use: auto, {', '.join(HISTORY_RESOLUTIONS)}")
+        fiat_currencies = parse_currencies(currencies)
+        samples = query_history(start, end, bucket, fiat_currencies)
+        return {
+            "resolution": next(name for name, seconds in HISTORY_RESOLUTIONS.items() if seconds == bucket),
+            "start": start,
+            "end": end,
+            "samples": samples
+        }
+
+    except Exception as e:
+        log(f"Error in nodebalance-history: {str(e)}", level="error")
+        raise Exception(f"Failed to retrieve history: {str(e)}")
+
+@plugin.method("nodebalance-stats")
+def node_balance_stats(plugin, reset=False):
+    """
+    RPC method reporting per-stage timings, cache and funds source counters, and per-provider
+    success/failure counts with latency histograms (bucket upper bounds in ms) since startup or the last reset,
+    plus each provider's current health (circuit state, latency EWMA, success rate, seconds it is skipped for).
+    """
+    with STATS["lock"]:
+        result = {
+            "since": datetime.fromtimestamp(STATS["since"]).isoformat(),
+            "timers": {
+                stage: {
+                    "count": timer["count"],
+                    "total_ms": round(timer["total"] * 1000, 3),
+                    "avg_ms": round(timer["total"] * 1000 / timer["count"], 3),
+                    "max_ms": round(timer["max"] * 1000, 3)
+                } for stage, timer in sorted(STATS["timers"].items())
+            },
+            "counters": dict(sorted(STATS["counters"].items())),
+            "providers": {
+                api_name: {
+                    "success": provider["success"],
+                    "failure": provider["failure"],
+                    "avg_ms": round(provider["total"] * 1000 / (provider["success"] + provider["failure"]), 3),
+                    "latency_ms": dict(provider["latency_ms"])
+                } for api_name, provider in sorted(STATS["providers"].items())
+            }
+        }
+        if reset in (True, "true"):
+            STATS["since"] = time.time()
+            STATS["timers"] = {}
+            STATS["counters"] = {}
+            STATS["providers"] = {}
+    hits = result["counters"].get("response_cache_hit", 0)
+    lookups = hits + result["counters"].get("response_cache_miss", 0)
+    with RESPONSE_CACHE["lock"]:
+        result["response_cache"] = {
+            "entries": len(RESPONSE_CACHE["entries"]),
+            "hit_rate": round(hits / lookups, 3) if lookups else None
+        }
+    now = time.time()
+    with PROVIDER_LOCK:
+        health_by_name = {name: provider_health(name) for name in RATE_PROVIDERS}
+        result["provider_health"] = {
+            name: {
+                "circuit": health["circuit"],
+                "latency_ewma_ms": round(health["latency_ms"], 3),
+                "success_rate": round(success_rate(health), 3),
+                "consecutive_failures": health["consecutive_failures"],
+                "skipped_for": max(0, int(max(health["retry_after_until"],
+                                              health["open_until"] if health["circuit"] == "open" else 0) - now))
+            } for name, health in health_by_name.items()
+        }
+    return result
+
+plugin.add_option("nodebalance-mode", "total", "Default output mode: total, onchain, channels, channel-details, summary, rate")
 plugin.add_option("nodebalance-currencies", "", "Default currencies: comma-separated (e.g., usd,mxn,eur); empty for usd,mxn")
+plugin.add_option("nodebalance-log-level", "info", "Minimum level of plugin log lines: debug (includes full payload dumps), info, warn or error", dynamic=True, on_change=set_log_level)
+plugin.add_option("nodebalance-http-timeout", 5, "Timeout in seconds for each rate API request", opt_type="int")
+plugin.add_option("nodebalance-http-pool-size", 4, "Connections kept alive per rate API host", opt_type="int")
+plugin.add_option("nodebalance-http-keepalive", True, "Reuse connections to the rate APIs between refreshes", opt_type="bool")
+plugin.add_option("nodebalance-http-conditional", True, "Revalidate rate API responses with ETag/If-Modified-Since", opt_type="bool")
+plugin.add_option("nodebalance-fetch-mode", "sequential", "How rate providers are queried: sequential, hedged (concurrent, first complete answer wins) or median (concurrent, median of all answers)")
+plugin.add_option("nodebalance-cache-file", "", f"File the fiat rates are saved to for warm restarts; empty for {RATE_STORE_FILE} in the lightning directory")
+plugin.add_option("nodebalance-prefetch-all", False, "Fetch and cache the rates of every supported currency in one request per refresh", opt_type="bool")
+plugin.add_option("nodebalance-ledger", True, "Keep balances in memory from notifications instead of calling listfunds on every request", opt_type="bool")
+plugin.add_option("nodebalance-reconcile-interval", RECONCILE_INTERVAL, "Seconds between full listfunds reconciles of the balance ledger", opt_type="int")
+plugin.add_option("nodebalance-background-refresh", True, "Refresh fiat rates in a background thread ahead of expiry", opt_type="bool")
+plugin.add_option("nodebalance-history-interval", 0, "Seconds between balance and rate history samples; 0 disables the history sampler", opt_type="int")
+plugin.add_option("nodebalance-history-file", "", f"SQLite file balance and rate history is stored in; empty for {HISTORY_STORE_FILE} in the lightning directory")
+plugin.add_option("nodebalance-metrics-port", 0, "Port on 127.0.0.1 serving Prometheus metrics; 0 disables the exporter", opt_type="int")
+plugin.add_option("nodebalance-metrics-interval", METRICS_INTERVAL, "Seconds between refreshes of the metrics snapshot", opt_type="int")
+plugin.add_option("nodebalance-slow-call-ms", 0, "Log nodebalance calls taking at least this many milliseconds with their stage timings; 0 disables", opt_type="int", dynamic=True)
+plugin.add_option("nodebalance-fleet-sockets", "", "Comma-separated lightning-rpc socket paths of other nodes totalled by nodebalance-fleet")
+plugin.add_option("nodebalance-fleet-timeout", FLEET_TIMEOUT, "Seconds nodebalance-fleet waits for the other nodes before returning partial results", opt_type="int")
+plugin.add_option("nodebalance-response-cache", RESPONSE_CACHE_SIZE, "Rendered nodebalance responses kept for repeated calls while funds and rates are unchanged; 0 disables", opt_type="int")
+plugin.add_option("nodebalance-notify-msat", 0, "Notify when the on-chain, channel or total balance moves by at least this many msat; 0 disables", opt_type="int")
+plugin.add_option("nodebalance-notify-fiat", "0", "Notify when the total balance in a nodebalance-currencies fiat moves by at least this amount; 0 disables")
+plugin.add_option("nodebalance-notify-percent", "0", "Notify when a balance or fiat total moves by at least this percent; 0 disables")
+plugin.add_option("nodebalance-notify-debounce", NOTIFY_DEBOUNCE, "Minimum seconds between balance change notifications; changes in between are combined", opt_type="int")
+plugin.add_option("nodebalance-notify-hook", "", "RPC method also called with each balance change notification; empty for none")
+plugin.add_option("nodebalance-max-stale", MAX_STALE_AGE, "Maximum age in seconds of expired rates served while a background refresh runs", opt_type="int")
+plugin.add_notification_topic(NOTIFY_TOPIC)
+
+@plugin.init()
+def init(options, configuration, plugin, **kwargs):
+    """Restore cached rates and start background workers once lightningd has handed us our configuration."""
+    set_log_level(plugin, "nodebalance-log-level", plugin.get_option("nodebalance-log-level"))
+    RATE_STORE["path"] = plugin.get_option("nodebalance-cache-file") or os.path.join(plugin.lightning_dir, RATE_STORE_FILE)
+    load_rates_cache(RATE_STORE["path"])
+    if plugin.get_option("nodebalance-background-refresh"):
+        start_rate_refresher()
+    prefetch_rates([c for c in parse_currencies(plugin.get_option("nodebalance-currencies")) if c in VALID_CURRENCY_SET])
+    if plugin.get_option("nodebalance-ledger"):
+        start_ledger()
+    HISTORY_STORE["path"] = plugin.get_option("nodebalance-history-file") or os.path.join(plugin.lightning_dir, HISTORY_STORE_FILE)
+    if int(plugin.get_option("nodebalance-history-interval")) > 0:
+        start_history_sampler()
+    metrics_port = int(plugin.get_option("nodebalance-metrics-port"))
+    if metrics_port > 0:
+        try:
+            start_metrics_server(metrics_port)
+        except OSError as e:
+            log(f"Cannot serve metrics on port {metrics_port}: {str(e)}", level="error")
+    if int(plugin.get_option("nodebalance-notify-msat")) > 0 or float(plugin.get_option("nodebalance-notify-fiat")) > 0 \
+            or float(plugin.get_option("nodebalance-notify-percent")) > 0:
+        start_notifier()
 
 if __name__ == "__main__":
     plugin.run()
@@ -5,7 +5,7 @@ import os
 import requests
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from nodebalance import plugin, node_balance, RATES_CACHE, CONVERSION_RATES
+from nodebalance import plugin, node_balance, RATES_CACHE, CONVERSION_RATES, reset_provider_health
 
 class TestNodeBalanceFallback(unittest.TestCase):
     def setUp(self):
@@ -14,13 +14,17 @@ class TestNodeBalanceFallback(unittest.TestCase):
         self.plugin.log = Mock()
         RATES_CACHE["rates"] = CONVERSION_RATES.copy()
         RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
 
     def _mock_rates(self):
         """Common mock rates for gbp, eur."""
         return {"gbp": 78000, "eur": 91604}
 
     @patch('nodebalance.time.time')
-    @patch('nodebalance.requests.get')
+    @patch('requests.Session.get')
     def test_coingecko_success(self, mock_get, mock_time):
         """Test CoinGecko succeeds, no further APIs called."""
         mock_time.return_value = 10000000
@@ -39,7 +43,7 @@ class TestNodeBalanceFallback(unittest.TestCase):
         self.assertTrue(RATES_CACHE["rates"]["gbp"] > 0)
 
     @patch('nodebalance.time.time')
-    @patch('nodebalance.requests.get')
+    @patch('requests.Session.get')
     def test_coingecko_fails_coinpaprika_success(self, mock_get, mock_time):
         """Test CoinGecko fails, CoinPaprika succeeds."""
         mock_time.return_value = 10000000
@@ -64,7 +68,7 @@ class TestNodeBalanceFallback(unittest.TestCase):
         self.assertTrue(RATES_CACHE["rates"]["gbp"] > 0)
 
     @patch('nodebalance.time.time')
-    @patch('nodebalance.requests.get')
+    @patch('requests.Session.get')
     def test_coingecko_coinpaprika_fails_coincap_success(self, mock_get, mock_time):
         """Test CoinGecko and CoinPaprika fail, CoinCap succeeds."""
         mock_time.return_value = 10000000
@@ -96,7 +100,7 @@ class TestNodeBalanceFallback(unittest.TestCase):
         self.assertTrue(RATES_CACHE["rates"]["gbp"] > 0)
 
     @patch('nodebalance.time.time')
-    @patch('nodebalance.requests.get')
+    @patch('requests.Session.get')
     def test_all_apis_fail(self, mock_get, mock_time):
         """Test all APIs fail, falls back to CONVERSION_RATES."""
         mock_time.return_value = 10000000
@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, node_balance_batch, BALANCE_LEDGER, CONVERSION_RATES
+
+OUTPUTS = {"outputs": [{"amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+CHANNELS = {"channels": [
+    {"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000}
+]}
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node and no ledger."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+
+    @patch('nodebalance.get_currency_rates')
+    def test_one_snapshot_for_all_modes(self, mock_rates):
+        """Every requested view is built from one rate lookup and one funds snapshot."""
+        mock_rates.return_value = CONVERSION_RATES
+        result = node_balance_batch(self.plugin, modes="total,onchain,channels,rate", currencies="usd")
+        self.assertEqual(list(result), ["total", "onchain", "channels", "rate"])
+        mock_rates.assert_called_once_with(["usd"])
+        self.assertEqual(self.plugin.rpc.call.call_count, 2)
+
+        # Each view matches what nodebalance returns for that mode
+        for mode in ["total", "onchain", "channels", "rate"]:
+            self.assertEqual(result[mode], node_balance(self.plugin, mode=mode, currencies="usd"))
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+    def test_mode_list_and_rpc_selection(self):
+        """Modes can be passed as a list; only the RPCs they need are made."""
+        result = node_balance_batch(self.plugin, modes=["channels", "channel-details"], currencies="usd")
+        self.assertEqual(result["channel-details"]["channels"][0]["short_channel_id"], "100x1x0")
+        self.assertEqual([call[0][0] for call in self.plugin.rpc.call.call_args_list], ["listpeerchannels"])
+
+    @patch('nodebalance.get_currency_rates')
+    def test_invalid_currency_not_fetched(self, mock_rates):
+        """Unsupported currencies are reported as unavailable without being fetched."""
+        mock_rates.return_value = CONVERSION_RATES
+        result = node_balance_batch(self.plugin, modes="rate", currencies="usd,xyz")
+        mock_rates.assert_called_once_with(["usd"])
+        self.assertEqual(result["rate"]["rates"]["xyz"], "Rate unavailable")
+        self.plugin.rpc.call.assert_not_called()
+
+    def test_invalid_mode(self):
+        """Unknown modes are rejected."""
+        with self.assertRaises(Exception) as ctx:
+            node_balance_batch(self.plugin, modes="total,bogus")
+        self.assertIn("bogus", str(ctx.exception))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, BALANCE_LEDGER, CONVERSION_RATES
+
+CHANNELS = {"channels": [
+    {"peer_id": ("02" if i % 2 else "03") + "%064x" % i, "channel_id": f"c{i}", "short_channel_id": f"{i}x1x0",
+     "state": "CHANNELD_NORMAL", "peer_connected": i != 9, "to_us_msat": (i * 37) % 11 * 1000000,
+     "total_msat": (i % 4 + 1) * 10000000}
+    for i in range(12)
+]}
+
+def scids(result):
+    return [ch["short_channel_id"] for ch in result["channels"]]
+
+@patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+class TestChannelQuery(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node and no ledger."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.return_value = CHANNELS
+        BALANCE_LEDGER["ready"] = False
+        self.usable = [ch for ch in CHANNELS["channels"] if ch["peer_connected"]]
+
+    def query(self, **params):
+        return node_balance(self.plugin, mode="channel-details", currencies="usd", **params)
+
+    def test_default_unchanged(self):
+        """Without parameters every usable channel is listed and no paging fields are added."""
+        result = self.query()
+        self.assertNotIn("total_channels", result)
+        self.assertEqual(len(result["channels"]), 11)
+
+    def test_pagination(self):
+        """limit/offset pages cover every channel once, in listing order."""
+        pages = []
+        offset = 0
+        while offset is not None:
+            result = self.query(limit=4, offset=offset)
+            self.assertEqual(result["total_channels"], 11)
+            pages.extend(scids(result))
+            offset = result["next_offset"]
+        self.assertEqual(pages, [ch["short_channel_id"] for ch in self.usable])
+
+    def test_top_n(self):
+        """Sorted pages match a full sort of the usable channels."""
+        by_outbound = sorted(self.usable, key=lambda ch: ch["to_us_msat"], reverse=True)
+        self.assertEqual(scids(self.query(sort="outbound", limit=3)),
+                         [ch["short_channel_id"] for ch in by_outbound[:3]])
+        self.assertEqual(scids(self.query(sort="outbound", limit=3, offset=3)),
+                         [ch["short_channel_id"] for ch in by_outbound[3:6]])
+
+        by_inbound = sorted(self.usable, key=lambda ch: ch["total_msat"] - ch["to_us_msat"])
+        self.assertEqual(scids(self.query(sort="inbound", order="asc", limit=5)),
+                         [ch["short_channel_id"] for ch in by_inbound[:5]])
+
+        by_ratio = sorted(self.usable, key=lambda ch: ch["to_us_msat"] / ch["total_msat"], reverse=True)
+        self.assertEqual(scids(self.query(sort="ratio")), [ch["short_channel_id"] for ch in by_ratio])
+
+    def test_filters(self):
+        """peer prefix, scid and min_capacity narrow the result and total_channels."""
+        result = self.query(peer="03", limit=100)
+        self.assertEqual(result["total_channels"], 6)
+        self.assertTrue(all(ch["peer_id"].startswith("03") for ch in result["channels"]))
+        self.assertIsNone(result["next_offset"])
+
+        self.assertEqual(scids(self.query(scid="4x1x0")), ["4x1x0"])
+        self.assertEqual(scids(self.query(scid="9x1x0")), [])
+
+        result = self.query(min_capacity=30000000)
+        self.assertEqual(scids(result), [ch["short_channel_id"] for ch in self.usable if ch["total_msat"] >= 30000000])
+
+    def test_invalid_parameters(self):
+        """Unknown sort keys and negative pages are rejected."""
+        for params in [{"sort": "fees"}, {"order": "up"}, {"limit": -1}, {"offset": -2}]:
+            with self.assertRaises(Exception):
+                self.query(**params)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import Mock
+import sys
+import os
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, format_balance, format_currency, format_balance_fast, build_format_table,
+                         format_columns, format_channel_details, CONVERSION_RATES)
+
+RATES = dict(CONVERSION_RATES, usd=100000000000 / 100000, eur=100000000000 / 91604, gbp=100000000000 / 78000,
+             jpy=100000000000 / 15000000, bad=1e-9)
+
+class TestFastFormat(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+
+    def test_matches_format_balance(self):
+        """The precomputed table formats exactly like format_balance, including skipped currencies."""
+        currencies = ["usd", "eur", "gbp", "jpy", "bad", "missing"]
+        table = build_format_table(RATES, currencies)
+        self.assertEqual([entry[0] for entry in table], ["btc", "sats", "msats", "usd", "eur", "gbp", "jpy"])
+        rng = random.Random(1)
+        for amount in [0, 1, 999, 1000, 123456789] + [rng.randrange(10 ** 13) for _ in range(200)]:
+            self.assertEqual(format_balance_fast(amount, table), format_balance(amount, RATES, currencies))
+
+    def test_columns(self):
+        """Column formatting equals format_balance_fast of each amount, in table order."""
+        table = build_format_table(RATES, ["usd", "eur", "gbp", "jpy"])
+        rng = random.Random(2)
+        amounts = [0, 1, 999, 1000, 2 ** 52] + [rng.randrange(10 ** 13) for _ in range(200)]
+        rows = [dict(zip([entry[0] for entry in table], row)) for row in zip(*format_columns(amounts, table))]
+        self.assertEqual(rows, [format_balance_fast(amount, table) for amount in amounts])
+
+    def test_channel_details(self):
+        """Channel details match the per-channel format_balance/format_currency output."""
+        channels = [
+            {"peer_id": "02" + "%064x" % i, "short_channel_id": f"{i}x1x0", "state": "CHANNELD_NORMAL",
+             "connected": i % 7 != 0, "our_amount_msat": i * 1000, "amount_msat": 10 ** 9}
+            for i in range(50)
+        ]
+        currencies = ["usd", "eur"]
+        details, matched = format_channel_details(channels, build_format_table(RATES, currencies))
+        expected = [
+            {
+                "peer_id": ch["peer_id"][:10] + "...",
+                "short_channel_id": ch["short_channel_id"],
+                "outbound_capacity": format_currency(ch["our_amount_msat"], "msats", RATES),
+                "inbound_capacity": format_currency(ch["amount_msat"] - ch["our_amount_msat"], "msats", RATES),
+                "outbound_balance": format_balance(ch["our_amount_msat"], RATES, currencies),
+                "inbound_balance": format_balance(ch["amount_msat"] - ch["our_amount_msat"], RATES, currencies)
+            } for ch in channels if ch["connected"]
+        ]
+        self.assertEqual(details, expected)
+        self.assertEqual(matched, len(expected))
+
+if __name__ == '__main__':
+    unittest.main()
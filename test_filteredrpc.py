@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, BALANCE_LEDGER, CONVERSION_RATES, OUTPUTS_FILTER, CHANNELS_FILTER
+
+OUTPUTS = {"outputs": [
+    {"amount_msat": 100000000, "status": "confirmed", "reserved": False},
+    {"amount_msat": 70000000, "status": "confirmed", "reserved": True}
+]}
+CHANNELS = {"channels": [
+    {"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000},
+    {"peer_id": "03" + "b" * 64, "channel_id": "c2", "short_channel_id": "100x2x0", "state": "ONCHAIN",
+     "peer_connected": False, "to_us_msat": 6000000, "total_msat": 8000000}
+]}
+
+@patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+class TestFilteredRpc(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node and no ledger."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+
+    def methods(self):
+        return [call[0][0] for call in self.plugin.rpc.call.call_args_list]
+
+    def test_onchain_skips_channels(self):
+        """onchain mode only asks listfunds for the output fields it reads."""
+        result = node_balance(self.plugin, mode="onchain", currencies="usd")
+        self.assertEqual(result["onchain_balance"]["msats"], "100,000,000 msats")
+        self.assertEqual(self.methods(), ["listfunds"])
+        self.assertEqual(self.plugin.rpc.call.call_args[1]["filter"], OUTPUTS_FILTER)
+
+    def test_channels_skip_outputs(self):
+        """channels and channel-details only call a filtered listpeerchannels."""
+        result = node_balance(self.plugin, mode="channels", currencies="usd")
+        self.assertEqual(result["channel_balance"]["msats"], "4,000,000 msats")
+        result = node_balance(self.plugin, mode="channel-details", currencies="usd")
+        self.assertEqual(len(result["channels"]), 1)
+        self.assertEqual(result["channels"][0]["inbound_capacity"], "6,000,000 msats")
+        self.assertEqual(self.methods(), ["listpeerchannels", "listpeerchannels"])
+        self.assertEqual(self.plugin.rpc.call.call_args[1]["filter"], CHANNELS_FILTER)
+
+    def test_total_uses_both(self):
+        """total mode needs both outputs and channels."""
+        result = node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertEqual(result["total_balance"]["msats"], "104,000,000 msats")
+        self.assertEqual(sorted(self.methods()), ["listfunds", "listpeerchannels"])
+
+    def test_rate_makes_no_rpc(self):
+        """rate mode never touches the node."""
+        node_balance(self.plugin, mode="rate", currencies="usd")
+        self.plugin.rpc.call.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
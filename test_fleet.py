@@ -0,0 +1,41 @@
+import os
+from pyln.testing.fixtures import *  # noqa: F403
+from pyln.testing.utils import sync_blockheight
+
+plugin = {'plugin': os.path.join(os.path.dirname(__file__), "nodebalance.py")}
+
+def msats(balance):
+    return int(balance["msats"].replace(",", "").replace(" msats", ""))
+
+def test_nodebalance_fleet(node_factory):
+    l2, l3 = node_factory.get_nodes(2)
+    sockets = ",".join(os.path.join(node.daemon.lightning_dir, "regtest", "lightning-rpc") for node in (l2, l3))
+    l1 = node_factory.get_node(options=dict(plugin, **{"nodebalance-fleet-sockets": sockets}))
+    bitcoind = l1.bitcoin
+
+    for node, btc in ((l1, 1), (l2, 2), (l3, 0.5)):
+        bitcoind.rpc.sendtoaddress(node.rpc.newaddr()['bech32'], btc)
+    bitcoind.generate_block(6)
+    sync_blockheight(bitcoind, [l1, l2, l3])
+
+    fleet = l1.rpc.call("nodebalance-fleet", {"currencies": "usd"})
+    assert list(fleet["nodes"]) == ["local"] + sockets.split(",")
+    assert fleet["nodes"]["local"]["id"] == l1.info["id"]
+    assert fleet["nodes_failed"] == 0 and not fleet["partial"]
+
+    # Each node matches its own nodebalance-style total, and the aggregate is their sum
+    totals = [msats(node["total_balance"]) for node in fleet["nodes"].values()]
+    assert totals == [100000000000, 200000000000, 50000000000]
+    assert msats(fleet["aggregate"]["total_balance"]) == sum(totals)
+
+    # A node that is gone is reported, the rest still add up
+    l3.stop()
+    fleet = l1.rpc.call("nodebalance-fleet", {"currencies": "usd", "timeout": 5})
+    assert fleet["partial"] and fleet["nodes_failed"] == 1
+    assert "error" in fleet["nodes"][sockets.split(",")[1]]
+    assert msats(fleet["aggregate"]["total_balance"]) == 300000000000
+
+if __name__ == "__main__":
+    from pyln.testing.fixtures import setup_node_factory
+    node_factory = setup_node_factory()
+    test_nodebalance_fleet(node_factory)
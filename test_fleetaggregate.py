@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance_fleet, BALANCE_LEDGER, FLEET_RPCS, FLEET_CALLS, CONVERSION_RATES
+
+def fake_node(node_id, onchain_msat, channel_msat, delay=0):
+    """RPC client of a node with one output and one channel, answering after delay seconds."""
+    def call(method, payload=None, filter=None):
+        time.sleep(delay)
+        if method == "getinfo":
+            return {"id": node_id}
+        if method == "listfunds":
+            return {"outputs": [{"amount_msat": onchain_msat, "status": "confirmed", "reserved": False}]}
+        return {"channels": [{"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "1x1x0",
+                              "state": "CHANNELD_NORMAL", "peer_connected": True, "to_us_msat": channel_msat,
+                              "total_msat": 10 ** 9}]}
+    rpc = Mock()
+    rpc.call.side_effect = call
+    return rpc
+
+NODES = {
+    "/nodes/a/lightning-rpc": fake_node("02" + "b" * 64, 2000000, 1000000),
+    "/nodes/b/lightning-rpc": fake_node("03" + "c" * 64, 5000000, 0),
+    "/nodes/slow/lightning-rpc": fake_node("03" + "d" * 64, 7000000, 0, delay=1),
+}
+
+@patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+@patch('nodebalance.LightningRpc', Mock(side_effect=lambda path: NODES[path]))
+class TestFleetAggregate(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed local node and no cached fleet clients."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = fake_node("02" + "e" * 64, 1000000, 500000)
+        BALANCE_LEDGER["ready"] = False
+        FLEET_RPCS.clear()
+        FLEET_CALLS.clear()
+
+    def tearDown(self):
+        FLEET_RPCS.clear()
+        FLEET_CALLS.clear()
+        self.plugin.options["nodebalance-fleet-sockets"].value = None
+
+    def test_aggregate(self):
+        """Every node is reported and summed; RPC clients are reused across calls."""
+        self.plugin.options["nodebalance-fleet-sockets"].value = "/nodes/a/lightning-rpc, /nodes/b/lightning-rpc"
+        result = node_balance_fleet(self.plugin, currencies="usd")
+        self.assertEqual(list(result["nodes"]), ["local", "/nodes/a/lightning-rpc", "/nodes/b/lightning-rpc"])
+        self.assertEqual(result["nodes"]["/nodes/a/lightning-rpc"]["id"], "02" + "b" * 64)
+        self.assertEqual(result["nodes"]["/nodes/a/lightning-rpc"]["total_balance"]["msats"], "3,000,000 msats")
+        self.assertEqual(result["aggregate"]["total_balance"]["msats"], "9,500,000 msats")
+        self.assertEqual(result["aggregate"]["channel_balance"]["msats"], "1,500,000 msats")
+        self.assertFalse(result["partial"])
+
+        node_balance_fleet(self.plugin, currencies="usd")
+        self.assertEqual(len(FLEET_RPCS), 2)
+
+    def test_partial_results(self):
+        """Slow and failing nodes are reported with an error and left out of the aggregate."""
+        start = time.monotonic()
+        result = node_balance_fleet(self.plugin, sockets=["/nodes/a/lightning-rpc", "/nodes/slow/lightning-rpc",
+                                                          "/nodes/missing/lightning-rpc"], timeout=0.3)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertIn("no answer within 0.3s", result["nodes"]["/nodes/slow/lightning-rpc"]["error"])
+        self.assertIn("error", result["nodes"]["/nodes/missing/lightning-rpc"])
+        self.assertEqual(result["aggregate"]["total_balance"]["msats"], "4,500,000 msats")
+        self.assertEqual((result["nodes_ok"], result["nodes_failed"], result["partial"]), (2, 2, True))
+
+    def test_hung_node_not_queued(self):
+        """A node still busy with an earlier call gets no new work and holds up no other node."""
+        sockets = ["/nodes/a/lightning-rpc", "/nodes/slow/lightning-rpc"]
+        node_balance_fleet(self.plugin, sockets=sockets, timeout=0.1)
+        hung = FLEET_CALLS["/nodes/slow/lightning-rpc"]
+        result = node_balance_fleet(self.plugin, sockets=sockets, timeout=0.1)
+        self.assertIn("still busy", result["nodes"]["/nodes/slow/lightning-rpc"]["error"])
+        self.assertEqual(result["nodes_ok"], 2)
+        self.assertIs(FLEET_CALLS["/nodes/slow/lightning-rpc"], hung)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, get_fetch_executor, RATES_CACHE, CONVERSION_RATES, FETCH_EXECUTOR,
+                         reset_provider_health)
+
+def slow(rates, delay):
+    """Build a fake provider that answers with rates after delay seconds."""
+    def fetch(currencies):
+        time.sleep(delay)
+        return rates
+    return fetch
+
+class TestHedgedFetch(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin, cache and fetch mode."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
+
+    def tearDown(self):
+        self.plugin.options["nodebalance-fetch-mode"].value = None
+
+    @patch('nodebalance.HEDGE_DELAY', 0.05)
+    @patch('nodebalance.fetch_coincap_rates', slow({"gbp": 77000}, 0))
+    @patch('nodebalance.fetch_coinpaprika_rates', slow({"gbp": 78000}, 0))
+    @patch('nodebalance.fetch_coingecko_rates', slow({"gbp": 79000}, 2))
+    def test_hedged_skips_hung_provider(self):
+        """A hung first provider only costs the hedge delay before the next one answers."""
+        self.plugin.options["nodebalance-fetch-mode"].value = "hedged"
+        start = time.monotonic()
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP"})
+
+    @patch('nodebalance.HEDGE_DELAY', 0.05)
+    @patch('nodebalance.fetch_coincap_rates', slow({"gbp": 77000}, 0))
+    @patch('nodebalance.fetch_coinpaprika_rates', slow({"gbp": 78000}, 0))
+    @patch('nodebalance.fetch_coingecko_rates', slow(None, 0))
+    def test_hedged_moves_on_after_failure(self):
+        """A failing provider starts the next one immediately instead of waiting the hedge delay."""
+        self.plugin.options["nodebalance-fetch-mode"].value = "hedged"
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP"})
+
+    @patch('nodebalance.HEDGE_DELAY', 0)
+    @patch('nodebalance.fetch_coincap_rates', slow({"gbp": 90000, "eur": 91000}, 0))
+    @patch('nodebalance.fetch_coinpaprika_rates', slow({"gbp": 78000}, 0))
+    @patch('nodebalance.fetch_coingecko_rates', slow({"gbp": 79000, "eur": 91604}, 0))
+    def test_median_across_providers(self):
+        """Median mode combines every answer per currency."""
+        self.plugin.options["nodebalance-fetch-mode"].value = "median"
+        result = node_balance(self.plugin, mode="rate", currencies="gbp,eur")
+        self.assertEqual(result["rates"], {"gbp": "79,000.00 GBP", "eur": "91,302.00 EUR"})
+
+    @patch('nodebalance.FETCH_DEADLINE', 0.2)
+    @patch('nodebalance.HEDGE_DELAY', 0)
+    @patch('nodebalance.fetch_coincap_rates', slow({"gbp": 77000}, 2))
+    @patch('nodebalance.fetch_coinpaprika_rates', slow({"gbp": 78000}, 0))
+    @patch('nodebalance.fetch_coingecko_rates', slow({"gbp": 79000}, 2))
+    def test_median_respects_deadline(self):
+        """Providers that miss the deadline are left out of the median."""
+        self.plugin.options["nodebalance-fetch-mode"].value = "median"
+        start = time.monotonic()
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP"})
+
+    def test_executor_created_once(self):
+        """Concurrent first uses of the fetch pool share one executor."""
+        created = []
+        def slow_pool(**kwargs):
+            time.sleep(0.05)
+            created.append(Mock())
+            return created[-1]
+        previous, FETCH_EXECUTOR["executor"] = FETCH_EXECUTOR["executor"], None
+        try:
+            with patch('concurrent.futures.ThreadPoolExecutor', side_effect=slow_pool):
+                executors = []
+                threads = [threading.Thread(target=lambda: executors.append(get_fetch_executor())) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(5)
+        finally:
+            FETCH_EXECUTOR["executor"] = previous
+        self.assertEqual(len(created), 1)
+        self.assertEqual(executors, created * 4)
+
+if __name__ == '__main__':
+    unittest.main()
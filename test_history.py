@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance_history, record_history, sample_history, close_history_store,
+                         HISTORY_STORE, RATES_CACHE, BALANCE_LEDGER, CONVERSION_RATES)
+
+DAY = 86400
+NOW = 1700000000 - 1700000000 % DAY + 12 * 3600  # Noon
+USD = 100000000000 / 100000  # msat per USD at 100,000 USD/BTC
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin and point the history store at a temporary file."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        HISTORY_STORE["path"] = os.path.join(self.tmpdir.name, "nodebalance-history.sqlite3")
+
+    def tearDown(self):
+        close_history_store()
+        HISTORY_STORE["path"] = None
+        self.tmpdir.cleanup()
+
+    @patch('nodebalance.time.time', Mock(return_value=NOW))
+    def test_raw_and_rollups(self):
+        """Raw samples are returned as written; hourly and daily buckets hold their averages."""
+        record_history(NOW - 1800, 1000, 3000, {"usd": USD})
+        record_history(NOW - 1200, 2000, 5000, {"usd": USD * 2})
+        record_history(NOW, 6000, 0, {"usd": USD})
+
+        raw = node_balance_history(self.plugin, start=NOW - 3600, currencies="usd")
+        self.assertEqual(raw["resolution"], "raw")
+        self.assertEqual([s["total_msat"] for s in raw["samples"]], [4000, 7000, 6000])
+        self.assertEqual(raw["samples"][1]["rates"], {"usd": 50000.0})
+
+        hourly = node_balance_history(self.plugin, start=NOW - DAY, resolution="hour", currencies="usd")
+        self.assertEqual([s["timestamp"] for s in hourly["samples"]], [NOW - 3600, NOW])
+        self.assertEqual(hourly["samples"][0]["onchain_msat"], 1500)
+        self.assertEqual(hourly["samples"][0]["channel_msat"], 4000)
+        # 100,000 and 50,000 USD/BTC average to 75,000
+        self.assertEqual(hourly["samples"][0]["rates"], {"usd": 75000.0})
+
+        daily = node_balance_history(self.plugin, start=NOW - DAY, resolution="day", currencies="mxn")
+        self.assertEqual(len(daily["samples"]), 1)
+        self.assertEqual(daily["samples"][0]["total_msat"], (4000 + 7000 + 6000) // 3)
+        self.assertEqual(daily["samples"][0]["rates"], {})
+
+    def test_retention(self):
+        """Raw samples past their retention are pruned, and auto picks a resolution that still has them."""
+        record_history(NOW - 10 * DAY, 1000, 0, {})
+        record_history(NOW, 2000, 0, {})
+        with patch('nodebalance.time.time', Mock(return_value=NOW)):
+            result = node_balance_history(self.plugin, start=NOW - 11 * DAY, resolution="raw")
+            self.assertEqual([s["total_msat"] for s in result["samples"]], [2000])
+            result = node_balance_history(self.plugin, start=NOW - 11 * DAY)
+        self.assertEqual(result["resolution"], "hour")
+        self.assertEqual([s["total_msat"] for s in result["samples"]], [1000, 2000])
+
+    @patch('nodebalance.time.time', Mock(return_value=NOW))
+    def test_sample_from_ledger_and_cache(self):
+        """The sampler records ledger balances and fetched rates, skipping fallback rates."""
+        BALANCE_LEDGER.update({"ready": True, "dirty": False, "onchain_msat": 500, "channel_msat": 250, "channels": {}})
+        RATES_CACHE.update({"rates": dict(CONVERSION_RATES, eur=USD), "timestamps": {"eur": NOW, "usd": NOW},
+                            "sources": {"eur": "CoinGecko", "usd": "fallback"}})
+        self.plugin.rpc = Mock()
+        try:
+            sample_history()
+        finally:
+            BALANCE_LEDGER["ready"] = False
+            RATES_CACHE.update({"rates": CONVERSION_RATES.copy(), "timestamps": {}, "sources": {}})
+        self.plugin.rpc.call.assert_not_called()
+        result = node_balance_history(self.plugin, currencies="usd,eur")
+        self.assertEqual(result["samples"], [{"timestamp": NOW, "onchain_msat": 500, "channel_msat": 250,
+                                              "total_msat": 750, "rates": {"eur": 100000.0}}])
+
+    def test_missing_store_and_invalid_parameters(self):
+        """An empty history answers with no samples; bad ranges and resolutions are rejected."""
+        self.assertEqual(node_balance_history(self.plugin)["samples"], [])
+        self.assertFalse(os.path.exists(HISTORY_STORE["path"]))
+        with self.assertRaises(Exception):
+            node_balance_history(self.plugin, start=2, end=1)
+        with self.assertRaises(Exception):
+            node_balance_history(self.plugin, resolution="minute")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, get_http_session, http_get_json, fetch_coincap_rates, HTTP_VALIDATORS
+
+class TestHttpSession(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin and conditional-request validators."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        HTTP_VALIDATORS.clear()
+
+    def test_session_is_shared(self):
+        """Every provider request goes through one pooled keep-alive session."""
+        session = get_http_session()
+        self.assertIs(get_http_session(), session)
+        self.assertIn("gzip", session.headers["Accept-Encoding"])
+        self.assertNotEqual(session.headers.get("Connection"), "close")
+
+    @patch('requests.Session.get')
+    def test_conditional_request_reuses_body(self, mock_get):
+        """A 304 reply to a revalidation returns the previously decoded body."""
+        first = Mock(status_code=200, headers={"ETag": '"abc"', "Last-Modified": "Tue, 13 May 2025 14:35:00 GMT"})
+        first.json.return_value = {"bitcoin": {"usd": 100000}}
+        mock_get.return_value = first
+        self.assertEqual(http_get_json("https://example.test/price"), {"bitcoin": {"usd": 100000}})
+        self.assertEqual(mock_get.call_args[1]["headers"], {})
+
+        mock_get.return_value = Mock(status_code=304, headers={})
+        self.assertEqual(http_get_json("https://example.test/price"), {"bitcoin": {"usd": 100000}})
+        self.assertEqual(mock_get.call_args[1]["headers"], {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Tue, 13 May 2025 14:35:00 GMT"
+        })
+
+    @patch('requests.Session.get')
+    def test_conditional_requests_disabled(self, mock_get):
+        """Validators are neither stored nor sent when conditional requests are off."""
+        self.plugin.options["nodebalance-http-conditional"].value = False
+        try:
+            response = Mock(status_code=200, headers={"ETag": '"abc"'})
+            response.json.return_value = {}
+            mock_get.return_value = response
+            http_get_json("https://example.test/price")
+            http_get_json("https://example.test/price")
+            self.assertEqual(mock_get.call_args[1]["headers"], {})
+            self.assertEqual(HTTP_VALIDATORS, {})
+        finally:
+            self.plugin.options["nodebalance-http-conditional"].value = None
+
+    @patch('requests.Session.get')
+    def test_coincap_uses_shared_session(self, mock_get):
+        """Both CoinCap requests go through the shared session."""
+        def side_effect(url, *args, **kwargs):
+            if "rates/bitcoin" in url:
+                return Mock(status_code=200, headers={}, json=lambda: {"data": {"id": "bitcoin", "rateUsd": 100000}})
+            return Mock(status_code=200, headers={}, json=lambda: {"data": [{"id": "eur", "rateUsd": 1.25}]})
+        mock_get.side_effect = side_effect
+
+        self.assertEqual(fetch_coincap_rates(["eur"]), {"eur": 80000})
+        self.assertEqual(mock_get.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
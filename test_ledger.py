@@ -0,0 +1,150 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, reconcile_ledger, RECONCILE_ATTEMPTS, get_funds_snapshot, on_coin_movement,
+                         on_balance_snapshot, on_channel_state_changed, on_connect, on_disconnect,
+                         BALANCE_LEDGER, CONVERSION_RATES)
+
+PEER_A = "02" + "a" * 64
+PEER_B = "03" + "b" * 64
+
+def fake_rpc():
+    """RPC answering filtered listfunds/listpeerchannels: two usable outputs, one reserved, one unconfirmed and two channels."""
+    outputs = {
+        "outputs": [
+            {"txid": "aa", "output": 0, "amount_msat": 100000000, "status": "confirmed", "reserved": False},
+            {"txid": "bb", "output": 1, "amount_msat": 50000000, "status": "confirmed", "reserved": False},
+            {"txid": "cc", "output": 0, "amount_msat": 70000000, "status": "confirmed", "reserved": True},
+            {"txid": "dd", "output": 0, "amount_msat": 30000000, "status": "unconfirmed", "reserved": False}
+        ]
+    }
+    channels = {
+        "channels": [
+            {"peer_id": PEER_A, "channel_id": "c1", "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+             "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000},
+            {"peer_id": PEER_B, "channel_id": "c2", "short_channel_id": "100x2x0", "state": "CHANNELD_NORMAL",
+             "peer_connected": True, "to_us_msat": 6000000, "total_msat": 8000000}
+        ]
+    }
+    rpc = Mock()
+    rpc.call.side_effect = lambda method, payload=None, filter=None: outputs if method == "listfunds" else channels
+    return rpc
+
+@patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+class TestBalanceLedger(unittest.TestCase):
+    def setUp(self):
+        """Build the ledger from a mocked RPC."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = fake_rpc()
+        reconcile_ledger()
+
+    def tearDown(self):
+        BALANCE_LEDGER["ready"] = False
+
+    def test_initial_totals(self):
+        """Totals match what listfunds-based modes compute."""
+        self.assertEqual(BALANCE_LEDGER["onchain_msat"], 150000000)
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 10000000)
+
+    def test_modes_served_without_listfunds(self):
+        """Balance modes are answered from the ledger without further RPC calls."""
+        result = node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertEqual(result["total_balance"]["msats"], "160,000,000 msats")
+        result = node_balance(self.plugin, mode="channel-details", currencies="usd")
+        self.assertEqual([ch["short_channel_id"] for ch in result["channels"]], ["100x1x0", "100x2x0"])
+        self.assertEqual(self.plugin.rpc.call.call_count, 2)
+
+    def test_channel_movements(self):
+        """Channel credits and debits move the channel total."""
+        on_coin_movement(self.plugin, {"type": "channel_mvt", "account_id": "c1", "credit_msat": 1000, "debit_msat": 0})
+        on_coin_movement(self.plugin, {"type": "channel_mvt", "account_id": "c2", "credit_msat": 0, "debit_msat": 3000})
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 10000000 - 2000)
+        self.assertEqual(BALANCE_LEDGER["channels"]["c1"]["our_amount_msat"], 4001000)
+
+    def test_wallet_movements(self):
+        """Wallet deposits add outputs and spends remove them."""
+        on_coin_movement(self.plugin, {"type": "chain_mvt", "account_id": "wallet", "utxo_txid": "ee", "vout": 2,
+                                       "credit_msat": 20000000, "debit_msat": 0, "output_msat": 20000000})
+        on_coin_movement(self.plugin, {"type": "chain_mvt", "account_id": "wallet", "utxo": "aa:0",
+                                       "spending_txid": "ff", "credit_msat": 0, "debit_msat": 100000000})
+        self.assertEqual(BALANCE_LEDGER["onchain_msat"], 150000000 + 20000000 - 100000000)
+
+    def test_wallet_spend_older_format(self):
+        """In the older utxo_txid/vout format a spend is marked by txid."""
+        on_coin_movement(self.plugin, {"type": "chain_mvt", "account_id": "wallet", "utxo_txid": "aa", "vout": 0,
+                                       "txid": "ff", "credit_msat": 0, "debit_msat": 100000000})
+        self.assertNotIn("aa:0", BALANCE_LEDGER["outputs"])
+        self.assertEqual(BALANCE_LEDGER["onchain_msat"], 150000000 - 100000000)
+
+    def test_connect_disconnect(self):
+        """Disconnected peers' channels drop out of the channel total until they reconnect."""
+        on_disconnect(self.plugin, disconnect={"id": PEER_B})
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 4000000)
+        on_connect(self.plugin, connect={"id": PEER_B, "direction": "in"})
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 10000000)
+
+    def test_channel_state_changed(self):
+        """Channels leaving CHANNELD_NORMAL stop counting; unknown channels force a reconcile."""
+        on_channel_state_changed(self.plugin, {"channel_id": "c1", "old_state": "CHANNELD_NORMAL",
+                                               "new_state": "CHANNELD_SHUTTING_DOWN"})
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 6000000)
+
+        on_channel_state_changed(self.plugin, {"channel_id": "c3", "old_state": "CHANNELD_AWAITING_LOCKIN",
+                                               "new_state": "CHANNELD_NORMAL"})
+        self.assertTrue(BALANCE_LEDGER["dirty"])
+        get_funds_snapshot(["total"])
+        self.assertFalse(BALANCE_LEDGER["dirty"])
+        self.assertEqual(self.plugin.rpc.call.call_count, 4)
+
+    def test_balance_snapshot(self):
+        """Snapshots set channel balances and detect wallet drift."""
+        on_balance_snapshot(self.plugin, {"accounts": [
+            {"account_id": "wallet", "balance_msat": 220000000},
+            {"account_id": "c1", "balance_msat": 5000000}
+        ]})
+        self.assertEqual(BALANCE_LEDGER["channel_msat"], 11000000)
+        self.assertFalse(BALANCE_LEDGER["dirty"])
+
+        on_balance_snapshot(self.plugin, {"accounts": [{"account_id": "wallet", "balance_msat": 1}]})
+        self.assertTrue(BALANCE_LEDGER["dirty"])
+
+    def test_notification_during_reconcile(self):
+        """A reconcile whose RPC calls raced with a notification is redone instead of dropping it."""
+        rpc = fake_rpc()
+        answer = rpc.call.side_effect
+        spent = {"done": False}
+        def racing_call(method, payload=None, filter=None):
+            result = answer(method, payload, filter)
+            if method == "listfunds" and spent["done"]:
+                result = {"outputs": [o for o in result["outputs"] if o["txid"] != "aa"]}
+            if method == "listpeerchannels" and not spent["done"]:
+                # Output aa is spent after listfunds answered, while listpeerchannels runs
+                spent["done"] = True
+                on_coin_movement(self.plugin, {"type": "chain_mvt", "account_id": "wallet", "utxo": "aa:0",
+                                               "spending_txid": "ee", "debit_msat": 100000000})
+            return result
+        rpc.call.side_effect = racing_call
+        self.plugin.rpc = rpc
+        self.assertTrue(reconcile_ledger())
+        self.assertEqual(rpc.call.call_count, 4)
+        self.assertEqual(BALANCE_LEDGER["onchain_msat"], 50000000)
+
+    def test_reconcile_gives_up_on_constant_notifications(self):
+        """Under a constant stream of notifications the last answers are installed and a retry is requested."""
+        rpc = fake_rpc()
+        answer = rpc.call.side_effect
+        def noisy_call(method, payload=None, filter=None):
+            on_connect(self.plugin, id=PEER_A)
+            return answer(method, payload, filter)
+        rpc.call.side_effect = noisy_call
+        self.plugin.rpc = rpc
+        self.assertFalse(reconcile_ledger())
+        self.assertEqual(rpc.call.call_count, 2 * RECONCILE_ATTEMPTS)
+        self.assertEqual(BALANCE_LEDGER["onchain_msat"], 150000000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import patch, Mock, MagicMock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, set_log_level, log, BALANCE_LEDGER, CONVERSION_RATES
+
+OUTPUTS = {"outputs": [{"amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+CHANNELS = {"channels": [{"peer_id": "02" + "a" * 64, "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+                          "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000}]}
+
+@patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+
+    def tearDown(self):
+        set_log_level(self.plugin, "nodebalance-log-level", "info")
+
+    @patch('nodebalance.json.dumps')
+    def test_no_payload_dumps_at_info(self, mock_dumps):
+        """At info level nothing is pretty-printed and no per-call debug lines are sent."""
+        node_balance(self.plugin, mode="channel-details", currencies="usd,mxn")
+        mock_dumps.assert_not_called()
+        levels = [call[1].get("level") for call in self.plugin.log.call_args_list]
+        self.assertNotIn("debug", levels)
+
+    def test_payload_dumps_at_debug(self):
+        """At debug level the full RPC payloads are logged."""
+        set_log_level(self.plugin, "nodebalance-log-level", "debug")
+        node_balance(self.plugin, mode="total", currencies="usd")
+        log_calls = [call[0][0] for call in self.plugin.log.call_args_list]
+        self.assertTrue(any(line.startswith("listfunds outputs: {") for line in log_calls))
+
+    def test_lazy_arguments(self):
+        """Arguments of suppressed messages are never formatted."""
+        payload = MagicMock()
+        log("payload %s", payload, level="debug")
+        payload.__str__.assert_not_called()
+        self.plugin.log.assert_not_called()
+
+        log("payload %s", "x", level="warn")
+        self.plugin.log.assert_called_once_with("payload x", level="warn")
+
+    def test_invalid_level(self):
+        """Unknown levels are rejected."""
+        with self.assertRaises(ValueError):
+            set_log_level(self.plugin, "nodebalance-log-level", "verbose")
+
+if __name__ == '__main__':
+    unittest.main()
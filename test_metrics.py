@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import urllib.request
+import urllib.error
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, render_metrics, refresh_metrics, start_metrics_server, METRICS, RATES_CACHE,
+                         BALANCE_LEDGER, CONVERSION_RATES)
+
+OUTPUTS = {"outputs": [{"amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+CHANNELS = {"channels": [
+    {"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000},
+    {"peer_id": "03" + "b" * 64, "channel_id": "c2", "short_channel_id": "100x2x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": False, "to_us_msat": 6000000, "total_msat": 8000000}
+]}
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node, no ledger and one fetched rate."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+        RATES_CACHE["rates"] = dict(CONVERSION_RATES, eur=100000000000 / 91604)
+        RATES_CACHE["timestamps"] = {"eur": 1000, "usd": 1000}
+        RATES_CACHE["sources"] = {"eur": "CoinGecko", "usd": "fallback"}
+
+    def tearDown(self):
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["sources"] = {}
+        METRICS["body"] = b""
+
+    def test_render(self):
+        """Balances, usable channels and fetched rates are exported as gauges."""
+        body = render_metrics({"onchain_msat": 100000000, "channel_msat": 4000000,
+                               "channels": [{"peer_id": "02" + "a" * 64, "short_channel_id": "100x1x0",
+                                             "state": "CHANNELD_NORMAL", "connected": True,
+                                             "our_amount_msat": 4000000, "amount_msat": 10000000}]}, 1060).decode()
+        lines = body.splitlines()
+        self.assertIn("nodebalance_total_msat 104000000", lines)
+        self.assertIn('nodebalance_channel_outbound_msat{peer_id="02' + "a" * 64 + '",short_channel_id="100x1x0"} 4000000', lines)
+        self.assertIn('nodebalance_channel_inbound_msat{peer_id="02' + "a" * 64 + '",short_channel_id="100x1x0"} 6000000', lines)
+        self.assertIn('nodebalance_rate_fiat_per_btc{currency="eur"} 91604.00', lines)
+        self.assertIn('nodebalance_rate_age_seconds{currency="eur"} 60', lines)
+        self.assertNotIn('currency="usd"', body)
+
+    @patch('nodebalance.metrics_refresh_loop', Mock())
+    def test_scrapes_serve_snapshot(self):
+        """Scrapes return the last snapshot without calling the node again."""
+        refresh_metrics()
+        self.assertEqual(self.plugin.rpc.call.call_count, 2)
+        server = start_metrics_server(0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            for _ in range(3):
+                with urllib.request.urlopen(url) as response:
+                    self.assertEqual(response.read(), METRICS["body"])
+                    self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/other")
+        finally:
+            server.shutdown()
+            server.server_close()
+            METRICS["server"] = None
+        self.assertEqual(self.plugin.rpc.call.call_count, 2)
+        self.assertIn(b'short_channel_id="100x1x0"', METRICS["body"])
+        self.assertNotIn(b"100x2x0", METRICS["body"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from unittest.mock import Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, check_balance_changes, value_changes, get_funds_snapshot, BALANCE_LEDGER,
+                         RATES_CACHE, RATES_LOCK, NOTIFIER, NOTIFY_TOPIC)
+
+OPTIONS = ["nodebalance-notify-msat", "nodebalance-notify-fiat", "nodebalance-notify-percent",
+           "nodebalance-notify-debounce", "nodebalance-notify-hook", "nodebalance-currencies"]
+
+class TestNotify(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with a ledger, a quoted usd rate and a fresh notifier baseline."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.notify = Mock()
+        self.plugin.rpc = Mock()
+        BALANCE_LEDGER.update(ready=True, dirty=False, onchain_msat=1000000000, channel_msat=1000000000)
+        with RATES_LOCK:
+            self.saved_rates = (RATES_CACHE["rates"], dict(RATES_CACHE["timestamps"]), dict(RATES_CACHE["sources"]))
+            RATES_CACHE["rates"] = dict(RATES_CACHE["rates"], usd=1000000.0)
+            RATES_CACHE["timestamps"]["usd"] = 1
+            RATES_CACHE["sources"]["usd"] = "CoinGecko"
+        NOTIFIER.update(baseline=None, last_sent=0, funds={})
+        self.plugin.options["nodebalance-currencies"].value = "usd"
+
+    def tearDown(self):
+        BALANCE_LEDGER["ready"] = False
+        with RATES_LOCK:
+            RATES_CACHE["rates"], RATES_CACHE["timestamps"], RATES_CACHE["sources"] = self.saved_rates
+        for name in OPTIONS:
+            self.plugin.options[name].value = None
+
+    def test_value_changes(self):
+        """Absolute msat, absolute fiat and percent thresholds apply independently; 0 disables one."""
+        baseline = {"onchain_msat": 1000, "channel_msat": 0, "total_usd": 100.0}
+        values = {"onchain_msat": 1050, "channel_msat": 10, "total_usd": 103.0}
+        self.assertEqual(list(value_changes(baseline, values, 50, 0, 0)), ["onchain_msat"])
+        self.assertEqual(list(value_changes(baseline, values, 0, 3, 0)), ["total_usd"])
+        self.assertEqual(list(value_changes(baseline, values, 0, 0, 4)), ["onchain_msat"])
+        self.assertEqual(value_changes(baseline, values, 0, 0, 0), {})
+        self.assertEqual(value_changes(baseline, values, 50, 0, 0)["onchain_msat"],
+                         {"previous": 1000, "current": 1050, "change": 50, "percent": 5.0})
+
+    def test_notifies_threshold_crossing(self):
+        """The first check sets the baseline; a crossing notifies subscribers and the hook, then rebases."""
+        self.plugin.options["nodebalance-notify-percent"].value = "10"
+        self.plugin.options["nodebalance-notify-hook"].value = "alerts-balance"
+        self.assertEqual(check_balance_changes(1000), 0)
+        self.plugin.notify.assert_not_called()
+
+        BALANCE_LEDGER["channel_msat"] = 1050000000  # 5% of channels, 2.5% of total
+        check_balance_changes(1001)
+        self.plugin.notify.assert_not_called()
+
+        BALANCE_LEDGER["channel_msat"] = 1200000000
+        check_balance_changes(1002)
+        topic, payload = self.plugin.notify.call_args[0]
+        self.assertEqual(topic, NOTIFY_TOPIC)
+        self.assertEqual(list(payload["changes"]), ["channel_msat", "total_msat", "total_usd"])
+        self.assertEqual(payload["changes"]["total_usd"], {"previous": 2000.0, "current": 2200.0, "change": 200.0, "percent": 10.0})
+        self.assertEqual(payload["timestamp"], 1002)
+        self.plugin.rpc.call.assert_called_once_with("alerts-balance", {NOTIFY_TOPIC: payload})
+        self.assertEqual(NOTIFIER["baseline"]["channel_msat"], 1200000000)
+
+    def test_rate_moves(self):
+        """A new rate table alone moves the fiat total."""
+        self.plugin.options["nodebalance-notify-fiat"].value = "100"
+        check_balance_changes(1000)
+        with RATES_LOCK:
+            RATES_CACHE["rates"] = dict(RATES_CACHE["rates"], usd=900000.0)
+        check_balance_changes(1001)
+        self.assertEqual(list(self.plugin.notify.call_args[0][1]["changes"]), ["total_usd"])
+
+    def test_debounce(self):
+        """Changes within the debounce window are held back and sent together once it closes."""
+        self.plugin.options["nodebalance-notify-msat"].value = 1000
+        self.plugin.options["nodebalance-notify-debounce"].value = 60
+        check_balance_changes(1000)
+        BALANCE_LEDGER["onchain_msat"] += 5000
+        check_balance_changes(1001)
+        self.assertEqual(self.plugin.notify.call_count, 1)
+        BALANCE_LEDGER["onchain_msat"] += 5000
+        self.assertEqual(check_balance_changes(1031), 30)
+        BALANCE_LEDGER["onchain_msat"] += 5000
+        self.assertEqual(self.plugin.notify.call_count, 1)
+        check_balance_changes(1061)
+        self.assertEqual(self.plugin.notify.call_count, 2)
+        self.assertEqual(self.plugin.notify.call_args[0][1]["changes"]["onchain_msat"]["change"], 10000)
+
+    def test_rpc_snapshots(self):
+        """Without the ledger, balances come from the snapshots requests take."""
+        BALANCE_LEDGER["ready"] = False
+        self.plugin.options["nodebalance-notify-msat"].value = 1000
+        self.plugin.rpc.call.return_value = {"channels": [], "outputs": []}
+        get_funds_snapshot(["channels"])
+        check_balance_changes(1000)
+        self.assertIsNone(NOTIFIER["baseline"])
+        get_funds_snapshot(["total"])
+        check_balance_changes(1001)
+        self.assertEqual(NOTIFIER["baseline"]["total_msat"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
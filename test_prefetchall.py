@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, RATES_CACHE, CONVERSION_RATES, VALID_CURRENCIES, reset_provider_health
+
+class TestPrefetchAll(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin and cache, and enable full-table prefetching."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.options["nodebalance-prefetch-all"].value = True
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        RATES_CACHE["retrying"].clear()
+        reset_provider_health()
+
+    def tearDown(self):
+        self.plugin.options["nodebalance-prefetch-all"].value = None
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_one_request_serves_every_currency(self, mock_get, mock_time):
+        """The first miss caches the whole fiat table; later currencies are served from cache."""
+        mock_time.return_value = 10000000
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {c: 50000 + i for i, c in enumerate(VALID_CURRENCIES)}}
+        mock_get.return_value = mock_response
+
+        node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertIn("vs_currencies=" + ",".join(VALID_CURRENCIES), mock_get.call_args[0][0])
+
+        for currency in ["eur", "jpy", "chf", "zar"]:
+            result = node_balance(self.plugin, mode="rate", currencies=currency)
+            self.assertNotEqual(result["rates"][currency], "Rate unavailable")
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_partial_table_does_not_fall_through(self, mock_get, mock_time):
+        """A provider quoting the requested currencies but not the whole table ends the fallback chain."""
+        mock_time.return_value = 10000000
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"gbp": 78000, "eur": 91604}}
+        mock_get.return_value = mock_response
+
+        result = node_balance(self.plugin, mode="rate", currencies="gbp,eur")
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP", "eur": "91,604.00 EUR"})
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_unanswered_currency_fetched_when_requested(self, mock_get, mock_time):
+        """Currencies a partial prefetch left unanswered are fetched once requested, not served as fallbacks."""
+        mock_time.return_value = 10000000
+        def side_effect(url, *args, **kwargs):
+            response = Mock(status_code=200, headers={})
+            if "coingecko" in url:
+                response.json.return_value = {"bitcoin": {"gbp": 78000}}
+            else:
+                response.json.return_value = {"quotes": {"GBP": {"price": 78000}, "JPY": {"price": 15000000}}}
+            return response
+        mock_get.side_effect = side_effect
+
+        node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertNotIn("jpy", RATES_CACHE["sources"])
+        calls = mock_get.call_count
+
+        result = node_balance(self.plugin, mode="rate", currencies="jpy")
+        self.assertEqual(result["rates"], {"jpy": "15,000,000.00 JPY"})
+        self.assertGreater(mock_get.call_count, calls)
+        self.assertEqual(RATES_CACHE["sources"]["jpy"], "CoinPaprika")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import requests
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, ordered_providers, refresh_rates, fetch_provider, BALANCE_LEDGER, REFRESHER, record_provider_health, reset_provider_health,
+                         register_provider, RATES_CACHE, RATE_PROVIDERS, PROVIDER_HEALTH, CONVERSION_RATES,
+                         CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+
+NOW = 10000000
+
+def names():
+    return [name for _, name in ordered_providers()]
+
+def rate_limited(retry_after):
+    """Response raising HTTP 429 with a Retry-After header."""
+    response = Mock(status_code=429, headers={"Retry-After": retry_after})
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError("429 Too Many Requests", response=response)
+    return response
+
+@patch('nodebalance.time.time', Mock(return_value=NOW))
+class TestProviderHealth(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin, cache and provider health."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
+
+    def test_registry_order_until_degraded(self):
+        """Providers keep registry order while healthy; a slow or failing one drops behind."""
+        self.assertEqual(names(), ["CoinGecko", "CoinPaprika", "CoinCap"])
+        record_provider_health("CoinGecko", 0.2, True)
+        self.assertEqual(names(), ["CoinGecko", "CoinPaprika", "CoinCap"])
+        record_provider_health("CoinGecko", 5, False)
+        self.assertEqual(names(), ["CoinPaprika", "CoinCap", "CoinGecko"])
+
+    def test_circuit_breaker(self):
+        """Consecutive failures open the circuit; after the cooldown one half-open trial decides."""
+        for _ in range(CIRCUIT_FAILURES):
+            record_provider_health("CoinGecko", 0.1, False)
+        self.assertNotIn("CoinGecko", names())
+
+        with patch('nodebalance.time.time', Mock(return_value=NOW + CIRCUIT_COOLDOWN)):
+            self.assertIn("CoinGecko", names())
+            self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["circuit"], "half-open")
+            record_provider_health("CoinGecko", 0.1, False)
+            self.assertNotIn("CoinGecko", names())
+            self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["cooldown"], 2 * CIRCUIT_COOLDOWN)
+
+        with patch('nodebalance.time.time', Mock(return_value=NOW + 3 * CIRCUIT_COOLDOWN)):
+            self.assertIn("CoinGecko", names())
+            record_provider_health("CoinGecko", 0.1, True)
+            self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["circuit"], "closed")
+            self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["cooldown"], CIRCUIT_COOLDOWN)
+
+    def test_single_half_open_trial(self):
+        """Only one fetch probes a half-open circuit; others fail fast until it closes the circuit."""
+        for _ in range(CIRCUIT_FAILURES):
+            record_provider_health("CoinGecko", 0.1, False)
+        started, release = threading.Event(), threading.Event()
+        def slow_fetch(currencies):
+            started.set()
+            release.wait(5)
+            return {"usd": 100000}
+        with patch('nodebalance.time.time', Mock(return_value=NOW + CIRCUIT_COOLDOWN)):
+            self.assertIn("CoinGecko", names())
+            probe = threading.Thread(target=fetch_provider, args=(slow_fetch, "CoinGecko", ["usd"]))
+            probe.start()
+            started.wait(5)
+            self.assertNotIn("CoinGecko", names())
+            other = Mock(return_value={"usd": 100000})
+            self.assertIsNone(fetch_provider(other, "CoinGecko", ["usd"]))
+            other.assert_not_called()
+            release.set()
+            probe.join(5)
+            self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["circuit"], "closed")
+            self.assertEqual(fetch_provider(other, "CoinGecko", ["usd"]), {"usd": 100000})
+
+    @patch('requests.Session.get')
+    def test_rate_limit_backoff(self, mock_get):
+        """HTTP 429 skips the provider for Retry-After seconds, so later refreshes go straight to the next one."""
+        def side_effect(url, *args, **kwargs):
+            if "coingecko" in url:
+                return rate_limited("120")
+            response = Mock(status_code=200, headers={})
+            response.json.return_value = {"quotes": {"GBP": {"price": 78000}, "EUR": {"price": 91604}}}
+            return response
+        mock_get.side_effect = side_effect
+
+        node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertNotIn("CoinGecko", names())
+        mock_get.reset_mock()
+        node_balance(self.plugin, mode="rate", currencies="eur")
+        self.assertFalse(any("coingecko" in call[0][0] for call in mock_get.call_args_list))
+        self.assertEqual(RATES_CACHE["sources"]["eur"], "CoinPaprika")
+
+        with patch('nodebalance.time.time', Mock(return_value=NOW + 120)):
+            self.assertEqual(names()[-1], "CoinGecko")
+
+    @patch('requests.Session.get')
+    def test_empty_answer_is_not_a_failure(self, mock_get):
+        """A provider answering without a quote stays healthy; only HTTP and parse errors count as failures."""
+        def side_effect(url, *args, **kwargs):
+            response = Mock(status_code=200, headers={})
+            if url.endswith("/rates/bitcoin"):
+                response.json.return_value = {"data": {"rateUsd": "100000"}}
+            else:
+                response.json.return_value = {"bitcoin": {}, "quotes": {}, "data": []}
+            return response
+        mock_get.side_effect = side_effect
+        for _ in range(CIRCUIT_FAILURES):
+            refresh_rates(["gbp"])
+        self.assertEqual(sorted(names()), ["CoinCap", "CoinGecko", "CoinPaprika"])
+        self.assertEqual([health["consecutive_failures"] for health in PROVIDER_HEALTH.values()], [0, 0, 0])
+
+        mock_get.side_effect = None
+        mock_get.return_value = Mock(status_code=200, headers={}, json=Mock(side_effect=ValueError("not JSON")))
+        refresh_rates(["gbp"])
+        self.assertEqual(PROVIDER_HEALTH["CoinGecko"]["consecutive_failures"], 1)
+
+    @patch('nodebalance.get_currency_rates')
+    def test_unsupported_currency_not_fetched(self, mock_rates):
+        """Balance modes neither fetch nor track currencies outside the supported set."""
+        mock_rates.return_value = CONVERSION_RATES
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.return_value = {"outputs": [], "channels": []}
+        BALANCE_LEDGER["ready"] = False
+        node_balance(self.plugin, mode="total", currencies="usd,xyz")
+        mock_rates.assert_called_once_with(["usd"])
+        self.assertNotIn("xyz", REFRESHER["currencies"])
+
+    def test_pluggable_provider(self):
+        """Registered providers take part in fetching."""
+        register_provider("Stub", lambda currencies: {c: 50000 for c in currencies})
+        try:
+            for name in ["CoinGecko", "CoinPaprika", "CoinCap"]:
+                for _ in range(CIRCUIT_FAILURES):
+                    record_provider_health(name, 0.1, False)
+            result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        finally:
+            RATE_PROVIDERS.pop("Stub")
+        self.assertEqual(result["rates"], {"gbp": "50,000.00 GBP"})
+        self.assertEqual(RATES_CACHE["sources"]["gbp"], "Stub")
+
+if __name__ == '__main__':
+    unittest.main()
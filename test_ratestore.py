@@ -0,0 +1,99 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import json
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, load_rates_cache, save_rates_cache, reset_provider_health,
+                         RATES_CACHE, RATE_STORE, CONVERSION_RATES)
+
+class TestRateStore(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin and cache, and point the rate store at a temporary file."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        RATE_STORE["path"] = os.path.join(self.tmpdir.name, "nodebalance-rates.json")
+
+    def tearDown(self):
+        RATE_STORE["path"] = None
+        self.tmpdir.cleanup()
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_refresh_saves_and_restart_loads(self, mock_get, mock_time):
+        """Fetched rates survive a restart and are served without any HTTP request."""
+        mock_time.return_value = 10000000
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"gbp": 78000, "eur": 91604}}
+        mock_get.return_value = mock_response
+        node_balance(self.plugin, mode="rate", currencies="gbp,eur")
+
+        with open(RATE_STORE["path"]) as f:
+            stored = json.load(f)
+        self.assertEqual(stored["rates"]["gbp"][1:], [10000000, "CoinGecko"])
+        self.assertNotIn("usd", stored["rates"])  # Never fetched, only a fallback
+        self.assertFalse(os.path.exists(RATE_STORE["path"] + ".tmp"))
+
+        # Simulate a restart
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        mock_get.reset_mock()
+
+        self.assertEqual(load_rates_cache(RATE_STORE["path"]), 2)
+        mock_time.return_value = 10000000 + 60
+        result = node_balance(self.plugin, mode="rate", currencies="gbp,eur")
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP", "eur": "91,604.00 EUR"})
+        self.assertEqual(result["age"], 60)
+        mock_get.assert_not_called()
+        self.assertEqual(RATES_CACHE["sources"]["eur"], "CoinGecko")
+
+    def test_load_keeps_newer_rates(self):
+        """Stored rates never overwrite newer in-memory ones."""
+        RATES_CACHE["rates"]["gbp"] = 1000
+        RATES_CACHE["timestamps"]["gbp"] = 200
+        RATES_CACHE["sources"]["gbp"] = "CoinCap"
+        save_rates_cache()
+        RATES_CACHE["rates"]["gbp"] = 2000
+        RATES_CACHE["timestamps"]["gbp"] = 300
+
+        self.assertEqual(load_rates_cache(RATE_STORE["path"]), 0)
+        self.assertEqual(RATES_CACHE["rates"]["gbp"], 2000)
+
+    def test_missing_or_corrupt_file(self):
+        """A missing or corrupt store is ignored."""
+        self.assertEqual(load_rates_cache(RATE_STORE["path"]), 0)
+        with open(RATE_STORE["path"], "w") as f:
+            f.write("{not json")
+        self.assertEqual(load_rates_cache(RATE_STORE["path"]), 0)
+        self.assertEqual(RATES_CACHE["rates"], CONVERSION_RATES)
+
+    def test_malformed_entries_skipped(self):
+        """Entries of the wrong shape are skipped with a warning; well-formed ones still load."""
+        with open(RATE_STORE["path"], "w") as f:
+            json.dump({"version": 1, "rates": {
+                "usd": [1, 2], "eur": "bad", "jpy": [None, 100, "CoinGecko"], "chf": [1e6, True, None],
+                "gbp": [1282051.28, 10000000, "CoinGecko"]
+            }}, f)
+        self.assertEqual(load_rates_cache(RATE_STORE["path"]), 1)
+        self.assertEqual(RATES_CACHE["sources"], {"gbp": "CoinGecko"})
+        self.assertEqual(sum("Skipping malformed" in call[0][0] for call in self.plugin.log.call_args_list), 4)
+
+        for stored in ([1, 2], {"version": 1, "rates": [1, 2]}):
+            with open(RATE_STORE["path"], "w") as f:
+                json.dump(stored, f)
+            self.assertEqual(load_rates_cache(RATE_STORE["path"]), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, BALANCE_LEDGER, RESPONSE_CACHE, CONVERSION_RATES
+
+RATES = dict(CONVERSION_RATES, usd=100000000000 / 100000, eur=100000000000 / 90000)
+OUTPUTS = {"outputs": [{"amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+CHANNELS = {"channels": [
+    {"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "100x1x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": True, "to_us_msat": 4000000, "total_msat": 10000000},
+    {"peer_id": "03" + "b" * 64, "channel_id": "c2", "short_channel_id": "200x1x0", "state": "CHANNELD_NORMAL",
+     "peer_connected": True, "to_us_msat": 9000000, "total_msat": 10000000}
+]}
+
+class TestRawFormat(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with an RPC-backed node, no ledger and an empty response cache."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+        RESPONSE_CACHE["entries"].clear()
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=RATES))
+    def test_balance_numbers(self):
+        """Balances are integer msat with numeric fiat values."""
+        result = node_balance(self.plugin, mode="total", currencies="usd,eur", format="raw")
+        self.assertEqual(result["total_balance"], {"msat": 113000000, "fiat": {"usd": 113.0, "eur": 101.7}})
+        onchain = node_balance(self.plugin, mode="onchain", currencies="usd", format="raw")
+        self.assertEqual(onchain["onchain_balance"]["msat"], 100000000)
+        json.dumps(result)
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=RATES))
+    def test_channel_details_columns(self):
+        """channel-details is column-oriented with msat per fiat unit, honouring sort and paging."""
+        result = node_balance(self.plugin, mode="channel-details", currencies="usd", format="raw",
+                              sort="outbound", limit=1)
+        self.assertEqual(result["channels"], {
+            "peer_ids": ["03" + "b" * 64],
+            "short_channel_ids": ["200x1x0"],
+            "outbound_msat": [9000000],
+            "inbound_msat": [1000000]
+        })
+        self.assertEqual(result["msat_per_unit"], {"usd": RATES["usd"]})
+        self.assertEqual((result["total_channels"], result["next_offset"]), (2, 1))
+        full = node_balance(self.plugin, mode="channel-details", currencies="usd", format="raw")
+        self.assertEqual(full["channels"]["outbound_msat"], [4000000, 9000000])
+        json.dumps(full)
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=RATES))
+    def test_cached_separately_from_text(self):
+        """Text and raw responses for the same mode are cached under different keys."""
+        text = node_balance(self.plugin, mode="channels", currencies="usd")
+        raw = node_balance(self.plugin, mode="channels", currencies="usd", format="raw")
+        self.assertEqual(text["channel_balance"]["usd"], "13.00 USD")
+        self.assertEqual(raw["channel_balance"]["msat"], 13000000)
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=RATES))
+    def test_rates(self):
+        """Rate mode returns fiat per BTC as numbers and a unix timestamp."""
+        result = node_balance(self.plugin, mode="rate", currencies="usd,eur", format="raw")
+        self.assertEqual(result["rates"], {"usd": 100000.0, "eur": 90000.0})
+        self.assertIsInstance(result["timestamp"], int)
+        invalid = node_balance(self.plugin, mode="rate", currencies="usd,xyz", format="raw")
+        self.assertEqual(invalid["rates"], {"usd": None, "xyz": None})
+
+    def test_invalid_format(self):
+        """Unknown formats are rejected."""
+        with self.assertRaises(Exception) as ctx:
+            node_balance(self.plugin, mode="total", format="csv")
+        self.assertIn("Invalid format", str(ctx.exception))
+
+if __name__ == '__main__':
+    unittest.main()
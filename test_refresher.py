@@ -0,0 +1,204 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import time
+import requests
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, get_currency_rates, next_refresh_delay, due_currencies, refresh_rates,
+                         refresh_round,
+                         reset_provider_health, RATES_CACHE, CONVERSION_RATES, CACHE_TIMEOUT, REFRESH_AHEAD,
+                         RETRY_TIMEOUT, REFRESHER, REQUEST_WINDOW)
+
+class TestBackgroundRefresh(unittest.TestCase):
+    def setUp(self):
+        """Seed the cache with a valid gbp rate fetched at t=10000000."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["rates"]["gbp"] = RATES_CACHE["rates"]["btc"] / 78000
+        RATES_CACHE["timestamp"] = 10000000
+        RATES_CACHE["timestamps"] = {"gbp": 10000000}
+        RATES_CACHE["ttls"] = {"gbp": CACHE_TIMEOUT}
+        RATES_CACHE["sources"] = {"gbp": "CoinGecko"}
+        RATES_CACHE["retrying"].clear()
+        reset_provider_health()
+        REFRESHER["currencies"].clear()
+        REFRESHER["wake"].clear()
+
+    def tearDown(self):
+        REFRESHER["thread"] = None
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_stale_rates_served_while_refreshing(self, mock_get, mock_time):
+        """Expired rates within the stale bound are returned without blocking on HTTP."""
+        mock_time.return_value = 10000000 + CACHE_TIMEOUT + 60
+        REFRESHER["thread"] = Mock(is_alive=Mock(return_value=True))
+
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP"})
+        self.assertFalse(result["fresh"])
+        self.assertEqual(result["age"], CACHE_TIMEOUT + 60)
+        mock_get.assert_not_called()
+        self.assertTrue(REFRESHER["wake"].is_set())
+        self.assertIn("gbp", REFRESHER["currencies"])
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_fallback_rates_not_fresh(self, mock_get, mock_time):
+        """A fallback rate written when no API answered reports no age and is never fresh."""
+        reset_provider_health()
+        mock_time.return_value = 10000000 + 60
+        mock_get.side_effect = requests.exceptions.RequestException("API down")
+
+        result = node_balance(self.plugin, mode="rate", currencies="eur")
+        self.assertEqual(RATES_CACHE["sources"]["eur"], "fallback")
+        self.assertIsNone(result["age"])
+        self.assertFalse(result["fresh"])
+
+        # A fetched rate next to it does not lend the fallback its age
+        result = node_balance(self.plugin, mode="rate", currencies="gbp,eur")
+        self.assertIsNone(result["age"])
+        self.assertFalse(result["fresh"])
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertEqual(result["age"], 60)
+        self.assertTrue(result["fresh"])
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_blocking_fetch_without_refresher(self, mock_get, mock_time):
+        """Expired rates are refetched inline when no background refresher is running."""
+        mock_time.return_value = 10000000 + CACHE_TIMEOUT + 60
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"gbp": 80000}}
+        mock_get.return_value = mock_response
+
+        rates = get_currency_rates(["gbp"])
+        self.assertAlmostEqual(rates["btc"] / rates["gbp"], 80000)
+        mock_get.assert_called_once()
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_too_stale_rates_block(self, mock_get, mock_time):
+        """Rates older than the stale bound are refetched even with a refresher running."""
+        mock_time.return_value = 10000000 + 7 * 3600
+        REFRESHER["thread"] = Mock(is_alive=Mock(return_value=True))
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"gbp": 80000}}
+        mock_get.return_value = mock_response
+
+        result = node_balance(self.plugin, mode="rate", currencies="gbp")
+        self.assertEqual(result["rates"], {"gbp": "80,000.00 GBP"})
+        self.assertTrue(result["fresh"])
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_only_missing_currencies_fetched(self, mock_get, mock_time):
+        """A miss fetches only the missing currencies and leaves fresh ones untouched."""
+        mock_time.return_value = 10000000 + 60
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"eur": 91604, "jpy": 15000000}}
+        mock_get.return_value = mock_response
+
+        result = node_balance(self.plugin, mode="rate", currencies="gbp,eur,jpy")
+        self.assertEqual(result["rates"], {"gbp": "78,000.00 GBP", "eur": "91,604.00 EUR", "jpy": "15,000,000.00 JPY"})
+        mock_get.assert_called_once()
+        self.assertIn("vs_currencies=eur,jpy", mock_get.call_args[0][0])
+        self.assertEqual(RATES_CACHE["timestamps"]["gbp"], 10000000)
+        self.assertEqual(RATES_CACHE["timestamps"]["eur"], 10000000 + 60)
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_unquoted_currency_not_retried_every_call(self, mock_get, mock_time):
+        """A currency no API could quote is retried after RETRY_TIMEOUT, not on every call."""
+        mock_time.return_value = 10000000
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {}}
+        mock_get.return_value = mock_response
+
+        node_balance(self.plugin, mode="rate", currencies="eur")
+        calls = mock_get.call_count
+        result = node_balance(self.plugin, mode="rate", currencies="eur")
+        self.assertEqual(mock_get.call_count, calls)
+        self.assertEqual(result["rates"], {"eur": "Rate unavailable"})
+
+    def test_next_refresh_delay(self):
+        """Refresh is scheduled REFRESH_AHEAD seconds before expiry, and only for tracked currencies."""
+        self.assertIsNone(next_refresh_delay(10000000))
+        REFRESHER["currencies"]["gbp"] = 10000000
+        self.assertEqual(next_refresh_delay(10000000), CACHE_TIMEOUT - REFRESH_AHEAD)
+        self.assertEqual(next_refresh_delay(10000000 + CACHE_TIMEOUT), 0)
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_unquoted_currency_waits_retry_timeout(self, mock_get, mock_time):
+        """The refresher retries a currency no API could quote after RETRY_TIMEOUT, not REFRESH_AHEAD early."""
+        reset_provider_health()
+        mock_time.return_value = 10000000
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {}}
+        mock_get.return_value = mock_response
+        REFRESHER["currencies"]["eur"] = 10000000
+        RATES_CACHE["timestamps"]["gbp"] = 10000000 + CACHE_TIMEOUT  # Keep gbp out of the way
+
+        refresh_rates(["eur"])
+        self.assertEqual(due_currencies(10000000), [])
+        self.assertEqual(next_refresh_delay(10000000), RETRY_TIMEOUT)
+        self.assertEqual(due_currencies(10000000 + RETRY_TIMEOUT), ["eur"])
+
+        # A rate kept after a failed renewal is also only retried once RETRY_TIMEOUT has passed
+        REFRESHER["currencies"]["gbp"] = 10000000
+        RATES_CACHE["timestamps"]["gbp"] = 10000000 - CACHE_TIMEOUT + REFRESH_AHEAD
+        refresh_rates(["gbp"])
+        self.assertNotIn("gbp", due_currencies(10000000 + RETRY_TIMEOUT - 1))
+        self.assertIn("gbp", due_currencies(10000000 + RETRY_TIMEOUT))
+
+    @patch('nodebalance.time.time')
+    @patch('requests.Session.get')
+    def test_refresh_round_renews_ahead_of_expiry(self, mock_get, mock_time):
+        """A refresher round renews rates that are due but not yet expired."""
+        mock_time.return_value = 10000000 + CACHE_TIMEOUT - REFRESH_AHEAD
+        mock_response = Mock(status_code=200, headers={})
+        mock_response.json.return_value = {"bitcoin": {"gbp": 79000}}
+        mock_get.return_value = mock_response
+        REFRESHER["currencies"]["gbp"] = 10000000
+
+        refresh_round(10000000 + CACHE_TIMEOUT - REFRESH_AHEAD)
+        mock_get.assert_called_once()
+        self.assertEqual(RATES_CACHE["timestamps"]["gbp"], 10000000 + CACHE_TIMEOUT - REFRESH_AHEAD)
+
+    @patch('requests.Session.get')
+    def test_refresh_round_joins_inflight_fetch(self, mock_get):
+        """A refresher round joins a nodebalance call already fetching its due currencies."""
+        RATES_CACHE["timestamps"] = {}
+        started, release = threading.Event(), threading.Event()
+        def slow_get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return Mock(status_code=200, headers={}, json=Mock(return_value={"bitcoin": {"eur": 91604}}))
+        mock_get.side_effect = slow_get
+        caller = threading.Thread(target=get_currency_rates, args=(["eur"],))
+        caller.start()
+        started.wait(5)
+        refresher = threading.Thread(target=refresh_round, args=(time.time(),))
+        refresher.start()
+        release.set()
+        caller.join(5)
+        refresher.join(5)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertIn("eur", RATES_CACHE["timestamps"])
+
+    def test_due_currencies_merged_and_pruned(self):
+        """Due currencies are refreshed together; ones nobody asked for recently are dropped."""
+        now = 10000000 + CACHE_TIMEOUT
+        REFRESHER["currencies"]["gbp"] = now
+        REFRESHER["currencies"]["eur"] = now  # Never fetched, due immediately
+        REFRESHER["currencies"]["jpy"] = now - REQUEST_WINDOW - 1
+        self.assertEqual(due_currencies(now), ["eur", "gbp"])
+        self.assertNotIn("jpy", REFRESHER["currencies"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, node_balance_stats, reconcile_ledger, on_coin_movement, rpc_snapshot,
+                         mark_ledger_dirty, BALANCE_LEDGER, RATES_CACHE, RESPONSE_CACHE, CONVERSION_RATES)
+
+NOW = 10000000
+USD = 100000000000 / 100000  # msat per USD at 100,000 USD/BTC
+
+def fake_rpc(channel_msat):
+    """RPC answering one output and one channel with channel_msat on our side."""
+    outputs = {"outputs": [{"txid": "aa", "output": 0, "amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+    channels = {"channels": [{"peer_id": "02" + "a" * 64, "channel_id": "c1", "short_channel_id": "100x1x0",
+                              "state": "CHANNELD_NORMAL", "peer_connected": True, "to_us_msat": channel_msat,
+                              "total_msat": 10000000}]}
+    rpc = Mock()
+    rpc.call.side_effect = lambda method, payload=None, filter=None: outputs if method == "listfunds" else channels
+    return rpc
+
+@patch('nodebalance.time.time', Mock(return_value=NOW))
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin, stats and response cache with fresh usd rates."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = fake_rpc(4000000)
+        BALANCE_LEDGER["ready"] = False
+        RATES_CACHE["rates"] = dict(CONVERSION_RATES, usd=USD)
+        RATES_CACHE["timestamps"] = {"usd": NOW - 60}
+        RATES_CACHE["ttls"] = {"usd": 3600}
+        RATES_CACHE["sources"] = {"usd": "CoinGecko"}
+        RESPONSE_CACHE["entries"].clear()
+        node_balance_stats(self.plugin, reset=True)
+
+    def tearDown(self):
+        BALANCE_LEDGER["ready"] = False
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        self.plugin.options["nodebalance-response-cache"].value = None
+
+    def test_ledger_hits_skip_snapshot(self):
+        """With a clean ledger, repeated calls reuse the response until a notification changes the funds."""
+        reconcile_ledger()
+        first = node_balance(self.plugin, mode="channel-details", currencies="usd")
+        with patch('nodebalance.get_funds_snapshot') as mock_snapshot, \
+                patch('nodebalance.time.time', Mock(return_value=NOW + 30)):
+            second = node_balance(self.plugin, mode="channel-details", currencies="usd")
+            mock_snapshot.assert_not_called()
+        self.assertEqual(second["channels"], first["channels"])
+        self.assertEqual((first["rates_age"], second["rates_age"]), (60, 90))
+
+        on_coin_movement(self.plugin, {"type": "channel_mvt", "account_id": "c1", "credit_msat": 1000, "debit_msat": 0})
+        third = node_balance(self.plugin, mode="channel-details", currencies="usd")
+        self.assertEqual(third["channels"][0]["outbound_capacity"], "4,001,000 msats")
+        self.assertEqual(node_balance_stats(self.plugin)["response_cache"]["hit_rate"], round(1 / 3, 3))
+
+    def test_rpc_digest(self):
+        """Without the ledger, unchanged RPC snapshots reuse the response and changed ones do not."""
+        first = node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertIs(node_balance(self.plugin, mode="total", currencies="usd")["total_balance"], first["total_balance"])
+        self.plugin.rpc = fake_rpc(5000000)
+        self.assertEqual(node_balance(self.plugin, mode="total", currencies="usd")["total_balance"]["msats"],
+                         "105,000,000 msats")
+        self.assertEqual(node_balance_stats(self.plugin)["counters"]["response_cache_hit"], 1)
+
+    def test_disabled_skips_digest(self):
+        """With the cache disabled, snapshots are not digested and nothing is looked up."""
+        self.plugin.options["nodebalance-response-cache"].value = 0
+        with patch('nodebalance.rpc_snapshot', wraps=rpc_snapshot) as mock_snapshot:
+            node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertFalse(mock_snapshot.call_args.kwargs["digest"])
+        self.assertNotIn("response_cache_miss", node_balance_stats(self.plugin)["counters"])
+
+    def test_dirty_ledger_keyed_on_version(self):
+        """A dirty ledger is reconciled and keys the response on its version, without a digest."""
+        reconcile_ledger()
+        mark_ledger_dirty("test")
+        with patch('nodebalance.rpc_snapshot') as mock_snapshot:
+            node_balance(self.plugin, mode="total", currencies="usd")
+            mock_snapshot.assert_not_called()
+        self.assertEqual([key[-1][0] for key in RESPONSE_CACHE["entries"]], ["ledger"])
+
+    def test_rate_refresh_invalidates(self):
+        """A refreshed rate table, different currencies or parameters never reuse a response."""
+        first = node_balance(self.plugin, mode="total", currencies="usd")
+        RATES_CACHE["rates"] = dict(CONVERSION_RATES, usd=USD * 2)
+        second = node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertNotEqual(second["total_balance"]["usd"], first["total_balance"]["usd"])
+        node_balance(self.plugin, mode="total", currencies="usd,mxn")
+        node_balance(self.plugin, mode="channel-details", currencies="usd", limit=1)
+        self.assertEqual(node_balance_stats(self.plugin)["counters"].get("response_cache_hit", 0), 0)
+
+    def test_bounded(self):
+        """The cache keeps at most nodebalance-response-cache entries, evicting the least recently used."""
+        self.plugin.options["nodebalance-response-cache"].value = 2
+        for mode in ["total", "onchain", "channels"]:
+            node_balance(self.plugin, mode=mode, currencies="usd")
+        self.assertEqual([key[0] for key in RESPONSE_CACHE["entries"]], ["onchain", "channels"])
+
+        self.plugin.options["nodebalance-response-cache"].value = 0
+        RESPONSE_CACHE["entries"].clear()
+        node_balance(self.plugin, mode="total", currencies="usd")
+        self.assertEqual(len(RESPONSE_CACHE["entries"]), 0)
+
+if __name__ == '__main__':
+    unittest.main()
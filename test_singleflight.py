@@ -0,0 +1,73 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance_request, get_currency_rates, reset_provider_health, RATES_CACHE,
+                         BALANCE_LEDGER, CONVERSION_RATES)
+
+def slow_coingecko(url, *args, **kwargs):
+    """CoinGecko answering gbp/eur after a short delay."""
+    time.sleep(0.2)
+    response = Mock(status_code=200, headers={})
+    response.json.return_value = {"bitcoin": {"gbp": 78000, "eur": 91604}}
+    return response
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin, cache and provider health."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
+
+    @patch('requests.Session.get', side_effect=slow_coingecko)
+    def test_burst_makes_one_request(self, mock_get):
+        """Concurrent cache misses for the same currencies share one upstream fetch."""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_currency_rates(["gbp", "eur"])))
+                   for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(round(CONVERSION_RATES["btc"] / r["gbp"]) == 78000 for r in results))
+
+    @patch('requests.Session.get', side_effect=slow_coingecko)
+    def test_overlapping_currencies(self, mock_get):
+        """A caller only fetches the currencies nobody else is already fetching."""
+        first = threading.Thread(target=get_currency_rates, args=(["gbp"],))
+        first.start()
+        time.sleep(0.05)
+        get_currency_rates(["gbp", "eur"])
+        first.join()
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertIn("vs_currencies=eur", mock_get.call_args_list[1][0][0])
+        self.assertGreater(RATES_CACHE["timestamps"]["gbp"], 0)
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+    def test_async_method(self):
+        """nodebalance answers its request from a worker thread, errors included."""
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.return_value = {"outputs": [{"amount_msat": 5000, "status": "confirmed", "reserved": False}]}
+        BALANCE_LEDGER["ready"] = False
+        request = Mock()
+        node_balance_request(self.plugin, request, mode="onchain", currencies="usd").result(timeout=5)
+        self.assertEqual(request.set_result.call_args[0][0]["onchain_balance"]["msats"], "5,000 msats")
+
+        request = Mock()
+        node_balance_request(self.plugin, request, mode="total", currencies="usd", sort="fees").result(timeout=5)
+        request.set_result.assert_not_called()
+        self.assertIn("Invalid sort", str(request.set_exception.call_args[0][0]))
+
+if __name__ == '__main__':
+    unittest.main()
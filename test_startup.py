@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import json
+import subprocess
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, prefetch_rates, refresh_coalesced, reset_provider_health, RATES_CACHE, CONVERSION_RATES
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFERRED = ["requests", "sqlite3", "http.server", "concurrent.futures", "email.utils"]
+MAX_IMPORT_SECONDS = 0.5  # nodebalance's own import time on top of pyln.client
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+import pyln.client
+start = time.perf_counter()
+import nodebalance
+print(json.dumps({{"seconds": time.perf_counter() - start, "loaded": [m for m in {DEFERRED!r} if m in sys.modules]}}))
+"""
+
+class TestStartup(unittest.TestCase):
+    def test_import_is_light(self):
+        """Importing the plugin loads none of the deferred modules and stays fast."""
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=PLUGIN_DIR, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output)
+        self.assertEqual(result["loaded"], [])
+        self.assertLess(result["seconds"], MAX_IMPORT_SECONDS)
+
+    def test_prefetch_does_not_block(self):
+        """The init prefetch returns at once and fetches the configured currencies in the background."""
+        plugin.log = Mock()
+        release = threading.Event()
+        fetched = []
+        def slow_rates(currencies):
+            release.wait(5)
+            fetched.append(currencies)
+        with patch('nodebalance.refresh_coalesced', side_effect=slow_rates):
+            thread = prefetch_rates(["usd", "eur"])
+            self.assertTrue(thread.is_alive())
+            release.set()
+            thread.join(5)
+        self.assertEqual(fetched, [["usd", "eur"]])
+
+    @patch('requests.Session.get')
+    def test_prefetch_joins_inflight_refresh(self, mock_get):
+        """A prefetch of currencies already being refreshed waits for that fetch instead of making its own."""
+        plugin.log = Mock()
+        reset_provider_health()
+        RATES_CACHE.update({"rates": CONVERSION_RATES.copy(), "timestamps": {}, "ttls": {}, "sources": {}})
+        RATES_CACHE["retrying"].clear()
+        started, release = threading.Event(), threading.Event()
+        def slow_get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return Mock(status_code=200, headers={}, json=Mock(return_value={"bitcoin": {"usd": 100000, "eur": 91604}}))
+        mock_get.side_effect = slow_get
+        refresher = threading.Thread(target=refresh_coalesced, args=(["usd", "eur"],))
+        refresher.start()
+        started.wait(5)
+        thread = prefetch_rates(["usd", "eur"])
+        release.set()
+        refresher.join(5)
+        thread.join(5)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertIn("eur", RATES_CACHE["timestamps"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import (plugin, node_balance, node_balance_stats, reset_provider_health, RATES_CACHE, BALANCE_LEDGER,
+                         CONVERSION_RATES)
+
+OUTPUTS = {"outputs": [{"amount_msat": 100000000, "status": "confirmed", "reserved": False}]}
+CHANNELS = {"channels": []}
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin, cache and stats with an RPC-backed node."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        self.plugin.rpc = Mock()
+        self.plugin.rpc.call.side_effect = lambda method, payload=None, filter=None: OUTPUTS if method == "listfunds" else CHANNELS
+        BALANCE_LEDGER["ready"] = False
+        RATES_CACHE["rates"] = CONVERSION_RATES.copy()
+        RATES_CACHE["timestamp"] = 0
+        RATES_CACHE["timestamps"] = {}
+        RATES_CACHE["ttls"] = {}
+        RATES_CACHE["sources"] = {}
+        reset_provider_health()
+        node_balance_stats(self.plugin, reset=True)
+
+    def tearDown(self):
+        self.plugin.options["nodebalance-slow-call-ms"].value = None
+
+    @patch('requests.Session.get')
+    def test_stages_counters_and_providers(self, mock_get):
+        """Stage timers, cache counters and provider outcomes are reported."""
+        failure = Mock(status_code=500, headers={})
+        failure.raise_for_status.side_effect = Exception("500 Server Error")
+        success = Mock(status_code=200, headers={})
+        success.json.return_value = {"quotes": {"EUR": {"price": 91604}}}
+        mock_get.side_effect = [failure, success]
+
+        node_balance(self.plugin, mode="total", currencies="eur")
+        node_balance(self.plugin, mode="rate", currencies="eur")
+        stats = node_balance_stats(self.plugin)
+
+        self.assertEqual(stats["counters"], {"funds_rpc": 1, "rates_cache_hit": 1, "rates_cache_miss": 1,
+                                             "response_cache_miss": 1})
+        self.assertEqual(stats["timers"]["nodebalance"]["count"], 2)
+        self.assertEqual(stats["timers"]["rates_fetch"]["count"], 1)
+        self.assertEqual(stats["timers"]["rpc_listfunds"]["count"], 1)
+        self.assertEqual(stats["timers"]["format"]["count"], 2)
+        self.assertIn("aggregate", stats["timers"])
+        self.assertEqual((stats["providers"]["CoinGecko"]["success"], stats["providers"]["CoinGecko"]["failure"]), (0, 1))
+        self.assertEqual((stats["providers"]["CoinPaprika"]["success"], stats["providers"]["CoinPaprika"]["failure"]), (1, 0))
+        self.assertEqual(sum(stats["providers"]["CoinPaprika"]["latency_ms"].values()), 1)
+
+    def test_reset(self):
+        """reset returns the current stats and starts over."""
+        node_balance(self.plugin, mode="onchain", currencies="usd")
+        self.assertIn("nodebalance", node_balance_stats(self.plugin, reset=True)["timers"])
+        self.assertEqual(node_balance_stats(self.plugin)["timers"], {})
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=CONVERSION_RATES))
+    def test_slow_call_log(self):
+        """Calls over nodebalance-slow-call-ms are logged with their stage breakdown."""
+        node_balance(self.plugin, mode="onchain", currencies="usd")
+        self.assertFalse(any("Slow nodebalance" in str(call) for call in self.plugin.log.call_args_list))
+
+        self.plugin.options["nodebalance-slow-call-ms"].value = 1
+        with patch('nodebalance.time.perf_counter', side_effect=[0, 0, 0.01, 0.01, 0.01, 0.01, 0.02, 0.03]):
+            node_balance(self.plugin, mode="onchain", currencies="usd")
+        slow = [call for call in self.plugin.log.call_args_list if "Slow nodebalance" in call[0][0]]
+        self.assertEqual(len(slow), 1)
+        self.assertIn("mode=onchain", slow[0][0][0])
+        self.assertIn("rpc_listfunds 10ms", slow[0][0][0])
+        self.assertEqual(slow[0][1]["level"], "warn")
+
+if __name__ == '__main__':
+    unittest.main()
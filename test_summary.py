@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nodebalance import plugin, node_balance, summarize_channels, percentile, BALANCE_LEDGER, RESPONSE_CACHE, CONVERSION_RATES
+
+RATES = dict(CONVERSION_RATES, usd=100000000000 / 100000)
+
+def channel(i, our_msat, capacity=10000000, state="CHANNELD_NORMAL", connected=True):
+    return {"peer_id": "02" + "%064x" % i, "short_channel_id": f"{i}x1x0", "state": state,
+            "connected": connected, "our_amount_msat": our_msat, "amount_msat": capacity}
+
+CHANNELS = [
+    channel(1, 0),
+    channel(2, 1000000),
+    channel(3, 5000000),
+    channel(4, 5500000, capacity=20000000),
+    channel(5, 10000000),
+    channel(6, 3000000, connected=False),
+    channel(7, 0, state="ONCHAIN"),
+]
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        """Reset plugin with a ledger holding CHANNELS and an empty response cache."""
+        self.plugin = plugin
+        self.plugin.log = Mock()
+        BALANCE_LEDGER.update(ready=True, dirty=False, onchain_msat=0, channel_msat=21500000,
+                              channels={c["short_channel_id"]: c for c in CHANNELS})
+        BALANCE_LEDGER["version"] += 1
+        RESPONSE_CACHE["entries"].clear()
+
+    def tearDown(self):
+        BALANCE_LEDGER.update(ready=False, channels={})
+
+    def test_statistics(self):
+        """Counts, totals, histogram, percentiles and imbalanced channels come from one pass."""
+        summary = summarize_channels(CHANNELS, limit=2)
+        self.assertEqual(summary["channels"], 5)
+        self.assertEqual(summary["states"], {"CHANNELD_NORMAL": 6, "ONCHAIN": 1})
+        self.assertEqual(summary["disconnected"], 1)
+        self.assertEqual(summary["outbound_msat"], 21500000)
+        self.assertEqual(summary["inbound_msat"], 38500000)
+        self.assertEqual(list(summary["ratio_histogram"].values()), [1, 1, 1, 0, 0, 1, 0, 0, 0, 1])
+        self.assertEqual(summary["ratio_percentiles"]["p50"], 0.275)
+        self.assertEqual(summary["capacity_percentiles_msat"]["p90"], 20000000)
+        self.assertEqual([c["short_channel_id"] for c in summary["most_imbalanced"]], ["1x1x0", "5x1x0"])
+
+    def test_filters_and_empty(self):
+        """Filters apply to every channel; no matching channels gives empty statistics."""
+        summary = summarize_channels(CHANNELS, min_capacity=15000000)
+        self.assertEqual((summary["channels"], summary["states"]), (1, {"CHANNELD_NORMAL": 1}))
+        empty = summarize_channels(CHANNELS, peer="03")
+        self.assertEqual(empty["channels"], 0)
+        self.assertIsNone(empty["ratio_percentiles"]["p50"])
+        self.assertEqual(empty["most_imbalanced"], [])
+        self.assertIsNone(percentile([], 50))
+
+    @patch('nodebalance.get_currency_rates', Mock(return_value=RATES))
+    def test_modes(self):
+        """summary renders formatted text or raw numbers and rejects paging parameters."""
+        text = node_balance(self.plugin, mode="summary", currencies="usd", limit=1)
+        self.assertEqual(text["outbound_balance"]["usd"], "21.50 USD")
+        self.assertEqual(text["most_imbalanced"][0]["peer_id"], CHANNELS[0]["peer_id"][:10] + "...")
+        self.assertEqual(text["capacity_percentiles"]["p90"], "20,000 sats")
+        raw = node_balance(self.plugin, mode="summary", currencies="usd", format="raw")
+        self.assertEqual(raw["outbound_balance"], {"msat": 21500000, "fiat": {"usd": 21.5}})
+        self.assertEqual(len(raw["most_imbalanced"]), 5)
+        self.assertLess(len(json.dumps(raw)), 2000)
+        with self.assertRaises(Exception):
+            node_balance(self.plugin, mode="summary", sort="ratio")
+
+if __name__ == '__main__':
+    unittest.main()